@@ -0,0 +1,117 @@
+import blockchain
+import metrics
+import utils
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+
+# Transaction admission for the mempool. Duplicates and txs already in the
+# chain are dropped first, signatures are checked in a process pool with no
+# lock held, and the accepted txs are committed in one short critical section
+# per batch. Txs that don't fit in the queue come back as TX_BUSY.
+
+MAX_PENDING_TXS = 20000 # txs being verified at once, across all callers
+VERIFY_CHUNK_SIZE = 64  # txs per job sent to a worker
+DEFAULT_NUM_WORKERS = os.cpu_count() or 1
+
+pendingGauge     = metrics.registry.Gauge('admission_pending_txs', 'Transactions being verified')
+busyCounter      = metrics.registry.Counter('admission_busy_total', 'Transactions refused with TX_BUSY')
+admitHistogram   = metrics.registry.Histogram('admission_batch_seconds', 'Admit latency per batch')
+
+def VerifySignatures(items):
+    # Runs in a worker process: [(txHash, signature, fromAddr)] -> [bool]
+    return [utils.ValidateSignature(txHash, signature, fromAddr)
+            for txHash, signature, fromAddr in items]
+
+
+class AdmissionPipeline:
+    def __init__(self, bc, numWorkers=DEFAULT_NUM_WORKERS, maxPending=MAX_PENDING_TXS):
+        self.blockchain = bc
+        self.numWorkers = numWorkers # 0 verifies in the calling thread
+        self.maxPending = maxPending
+        self.executor   = None
+        self.pending    = set() # hashes of txs being verified
+        self.lock       = threading.Lock()
+
+    def Start(self):
+        if self.numWorkers and self.executor is None:
+            # The node is multi-threaded by now, so don't fork it
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('forkserver')
+            else:
+                context = None
+            self.executor = ProcessPoolExecutor(self.numWorkers, mp_context=context)
+
+    def Stop(self):
+        executor, self.executor = self.executor, None
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def GetNumPending(self):
+        return len(self.pending)
+
+    def Admit(self, txs):
+        # Returns a blockchain.TX_* status per tx, once the batch is committed
+        with admitHistogram.Time():
+            return self._Admit(txs)
+
+    def AdmitOne(self, tx):
+        return self._Admit([tx])[0]
+
+    def _Admit(self, txs):
+        bc = self.blockchain
+        hashes = [tx.GetHash() for tx in txs]
+        statuses = bc.CheckTransactions(txs, hashes)
+
+        # Claim the txs to verify; another caller verifying the same tx makes
+        # this one a duplicate, and a full queue refuses the rest
+        claimed = []
+        with self.lock:
+            for i, txHash in enumerate(hashes):
+                if statuses[i] != blockchain.TX_OK:
+                    continue
+                if txHash in self.pending:
+                    statuses[i] = blockchain.TX_DUPLICATE
+                elif len(self.pending) >= self.maxPending:
+                    statuses[i] = blockchain.TX_BUSY
+                else:
+                    self.pending.add(txHash)
+                    claimed.append(i)
+            pendingGauge.Set(len(self.pending))
+
+        numBusy = statuses.count(blockchain.TX_BUSY)
+        if numBusy:
+            busyCounter.Inc(numBusy)
+
+        try:
+            for i, valid in zip(claimed, self._Verify([txs[i] for i in claimed])):
+                if not valid:
+                    statuses[i] = blockchain.TX_BAD_SIG
+            bc.CommitTransactions(txs, hashes, statuses)
+        finally:
+            with self.lock:
+                for i in claimed:
+                    self.pending.discard(hashes[i])
+                pendingGauge.Set(len(self.pending))
+
+        return statuses
+
+    def _Verify(self, txs):
+        executor = self.executor
+        if executor is None or not txs:
+            return [tx.ValidateSignature() for tx in txs]
+
+        items = [(tx.GetHash(), tx.signature, tx.fromAddr) for tx in txs]
+        chunkSize = max(1, min(VERIFY_CHUNK_SIZE, -(-len(items) // self.numWorkers)))
+        try:
+            futures = [executor.submit(VerifySignatures, items[i:i + chunkSize])
+                       for i in range(0, len(items), chunkSize)]
+            results = []
+            for f in futures:
+                results.extend(f.result())
+            return results
+        except (RuntimeError, CancelledError):
+            # Shutting down or a broken pool (BrokenProcessPool is a RuntimeError)
+            return [tx.ValidateSignature() for tx in txs]
@@ -0,0 +1,277 @@
+import block
+import blockchain
+import chaingen
+import log
+import server
+import transaction
+import utils
+
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+# Microbenchmarks over a synthetic chain. Results are written as JSON so that
+# runs from different commits can be compared with "bench.py compare".
+
+DEFAULT_REPEAT = 5
+DEFAULT_MEMPOOL_SIZE = 1000
+NUM_QUERIES = 200
+
+BENCHMARKS = []
+
+def Benchmark(fn):
+    BENCHMARKS.append(fn)
+    return fn
+
+
+class _FakeSock:
+    # Stands in for a client socket in server handlers
+    def __init__(self):
+        self.sent = []
+        self.bytesSent = 0
+
+    def Send(self, msgType, payload=b'', compress=False):
+        self.sent.append((msgType, payload))
+        self.bytesSent += len(payload)
+
+class _FakeController:
+    def __init__(self, bc):
+        self.blockchain = bc
+
+
+class Context:
+    def __init__(self, args):
+        self.args = args
+        startTime = time.perf_counter()
+        self.gen = chaingen.ChainGenerator(height=args.height,
+                                           txsPerBlock=args.txs,
+                                           numAddrs=args.addrs,
+                                           distribution=args.distribution,
+                                           difficulty=args.difficulty,
+                                           seed=args.seed)
+        self.blocks = self.gen.Generate()
+        self.bc = chaingen.BuildBlockchain(self.blocks, args.difficulty)
+        self.generateTime = time.perf_counter() - startTime
+
+        self.encodedBlocks = [block.EncodeBlock(b) for b in self.blocks]
+        self.txHashes = [tx.GetHash() for b in self.blocks for tx in b.transactions]
+        self.addrs = [self.gen.keys.GetAddr(i) for i in range(len(self.gen.keys))]
+
+
+def Measure(fn, repeat, setup=None):
+    times = []
+    for _ in range(repeat):
+        state = setup() if setup else None
+        startTime = time.perf_counter()
+        if setup:
+            fn(state)
+        else:
+            fn()
+        times.append(time.perf_counter() - startTime)
+    return times
+
+def _Result(times, ops):
+    best = min(times)
+    return {
+        'ops': ops,
+        'best': best,
+        'median': statistics.median(times),
+        'mean': statistics.mean(times),
+        'perOp': best / ops if ops else None,
+        'runs': len(times),
+    }
+
+
+@Benchmark
+def block_gethash(ctx, repeat):
+    def Run():
+        for b in ctx.blocks:
+            b.GetHash()
+    return _Result(Measure(Run, repeat), len(ctx.blocks))
+
+@Benchmark
+def encode_block(ctx, repeat):
+    def Run():
+        for b in ctx.blocks:
+            block.EncodeBlock(b)
+    return _Result(Measure(Run, repeat), len(ctx.blocks))
+
+@Benchmark
+def decode_block(ctx, repeat):
+    def Run():
+        for blBytes in ctx.encodedBlocks:
+            block.DecodeBlock(blBytes)
+    return _Result(Measure(Run, repeat), len(ctx.encodedBlocks))
+
+@Benchmark
+def add_block(ctx, repeat):
+    # Full validation of every block into an empty chain
+    def Setup():
+        return [block.DecodeBlock(blBytes) for blBytes in ctx.encodedBlocks]
+
+    def Run(blocks):
+        bc = blockchain.Blockchain(ctx.args.difficulty)
+        for b in blocks:
+            bc.AddBlock(b)
+    return _Result(Measure(Run, repeat, Setup), len(ctx.blocks))
+
+@Benchmark
+def add_blocks_assumed(ctx, repeat):
+    # Initial sync of the whole chain with the tip as the assumed-valid block
+    def Setup():
+        return [block.DecodeBlock(blBytes) for blBytes in ctx.encodedBlocks]
+
+    def Run(blocks):
+        bc = blockchain.Blockchain(ctx.args.difficulty, assumeValid=ctx.blocks[-1].GetHash())
+        bc.AddBlocks(blocks)
+    return _Result(Measure(Run, repeat, Setup), len(ctx.blocks))
+
+@Benchmark
+def get_balance(ctx, repeat):
+    rng = chaingen.random.Random(ctx.args.seed)
+    addrs = [rng.choice(ctx.addrs) for _ in range(NUM_QUERIES)]
+    def Run():
+        for addr in addrs:
+            ctx.bc.GetBalance(addr)
+    return _Result(Measure(Run, repeat), len(addrs))
+
+@Benchmark
+def is_tx_in_chain(ctx, repeat):
+    # Half present, half missing
+    rng = chaingen.random.Random(ctx.args.seed)
+    present = [rng.choice(ctx.txHashes) for _ in range(NUM_QUERIES // 2)]
+    missing = [utils.IntToBytes(i + 1, utils.HASH_BYTE_LEN) for i in range(NUM_QUERIES // 2)]
+    hashes = present + missing
+    def Run():
+        with ctx.bc.blockLock:
+            for txHash in hashes:
+                ctx.bc._IsTxInChain(txHash)
+    return _Result(Measure(Run, repeat), len(hashes))
+
+@Benchmark
+def mine_selection(ctx, repeat):
+    # Picks txs from a full mempool; difficulty 0 so that no time goes to PoW
+    numTxs = ctx.args.mempool
+    txs = ctx.gen.GenerateTxs(numTxs)
+
+    def Setup():
+        with ctx.bc.mempoolLock:
+            ctx.bc.mempool.clear()
+            for tx in txs:
+                ctx.bc.mempool[tx.GetHash()] = tx
+        return ctx.bc
+
+    minerIdx = 0
+    miner = ctx.gen.keys.GetAddr(minerIdx)
+    privateKey = ctx.gen.keys.GetPrivateKey(minerIdx)
+    def Run(bc):
+        bc.Mine(miner, privateKey)
+
+    difficulty = ctx.bc.difficulty
+    ctx.bc.SetDifficulty(0)
+    try:
+        times = Measure(Run, repeat, Setup)
+    finally:
+        ctx.bc.SetDifficulty(difficulty)
+        with ctx.bc.mempoolLock:
+            ctx.bc.mempool.clear()
+    return _Result(times, 1)
+
+@Benchmark
+def sync_blocks_message(ctx, repeat):
+    # Builds the Hashes response of server.Server._SyncBlocks
+    srv = server.Server(0, _FakeController(ctx.bc))
+    msg = utils.IntToBytes(0)
+    def Run():
+        sock = _FakeSock()
+        srv._SyncBlocks(sock, ('bench', 0), 'SyncBlocks', msg)
+    return _Result(Measure(Run, repeat), 1)
+
+
+def GetCommit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                             capture_output=True, text=True, check=True)
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def Run(args):
+    log.SetLevel(log.WARNING, 'blockchain')
+
+    print("Generating chain: height=%d txs=%d addrs=%d" % (args.height, args.txs, args.addrs),
+          file=sys.stderr)
+    ctx = Context(args)
+
+    results = {}
+    for fn in BENCHMARKS:
+        name = fn.__name__
+        if args.only and name not in args.only:
+            continue
+        results[name] = fn(ctx, args.repeat)
+        print("%-22s %12.6f s/op" % (name, results[name]['perOp']), file=sys.stderr)
+
+    return {
+        'meta': {
+            'commit': GetCommit(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'time': utils.GetCurrentTime(),
+            'height': args.height,
+            'txsPerBlock': args.txs,
+            'addrs': args.addrs,
+            'distribution': args.distribution,
+            'difficulty': args.difficulty,
+            'seed': args.seed,
+            'repeat': args.repeat,
+            'generateTime': ctx.generateTime,
+        },
+        'results': results,
+    }
+
+def Compare(basePath, newPath):
+    with open(basePath) as f:
+        base = json.load(f)
+    with open(newPath) as f:
+        new = json.load(f)
+
+    print("%-22s %14s %14s %8s" % ('benchmark', 'base s/op', 'new s/op', 'speedup'))
+    for name, r in sorted(new['results'].items()):
+        b = base['results'].get(name, None)
+        if not b or not b['perOp'] or not r['perOp']:
+            print("%-22s %14s %14.6g %8s" % (name, '-', r['perOp'] or 0, '-'))
+            continue
+        print("%-22s %14.6g %14.6g %7.2fx" % (name, b['perOp'], r['perOp'], b['perOp'] / r['perOp']))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'compare':
+        if len(sys.argv) != 4:
+            print("Usage: bench.py compare BASE.json NEW.json")
+            sys.exit(1)
+        Compare(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description='JoaoChain microbenchmarks')
+    parser.add_argument('--height', type=int, default=chaingen.DEFAULT_HEIGHT)
+    parser.add_argument('--txs', type=int, default=chaingen.DEFAULT_TXS_PER_BLOCK)
+    parser.add_argument('--addrs', type=int, default=chaingen.DEFAULT_NUM_ADDRS)
+    parser.add_argument('--distribution', choices=chaingen.DISTRIBUTIONS, default='uniform')
+    parser.add_argument('--difficulty', type=int, default=chaingen.DEFAULT_DIFFICULTY)
+    parser.add_argument('--seed', type=int, default=chaingen.DEFAULT_SEED)
+    parser.add_argument('--mempool', type=int, default=DEFAULT_MEMPOOL_SIZE)
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('--only', nargs='*', help='benchmarks to run')
+    parser.add_argument('--out', help='write JSON results to this file')
+    args = parser.parse_args()
+
+    out = json.dumps(Run(args), indent=2, sort_keys=True)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(out)
+    else:
+        print(out)
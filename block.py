@@ -2,6 +2,7 @@ import transaction
 
 import hashlib
 import utils
+import merkle
 
 class Block:
     def __init__(self, parent, transactions, timestamp, miner, nonce=0):
@@ -11,36 +12,85 @@ class Block:
         self.miner        = miner
         self.signature    = None
         #self.gas         = 0
-        self.transactions = transactions
+        self._transactions = transactions
+        self._store        = None # the blockstore.BlockStore holding the txs, once archived
 
         # Metadata
         self.height    = None
         self.timeAdded = None
         self.balances  = {}
+        self.target    = None # PoW target it was validated against
+        self.chainWork = 0    # work of the chain up to and including it
         self.byteSize  = 0
 
-    def Sign(self, privateKey):
-        self.signature = utils.SignData(self.GetHash(), privateKey)
+        # Caches; the txs, parent and timestamp don't change once the block
+        # is made, only the nonce does while mining
+        self._merkleLevels = None
+        self._header       = None
+        self._hash         = None
+        self._hashNonce    = None
+
+    @property
+    def transactions(self):
+        if self._store is not None:
+            return self._store.GetTransactions(self.GetHash())
+        return self._transactions
+
+    @transactions.setter
+    def transactions(self, transactions):
+        self._transactions = transactions
+        self._store        = None
+        self._merkleLevels = None
+        self._header       = None
+        self._hashNonce    = None
+
+    def Archive(self, store):
+        # Drop the txs and anything derived from them but the header, which
+        # the hash needs; store gives them back when asked
+        self.GetHeader()
+        self._store        = store
+        self._transactions = None
+        self._merkleLevels = None
+
+    def Sign(self, privateKey, deterministic=False):
+        self.signature = utils.SignData(self.GetHash(), privateKey, deterministic)
 
     def ValidateSignature(self):
         return utils.ValidateSignature(self.GetHash(),
                                        self.signature,
                                        self.miner)
 
-    def GetHash(self):
-        if self.parent is None:
-            parent = b''
-        else:
-            parent = self.parent
-
-        b = parent
-        b += utils.IntToBytes(len(self.transactions))
-        b += utils.IntToBytes(self.timestamp, 8)
-        b += utils.IntToBytes(self.nonce)
-        for tx in self.transactions:
-            b += tx.GetHash()
+    def GetMerkleLevels(self):
+        if self._merkleLevels is not None:
+            return self._merkleLevels
+        levels = merkle.GetLevels([tx.GetHash() for tx in self.transactions])
+        if self._store is None:
+            self._merkleLevels = levels
+        return levels
+
+    def GetMerkleRoot(self):
+        return self.GetMerkleLevels()[-1][0]
+
+    def GetTxProof(self, txPos):
+        return merkle.GetProof(self.GetMerkleLevels(), txPos)
+
+    def GetHeader(self):
+        h = self._header
+        if h is None or h.nonce != self.nonce:
+            if h is None:
+                h = Header(self.parent, self.GetMerkleRoot(), len(self.transactions),
+                           self.timestamp, self.nonce)
+            else:
+                h = Header(h.parent, h.merkleRoot, h.numTx, h.timestamp, self.nonce)
+            self._header = h
+        return h
 
-        return hashlib.sha256(b).digest()
+    def GetHash(self):
+        # The hash only covers the header, so its cost doesn't grow with the txs
+        if self._hashNonce != self.nonce:
+            self._hash = self.GetHeader().GetHash()
+            self._hashNonce = self.nonce
+        return self._hash
 
     def __repr__(self):
 
@@ -54,7 +104,7 @@ class Block:
             p,
             utils.Shorten(self.miner),
             self.timestamp,
-            len(self.transactions),
+            self.GetHeader().numTx,
             self.nonce)
 
     def __eq__(self, other):
@@ -62,6 +112,69 @@ class Block:
             return False
         return self.GetHash() == other.GetHash()
 
+class Header:
+    # What the block hash commits to; the txs are in through the Merkle root
+    __slots__ = ('parent', 'merkleRoot', 'numTx', 'timestamp', 'nonce')
+
+    def __init__(self, parent, merkleRoot, numTx, timestamp, nonce):
+        self.parent     = parent
+        self.merkleRoot = merkleRoot
+        self.numTx      = numTx
+        self.timestamp  = timestamp
+        self.nonce      = nonce
+
+    def GetHash(self):
+        b = self.parent if self.parent is not None else utils.ZeroHash()
+        b += self.merkleRoot
+        b += utils.IntToBytes(self.numTx)
+        b += utils.IntToBytes(self.timestamp, 8)
+        b += utils.IntToBytes(self.nonce)
+        return hashlib.sha256(b).digest()
+
+
+HEADER_LEN = (utils.HASH_BYTE_LEN + # parent
+              utils.HASH_BYTE_LEN + # merkleRoot
+              utils.INT_BYTE_LEN  + # numTx
+              utils.INT_BYTE_LEN  + # timestamp
+              utils.INT_BYTE_LEN    # nonce
+              )
+
+def EncodeHeader(h):
+    out = h.parent if h.parent is not None else utils.ZeroHash()
+    out += h.merkleRoot
+    out += utils.IntToBytes(h.numTx)
+    out += utils.IntToBytes(h.timestamp)
+    out += utils.IntToBytes(h.nonce)
+    return out
+
+def DecodeHeader(hBytes):
+    if len(hBytes) < HEADER_LEN:
+        raise ValueError("Invalid Header size: %d" % len(hBytes))
+
+    start = 0
+    end = utils.HASH_BYTE_LEN
+    parent = hBytes[start:end]
+    if parent == utils.ZeroHash():
+        parent = None
+
+    start = end
+    end += utils.HASH_BYTE_LEN
+    merkleRoot = hBytes[start:end]
+
+    start = end
+    end += utils.INT_BYTE_LEN
+    numTx = utils.BytesToInt(hBytes[start:end])
+
+    start = end
+    end += utils.INT_BYTE_LEN
+    timestamp = utils.BytesToInt(hBytes[start:end])
+
+    start = end
+    end += utils.INT_BYTE_LEN
+    nonce = utils.BytesToInt(hBytes[start:end])
+
+    return Header(parent, merkleRoot, numTx, timestamp, nonce)
+
 #todo: add test
 def EncodeBlock(bl):
     if bl.signature is None:
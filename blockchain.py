@@ -1,150 +1,383 @@
 import hashlib
+import math
 import time
 from collections import OrderedDict
 import random
 import threading
 
 import block
+import blockstore
 import transaction
 import utils
+import metrics
+import profiling
+import log
 
 MAX_TX_PER_BLOCK = 10
 
-doLog = True
-def Log(msg):
-    if doLog:
-        print(msg)
+# Proof of work: a block is valid if its hash, as a 256 bit integer, is at
+# most the target. Difficulty d is the target of d leading zero hex digits.
+MAX_TARGET = (1 << 256) - 1
+MAX_RETARGET_FACTOR = 4 # most a target can move in one retarget, either way
+MAX_NONCE = 1 << (utils.INT_BYTE_LEN * 8)
+
+# Timestamps: a block's must be above the median of its last MEDIAN_TIME_SPAN
+# ancestors' and at most MAX_FUTURE_BLOCK_TIME seconds ahead of our clock, so
+# that the retarget timespans can't be stretched by much
+MEDIAN_TIME_SPAN = 11
+MAX_FUTURE_BLOCK_TIME = 2 * 60
+
+def DifficultyToTarget(difficulty):
+    return (1 << (256 - 4 * difficulty)) - 1
+
+def TargetToDifficulty(target):
+    return (256 - math.log2(target + 1)) / 4
+
+def HashToInt(hash):
+    return int.from_bytes(hash, 'big')
+
+def GetWork(target):
+    # Expected number of hashes to meet target
+    return (1 << 256) // (target + 1)
+
+def GetMedianTime(timestamps):
+    # Median of the last MEDIAN_TIME_SPAN timestamps, None for none
+    recent = sorted(timestamps[-MEDIAN_TIME_SPAN:])
+    return recent[len(recent) // 2] if recent else None
+
+def ValidateTimestamp(timestamp, medianTime, now):
+    if medianTime is not None and timestamp <= medianTime:
+        return False
+    return timestamp <= now + MAX_FUTURE_BLOCK_TIME
+
+def Retarget(target, timespan, retargetInterval, targetBlockTime):
+    # timespan: seconds between the first and last block of the interval
+    expected = (retargetInterval - 1) * targetBlockTime
+    timespan = max(expected // MAX_RETARGET_FACTOR, min(timespan, expected * MAX_RETARGET_FACTOR))
+    timespan = max(timespan, 1)
+    return max(1, min(MAX_TARGET, target * timespan // expected))
+
+# Per-transaction results of AddTransactions
+TX_OK        = 0
+TX_DUPLICATE = 1 # already in the mempool or earlier in the batch
+TX_IN_CHAIN  = 2
+TX_BAD_SIG   = 3
+TX_MALFORMED = 4 # couldn't be decoded, set by the caller
+TX_BUSY      = 5 # not checked, the admission queue was full
+
+# Events passed to listeners added with AddListener
+EVENT_NEW_TX      = 'newTx'      # (tx)
+EVENT_BLOCK_ADDED = 'blockAdded' # (block)
+EVENT_NEW_TIP     = 'newTip'     # (block)
+EVENT_TX_EVICTED  = 'txEvicted'  # ([tx]) dropped from the mempool unmined
+
+blocksAddedCounter    = metrics.registry.Counter('blocks_added_total', 'Blocks connected to the tree')
+blocksRejectedCounter = metrics.registry.Counter('blocks_rejected_total', 'Invalid blocks by reason')
+addBlockHistogram     = metrics.registry.Histogram('add_block_seconds', 'AddBlock latency')
+txsAddedCounter       = metrics.registry.Counter('txs_added_total', 'Transactions added to the mempool')
+txsRejectedCounter    = metrics.registry.Counter('txs_rejected_total', 'Transactions rejected by reason')
+addTxHistogram        = metrics.registry.Histogram('add_tx_seconds', 'AddTransaction latency')
+addTxBatchHistogram   = metrics.registry.Histogram('add_tx_batch_seconds', 'AddTransactions latency')
+hashesCounter         = metrics.registry.Counter('mining_hashes_total', 'Nonces tried')
+hashrateGauge         = metrics.registry.Gauge('mining_hashrate', 'Hashes per second of the last mining round')
+blocksAssumedValidCounter = metrics.registry.Counter('blocks_assumed_valid_total', 'Blocks added without signature checks')
+blocksMinedCounter    = metrics.registry.Counter('blocks_mined_total', 'Blocks found by this node')
+
+logger = log.GetLogger('blockchain')
+
+
+class ChainSnapshot:
+    # Immutable view of the highest chain, the one with the most work,
+    # published after each new tip.
+    # bestChain may be shared with later snapshots, which only append past
+    # height; a reorg makes a new list rather than rewriting this one.
+    def __init__(self, tip=None, bestChain=(), height=0):
+        self.tip       = tip
+        self.bestChain = bestChain
+        self.height    = height
+
+    def GetTipHash(self):
+        return self.tip.GetHash() if self.tip else None
+
+    def Contains(self, b):
+        i = b.height - 1
+        return i < self.height and self.bestChain[i] == b.GetHash()
 
 
 class Blockchain:
-    def __init__(self, difficulty=1):
+    def __init__(self, difficulty=1, addrIndex=False, retargetInterval=None, targetBlockTime=None,
+                 assumeValid=None, storePath=None, blockCacheSize=blockstore.DEFAULT_CACHE_SIZE):
         self.mempool     = OrderedDict()
-        self.blocks      = {}
+        self.mempoolGeneration = 0 # bumped under mempoolLock on every change
+        self.blocks      = {} # hash -> Block, whose txs are in self.store once added
+
+        # Bodies of the added blocks, decoded on demand. Headers, heights and
+        # balances stay in self.blocks, so walking the chain doesn't load them.
+        self.store       = blockstore.BlockStore(storePath, blockCacheSize)
         self.difficulty  = difficulty
+        self.target      = DifficultyToTarget(difficulty)
+
+        # Without a retarget interval every block uses self.target. With one,
+        # the target moves every retargetInterval blocks so that blocks come
+        # targetBlockTime seconds apart.
+        self.retargetInterval = retargetInterval
+        self.targetBlockTime  = targetBlockTime
+
+        # Hash of a block known to be valid; see AddBlocks
+        self.assumeValid = assumeValid
         self.reward      = 10
         self.highest     = None
+        self.bestChain   = [] # block hashes of the highest chain, by height - 1
+        self.snapshot    = ChainSnapshot() # read without blockLock
+
+        # Optional addr -> [(blockHash, txPos)] for every block, including
+        # side branches. Reads keep only entries on the best chain, so a
+        # reorg needs no rewrite of the index.
+        self.addrIndex   = {} if addrIndex else None
 
-        self.mempoolLock = threading.Lock()
-        self.blockLock   = threading.Lock()
+        # txHash -> [blockHash] of every block it's in, to find txs in the
+        # highest chain without reading the bodies. Unlike the bodies, this
+        # and the blocks' balances aren't bounded: they grow with the chain.
+        self.txIndex     = {}
+
+        self.mempoolLock = profiling.TimedLock()
+        self.blockLock   = profiling.TimedLock()
 
         self._stopMining   = False
         self._miningHeight = None
 
+        self.listeners     = {} # event -> [callback]
+
+    def Close(self):
+        self.store.Close()
+
+    def AddListener(self, event, callback):
+        self.listeners.setdefault(event, []).append(callback)
+
+    def _Notify(self, event, *args):
+        # Always called with no lock held
+        for callback in self.listeners.get(event, ()):
+            callback(*args)
+
     def SetDifficulty(self, newDifficulty):
+        # Starting difficulty, or the fixed one without retargeting
         self.difficulty = newDifficulty
-
-    def AddBlock(self, b):
-        Log("Adding Block: %s" % b)
+        self.target = DifficultyToTarget(newDifficulty)
+
+    def GetNextTarget(self):
+        # Target of a block mined on the current tip
+        return self._GetTarget(self.snapshot.tip)
+
+    def GetMinTimestamp(self, parent):
+        # Earliest valid timestamp for a child of parent: now, or just after
+        # its median time if the clock is behind it
+        now = utils.GetCurrentTime()
+        medianTime = self._GetMedianTime(parent)
+        if medianTime is None:
+            return now
+        return max(now, medianTime + 1)
+
+    def AddBlock(self, b, skipSigs=False):
+        # skipSigs: only for blocks below the assumed-valid block, see AddBlocks
+        with addBlockHistogram.Time():
+            added = self._AddBlock(b, skipSigs)
+        if added:
+            blocksAddedCounter.Inc()
+        return added
+
+    def _AddBlock(self, b, skipSigs=False):
+        logger.Debug("Adding Block: %s", b)
         hash = b.GetHash()
 
         if hash in self.blocks:
-            Log("Block already added...")
+            logger.Debug("Block already added...")
             return
 
         with self.blockLock:
-            if not self._ValidateMiner(b):
-                Log("Invalid Miner Sig for %s" % b)
+            if not self._ValidateMiner(b, skipSigs):
+                logger.Warning("Invalid Miner Sig for %s", b)
+                blocksRejectedCounter.Inc(labels={'reason': 'miner'})
                 return False
 
             if not self._ValidateParent(b):
                 # TODO send to hanging blocks list?
-                Log("Invalid Parent for %s" % b)
+                logger.Warning("Invalid Parent for %s", b)
+                blocksRejectedCounter.Inc(labels={'reason': 'parent'})
+                return False
+
+            parent = self.blocks.get(b.parent, None)
+            if not ValidateTimestamp(b.timestamp, self._GetMedianTime(parent), utils.GetCurrentTime()):
+                logger.Warning("Invalid Timestamp for %s", b)
+                blocksRejectedCounter.Inc(labels={'reason': 'timestamp'})
                 return False
 
-            if not self._ValidatePow(b):
-                Log("Invalid POW for %s" % b)
+            target = self._GetTarget(parent)
+            if not self._ValidatePow(b, target):
+                logger.Warning("Invalid POW for %s", b)
+                blocksRejectedCounter.Inc(labels={'reason': 'pow'})
                 return False
 
-            if not self._ValidateTxSignatures(b):
-                Log("Invalid Tx Sigs for %s" % b)
+            if not skipSigs and not self._ValidateTxSignatures(b):
+                logger.Warning("Invalid Tx Sigs for %s", b)
+                blocksRejectedCounter.Inc(labels={'reason': 'txsig'})
                 return False
 
-            chain = self._GetChain(b.parent)
-            blockBalances = self._CalculateBalances(b, chain)
+            blockBalances = self._CalculateBalances(b, parent)
             if blockBalances is None:
-                Log("Invalid Balances for %s" % b)
+                logger.Warning("Invalid Balances for %s", b)
+                blocksRejectedCounter.Inc(labels={'reason': 'balance'})
                 return False
 
             # Get the parent height     
             self._RemoveTxsFromMemPool(b)
 
-            # Get the parent height   
-            parent = self.blocks.get(b.parent, None)
+            # Get the parent height and work
             if parent:
                 parentHeight = parent.height
+                parentWork   = parent.chainWork
             else:
                 parentHeight = 0
+                parentWork   = 0
+            chainWork = parentWork + GetWork(target)
 
-            # Update highest if this is indeed the highest
+            # Update highest if this chain has the most work; on a tie the
+            # first one seen stays
             highestBlock = self.blocks.get(self.highest, None)
-            if highestBlock is None or parentHeight == highestBlock.height:
+            isNewTip = highestBlock is None or chainWork > highestBlock.chainWork
+            if isNewTip:
                 self.highest = b.GetHash()
 
             # Set the metadata
             b.height    = parentHeight + 1
             b.timeAdded = utils.GetCurrentTime()
             b.balances  = blockBalances
+            b.target    = target
+            b.chainWork = chainWork
+
+            # Archive before publishing: readers take no lock, so the block
+            # must not change once it's in self.blocks or a snapshot
+            self.store.Put(b)
 
             # Add the block
             self.blocks[hash] = b
+            if isNewTip:
+                self._SetBestChain(b)
+                self.snapshot = ChainSnapshot(b, self.bestChain, b.height)
+            if self.addrIndex is not None:
+                self._IndexBlock(b)
+            self._IndexTxs(b)
 
             if self._miningHeight is not None and self._miningHeight <= b.height:
                 self.StopMining()
+
+        self._Notify(EVENT_BLOCK_ADDED, b)
+        if isNewTip:
+            self._Notify(EVENT_NEW_TIP, b)
         
         return True
 
     def AddBlocks(self, blocks):
-        for b in blocks:
-            self.AddBlock(b)
+        # Blocks up to the assumed-valid one skip their signature checks, if
+        # the batch is a chain that ends in it or passes through it. Its hash
+        # then commits to all of them, and they still get full PoW, linkage
+        # and balance checks.
+        numAssumed = self._GetNumAssumedValid(blocks)
+        if numAssumed:
+            blocksAssumedValidCounter.Inc(numAssumed)
+
+        for i, b in enumerate(blocks):
+            self.AddBlock(b, skipSigs=i < numAssumed)
+
+    def SetAssumeValid(self, blockHash):
+        self.assumeValid = blockHash
+
+    def _GetNumAssumedValid(self, blocks):
+        if self.assumeValid is None or self.assumeValid in self.blocks:
+            return 0
+
+        for i, b in enumerate(blocks):
+            if i > 0 and b.parent != blocks[i - 1].GetHash():
+                return 0
+            if b.GetHash() == self.assumeValid:
+                return i + 1
+        return 0
+
+    # Reads don't take blockLock: blocks are complete before they go into
+    # self.blocks and never change after, and the highest chain is read
+    # from the current snapshot
+
+    def GetSnapshot(self):
+        return self.snapshot
 
     def HasBlock(self, hash):
-        with self.blockLock:
-            return hash in self.blocks
+        return hash in self.blocks
 
     def GetBlock(self, hash):
-        with self.blockLock:
-            return self.blocks.get(hash, None)
+        return self.blocks.get(hash, None)
 
     def GetChain(self, hash=None):
-        with self.blockLock:
-            return self._GetChain(hash)
+        return self._GetChain(hash)
 
     def GetHighestChain(self):
-        with self.blockLock:
-            return self._GetChain(self.highest)
+        snapshot = self.snapshot
+        blocks = self.blocks
+        return [blocks[h] for h in reversed(snapshot.bestChain[:snapshot.height])]
 
     def GetHeight(self):
-        with self.blockLock:
-            highestBlock = self.blocks.get(self.highest, None)
-            if highestBlock is None:
-                return 0
-            
-            return highestBlock.height
+        return self.snapshot.height
 
     def GetHighestBlockHash(self):
-        with self.blockLock:
-            return self.highest
+        return self.snapshot.GetTipHash()
 
     def GetHighestBlock(self):
-        with self.blockLock:
-            return self.blocks.get(self.highest, None)
+        return self.snapshot.tip
 
     def GetBalance(self, addr):
-        with self.blockLock:
-            chain = self._GetChain(self.highest)
-            return self._GetBalanceInChain(addr, chain)
+        return self._GetBalanceInChain(addr, self.snapshot.tip)
             
+    def GetAddressHistory(self, addr, start=0, limit=100, maxHeight=None):
+        # Newest first: [(height, blockHash, txPos, tx)], skipping the first
+        # start entries, and any above maxHeight. None if the node doesn't
+        # keep the index.
+        if self.addrIndex is None:
+            return None
+
+        history = []
+        snapshot = self.snapshot
+        entries = self.addrIndex.get(addr, ())
+        skipped = 0
+        for blockHash, txPos in reversed(entries):
+            b = self.blocks[blockHash]
+            if not snapshot.Contains(b) or (maxHeight is not None and b.height > maxHeight):
+                continue
+            if skipped < start:
+                skipped += 1
+                continue
+            history.append((b.height, blockHash, txPos, b.transactions[txPos]))
+            if len(history) >= limit:
+                break
+        return history
+
     def Mine(self, miner, privateKey, maxNumTx=MAX_TX_PER_BLOCK):
         if not self.HasMemPool():
             return None
 
+        snapshot = self.snapshot
+
+        # Blocks found faster than a second apart push the timestamps ahead of
+        # the clock; wait for it rather than mine a block nobody would accept
+        timestamp = self.GetMinTimestamp(snapshot.tip)
+        if timestamp > utils.GetCurrentTime() + MAX_FUTURE_BLOCK_TIME:
+            logger.Debug("Timestamps too far ahead, not mining")
+            return None
+
         self._stopMining = False
-        self._miningHeight = self.GetHeight()
-        Log ("Mining...")
+        self._miningHeight = snapshot.height
+        logger.Debug("Mining...")
 
-        parentHash = self.highest
+        parentHash = snapshot.GetTipHash()
         if parentHash:
-            parentBalances = self.GetBlock(parentHash).balances
+            parentBalances = snapshot.tip.balances
         else:
             parentBalances = {}
 
@@ -163,15 +396,14 @@ class Blockchain:
                 # Stop if we ran out of mempool
                 if not self.mempool: break
 
-                # Get the first tx in the mempool and validate its sig
+                # Get the first tx in the mempool, its sig was checked on admission
                 tx = self.mempool.popitem(last=False)[1]
-                if not tx.ValidateSignature(): continue
 
                 # Calculate the balance of the from addr, minus the tx amout
                 fromBal = tmpBalances.get(tx.fromAddr,
                             parentBalances.get(tx.fromAddr, 0)) - tx.amount
                 if fromBal < 0:
-                    print("Rejected %s" % tx)
+                    logger.Debug("Rejected %s", tx)
                     # Reject tx and add to the end of the pool
                     rejected.append(tx)
                     continue
@@ -189,49 +421,114 @@ class Blockchain:
             # Add the rejected txs to the end of the mempool
             for rTx in rejected:
                 self.mempool[rTx.GetHash()] = rTx
+            self.mempoolGeneration += 1
 
-        # Create the Block
+        # Create the Block, after its ancestors' median time even if the
+        # clock says otherwise
         b = block.Block(parentHash,
                         transactions,
-                        utils.GetCurrentTime(),
+                        timestamp,
                         miner)
         
         # Mine it
-        while(not self._ValidatePow(b)):
-            if self._stopMining:
-                self._miningHeight = None
-                return None
-            b.nonce += random.randint(1, 100)
+        target = self._GetTarget(snapshot.tip)
+        b.nonce = random.randrange(MAX_NONCE)
+        numHashes = 1
+        startTime = time.perf_counter()
+        try:
+            while HashToInt(b.GetHash()) > target:
+                if self._stopMining:
+                    self._miningHeight = None
+                    return None
+                b.nonce = (b.nonce + 1) % MAX_NONCE
+                numHashes += 1
+        finally:
+            elapsed = time.perf_counter() - startTime
+            hashesCounter.Inc(numHashes)
+            if elapsed > 0:
+                hashrateGauge.Set(numHashes / elapsed)
         
         # Todo properly sign:
         b.Sign(privateKey)
+        blocksMinedCounter.Inc()
 
         self._miningHeight = None
         return b
 
     def StopMining(self):
-        Log("Aborting Mining!")
+        logger.Info("Aborting Mining!")
         self._stopMining = True
 
     def AddTransaction(self, tx):
-        txHash = tx.GetHash()
-
+        with addTxHistogram.Time():
+            status = self._AddTransactions([tx])[0]
+        return status in (TX_OK, TX_DUPLICATE)
+
+    def AddTransactions(self, txs):
+        # Batch version of AddTransaction: one chain scan and one pass under
+        # mempoolLock for the whole batch. Returns a TX_* status per tx.
+        with addTxBatchHistogram.Time():
+            return self._AddTransactions(txs)
+
+    def _AddTransactions(self, txs):
+        hashes = [tx.GetHash() for tx in txs]
+        statuses = self.CheckTransactions(txs, hashes)
+
+        # Signatures are the expensive part, so check them with no lock held
+        for i, tx in enumerate(txs):
+            if statuses[i] == TX_OK and not tx.ValidateSignature():
+                statuses[i] = TX_BAD_SIG
+
+        self.CommitTransactions(txs, hashes, statuses)
+        return statuses
+
+    def CheckTransactions(self, txs, hashes):
+        # Everything but the signatures, with no lock held: duplicates in the
+        # batch or the mempool, and txs already in the highest chain
+        statuses = [TX_OK] * len(txs)
+
+        seen = set()
+        for i, txHash in enumerate(hashes):
+            if txHash in seen or txHash in self.mempool:
+                statuses[i] = TX_DUPLICATE
+            seen.add(txHash)
+
+        chainTxs = self._GetChainTxHashes(seen)
+        for i, txHash in enumerate(hashes):
+            if statuses[i] == TX_OK and txHash in chainTxs:
+                statuses[i] = TX_IN_CHAIN
+        return statuses
+
+    def CommitTransactions(self, txs, hashes, statuses):
+        # Adds the txs still TX_OK, whose signatures must already be checked
+        added = []
+        now = utils.GetCurrentTime()
         with self.mempoolLock:
-            with self.blockLock:
-                if self._IsTxInChain(txHash):
-                    return False
-
-            if tx.ValidateSignature():
-                if tx.GetHash() not in self.mempool:
-                    self.mempool[txHash] = tx
-
-                    # Set the metadata
-                    tx.timeAdded = utils.GetCurrentTime()
-                    
-                return True
-            else:
-                Log("Tried to add invalid tx: %s" % tx)
-                return False
+            for i, tx in enumerate(txs):
+                if statuses[i] != TX_OK:
+                    continue
+                if hashes[i] in self.mempool:
+                    statuses[i] = TX_DUPLICATE
+                    continue
+                if tx.timeAdded is None: # kept when reloaded from a journal
+                    tx.timeAdded = now
+                self.mempool[hashes[i]] = tx
+                added.append(tx)
+            if added:
+                self.mempoolGeneration += 1
+
+        for tx, status in zip(txs, statuses):
+            if status == TX_IN_CHAIN:
+                txsRejectedCounter.Inc(labels={'reason': 'inchain'})
+            elif status == TX_BAD_SIG:
+                logger.Warning("Tried to add invalid tx: %s", tx)
+                txsRejectedCounter.Inc(labels={'reason': 'sig'})
+
+        if added:
+            txsAddedCounter.Inc(len(added))
+        for tx in added:
+            self._Notify(EVENT_NEW_TX, tx)
+        return added
 
     def HasMemPool(self):
         with self.mempoolLock:
@@ -242,20 +539,54 @@ class Blockchain:
             return self.mempool.values()
 
     def CleanMempool(self, timestamp):
-        for txHash, tx in self.mempool.items():
-            if tx.timeAdded < timestamp:
-                del self.mempool[txHash]
+        with self.mempoolLock:
+            evicted = [tx for tx in self.mempool.values() if tx.timeAdded < timestamp]
+            for tx in evicted:
+                del self.mempool[tx.GetHash()]
+            if evicted:
+                self.mempoolGeneration += 1
 
-    def _ValidateMiner(self, b):
-        return b.miner is not None and b.ValidateSignature()
+        if evicted:
+            self._Notify(EVENT_TX_EVICTED, evicted)
+        return evicted
 
-    def _ValidatePow(self, b):
+    def _ValidateMiner(self, b, skipSig=False):
+        return b.miner is not None and (skipSig or b.ValidateSignature())
+
+    def _ValidatePow(self, b, target=None):
         hash = b.GetHash()
         if hash is None:
             return False
 
-        prefix = '0' * self.difficulty   
-        return hash.hex().startswith(prefix)
+        if target is None:
+            target = self.target
+        return HashToInt(hash) <= target
+
+    def _GetTarget(self, parent):
+        # Target for a child of parent. It only changes at heights that are a
+        # multiple of the interval, scaled by how long the last interval took.
+        if not self.retargetInterval or parent is None:
+            return self.target
+        if parent.height % self.retargetInterval != 0:
+            return parent.target
+
+        first = parent
+        for _ in range(self.retargetInterval - 1):
+            first = self.blocks.get(first.parent, None)
+            if first is None:
+                return parent.target
+
+        return Retarget(parent.target, parent.timestamp - first.timestamp,
+                        self.retargetInterval, self.targetBlockTime)
+
+    def _GetMedianTime(self, parent):
+        # Median timestamp of parent and its ancestors, None for no parent
+        timestamps = []
+        b = parent
+        while b is not None and len(timestamps) < MEDIAN_TIME_SPAN:
+            timestamps.append(b.timestamp)
+            b = self.blocks.get(b.parent, None)
+        return GetMedianTime(timestamps)
 
     def _ValidateParent(self, b):
         if b.parent is None:
@@ -269,26 +600,26 @@ class Blockchain:
                 return False
         return True
 
-    def _CalculateBalances(self, b, chain):
+    def _CalculateBalances(self, b, parent):
         balances = {}
         for tx in b.transactions:
 
             if tx.fromAddr == tx.toAddr == b.miner:
-                Log("  -> Tx: %s REWARD" % tx)
+                logger.Debug("  -> Tx: %s REWARD", tx)
                 pass
             else:
                 fromBalance = balances.get(tx.fromAddr, None)
                 if fromBalance is None:
-                    fromBalance = self._GetBalanceInChain(tx.fromAddr, chain)
+                    fromBalance = self._GetBalanceInChain(tx.fromAddr, parent)
                 
                 fromBalance -= tx.amount
                 if fromBalance < 0:
-                    Log("  -> Tx: %s BAD" % tx)
+                    logger.Debug("  -> Tx: %s BAD", tx)
                     return None
-                Log("  -> Tx: %s OK" % tx)
+                logger.Debug("  -> Tx: %s OK", tx)
                 balances[tx.fromAddr] = fromBalance
 
-            toBalance = self._GetBalanceInChain(tx.toAddr, chain)
+            toBalance = self._GetBalanceInChain(tx.toAddr, parent)
             balances[tx.toAddr] = toBalance + tx.amount
         
         return balances
@@ -302,25 +633,73 @@ class Blockchain:
             hash = b.parent
         return chain
 
-    def _GetBalanceInChain(self, addr, chain):
-        for ancestor in chain:
-            balance = ancestor.balances.get(addr, None)
+    def _GetBalanceInChain(self, addr, b):
+        # addr's balance after block b: walks up only until an ancestor
+        # changed it, rather than listing the whole chain first
+        while b is not None:
+            balance = b.balances.get(addr, None)
             if balance is not None:
                 return balance
+            b = self.blocks.get(b.parent, None)
         return 0
 
     def _RemoveTxsFromMemPool(self, b):
-       for tx in b.transactions:
-           txHash = tx.GetHash()
-           if txHash in self.mempool:
-               self.mempool.pop(txHash)
+        with self.mempoolLock:
+            for tx in b.transactions:
+                txHash = tx.GetHash()
+                if txHash in self.mempool:
+                    self.mempool.pop(txHash)
+                    self.mempoolGeneration += 1
+
+    def _SetBestChain(self, tip):
+        # Replace the best chain from the fork point with tip's branch.
+        # Extending appends in place; a reorg copies, so that published
+        # snapshots keep seeing their own chain.
+        branch = []
+        b = tip
+        while b is not None and not self._IsInBestChain(b):
+            branch.append(b.GetHash())
+            b = self.blocks.get(b.parent, None)
+
+        forkHeight = b.height if b is not None else 0
+        if forkHeight == len(self.bestChain):
+            self.bestChain.extend(reversed(branch))
+        else:
+            self.bestChain = self.bestChain[:forkHeight] + branch[::-1]
+
+    def _IsInBestChain(self, b):
+        i = b.height - 1
+        return i < len(self.bestChain) and self.bestChain[i] == b.GetHash()
+
+    def _IndexBlock(self, b):
+        hash = b.GetHash()
+        for txPos, tx in enumerate(b.transactions):
+            self.addrIndex.setdefault(tx.fromAddr, []).append((hash, txPos))
+            if tx.toAddr != tx.fromAddr:
+                self.addrIndex.setdefault(tx.toAddr, []).append((hash, txPos))
+
+    def _IndexTxs(self, b):
+        hash = b.GetHash()
+        txIndex = self.txIndex
+        for tx in b.transactions:
+            txHash = tx.GetHash()
+            blockHashes = txIndex.get(txHash, None)
+            if blockHashes is None:
+                blockHashes = txIndex[txHash] = []
+            # A reward tx can be in every block its miner mines
+            blockHashes.append(hash)
+
+    def _GetChainTxHashes(self, txHashes):
+        # Which of txHashes are in the highest chain
+        snapshot = self.snapshot
+        found = set()
+        for txHash in txHashes:
+            for blockHash in self.txIndex.get(txHash, ()):
+                if snapshot.Contains(self.blocks[blockHash]):
+                    found.add(txHash)
+                    break
+        return found
 
     def _IsTxInChain(self, txHash):
-        # TODO cache tx hashes?
-        chain = self._GetChain(self.highest)
-        for b in chain:
-            for tx in b.transactions:
-                if txHash == tx.GetHash():
-                    return True
-        return False
+        return bool(self._GetChainTxHashes((txHash,)))
 
@@ -0,0 +1,112 @@
+import transaction
+import merkle
+import metrics
+
+import fcntl
+import os
+import threading
+from collections import OrderedDict
+
+# Cold tier for block bodies. Blocks stay in Blockchain.blocks with their
+# header fields and metadata, but their transactions are kept here encoded,
+# in a file or in memory, and decoded on demand into an LRU cache of the
+# most recently used bodies. Bodies read back from the cold tier are checked
+# against the block's Merkle root.
+
+DEFAULT_CACHE_SIZE = 256 # decoded block bodies kept resident
+
+cacheHitsCounter   = metrics.registry.Counter('block_cache_hits_total', 'Block bodies served from the cache')
+cacheMissesCounter = metrics.registry.Counter('block_cache_misses_total', 'Block bodies decoded from the cold tier')
+coldBytesGauge     = metrics.registry.Gauge('block_store_bytes', 'Encoded block bodies in the cold tier')
+
+
+class BlockStore:
+    def __init__(self, path=None, cacheSize=DEFAULT_CACHE_SIZE):
+        self.path      = path # None keeps the encoded bodies in memory
+        self.cacheSize = cacheSize
+        self.cache     = OrderedDict() # block hash -> [tx], oldest first
+        self.bodies    = {} # block hash -> ((offset, numTx) in the file, or the encoded body, merkle root)
+        self.size      = 0
+        self.fd        = None
+        self.lock      = threading.Lock()
+
+        if path:
+            # The chain is synced again on start, so the file is scratch space,
+            # but only for one node at a time
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                raise RuntimeError("Block store in use by another node: %s" % path)
+            os.ftruncate(fd, 0)
+            self.fd = fd
+
+    def Close(self):
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+    def Has(self, hash):
+        return hash in self.bodies
+
+    def Put(self, b):
+        # Moves b's transactions here; b.transactions reads them back
+        hash = b.GetHash()
+        txs = b.transactions
+        body = b''.join(transaction.EncodeTx(tx) for tx in txs)
+
+        with self.lock:
+            if hash not in self.bodies:
+                merkleRoot = b.GetMerkleRoot()
+                if self.fd is not None:
+                    os.pwrite(self.fd, body, self.size)
+                    self.bodies[hash] = ((self.size, len(txs)), merkleRoot)
+                else:
+                    self.bodies[hash] = (body, merkleRoot)
+                self.size += len(body)
+                coldBytesGauge.Set(self.size)
+            self._Cache(hash, txs)
+
+        b.Archive(self)
+
+    def GetTransactions(self, hash):
+        with self.lock:
+            txs = self.cache.get(hash, None)
+            if txs is not None:
+                self.cache.move_to_end(hash)
+                cacheHitsCounter.Inc()
+                return txs
+            entry = self.bodies.get(hash, None)
+            fd = self.fd
+
+        if entry is None:
+            return None
+
+        location, merkleRoot = entry
+        if isinstance(location, tuple):
+            if fd is None:
+                raise ValueError("Block store closed: %s" % self.path)
+            offset, numTx = location
+            body = os.pread(fd, numTx * transaction.MSG_LEN, offset)
+        else:
+            body = location
+        try:
+            txs = [transaction.DecodeTx(body[i:i + transaction.MSG_LEN])
+                   for i in range(0, len(body), transaction.MSG_LEN)]
+        except ValueError:
+            txs = None
+        if txs is None or merkle.GetRoot([tx.GetHash() for tx in txs]) != merkleRoot:
+            raise ValueError("Corrupt block body in %s: %s" % (self.path, hash.hex()))
+        cacheMissesCounter.Inc()
+
+        with self.lock:
+            self._Cache(hash, txs)
+        return txs
+
+    def _Cache(self, hash, txs):
+        self.cache[hash] = txs
+        self.cache.move_to_end(hash)
+        while len(self.cache) > self.cacheSize:
+            self.cache.popitem(last=False)
@@ -0,0 +1,163 @@
+import block
+import blockchain
+import log
+import transaction
+import utils
+
+import random
+import sys
+
+# Synthetic chains for benchmarks and simulations. Everything derives from the
+# seed, so the same parameters always produce the same blocks and hashes.
+
+DEFAULT_HEIGHT = 100
+DEFAULT_TXS_PER_BLOCK = blockchain.MAX_TX_PER_BLOCK
+DEFAULT_NUM_ADDRS = 100
+DEFAULT_NUM_MINERS = 4
+DEFAULT_DIFFICULTY = 1
+DEFAULT_SEED = 1
+GENESIS_TIME = 1600000000
+BLOCK_INTERVAL = 10
+ZIPF_EXPONENT = 1.2
+
+DISTRIBUTIONS = ('uniform', 'zipf')
+
+class KeyPool:
+    def __init__(self, numKeys, seed=DEFAULT_SEED):
+        # Secrets are derived from the seed, not random
+        self.keys = [utils.GenerateKeysFromSecret(seed * 1000003 + i + 1)
+                     for i in range(numKeys)]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def GetPrivateKey(self, i):
+        return self.keys[i][0]
+
+    def GetAddr(self, i):
+        return self.keys[i][1]
+
+
+class ChainGenerator:
+    def __init__(self, height=DEFAULT_HEIGHT, txsPerBlock=DEFAULT_TXS_PER_BLOCK,
+                 numAddrs=DEFAULT_NUM_ADDRS, numMiners=DEFAULT_NUM_MINERS,
+                 distribution='uniform', difficulty=DEFAULT_DIFFICULTY,
+                 seed=DEFAULT_SEED, reward=10):
+        if distribution not in DISTRIBUTIONS:
+            raise ValueError("Unknown distribution: %s" % distribution)
+
+        self.height       = height
+        self.txsPerBlock  = txsPerBlock
+        self.numMiners    = max(1, min(numMiners, numAddrs))
+        self.distribution = distribution
+        self.difficulty   = difficulty
+        self.seed         = seed
+        self.reward       = reward
+        self.rng          = random.Random(seed)
+        self.keys         = KeyPool(numAddrs, seed)
+        self.validator    = blockchain.Blockchain(difficulty)
+        self.balances     = {}
+        self.nonce        = 0
+
+        # Address weights for picking senders and receivers
+        if distribution == 'zipf':
+            self.weights = [1.0 / (i + 1) ** ZIPF_EXPONENT for i in range(numAddrs)]
+        else:
+            self.weights = [1.0] * numAddrs
+
+    def Generate(self):
+        blocks = []
+        parent = None
+        for i in range(self.height):
+            b = self.GenerateBlock(parent, GENESIS_TIME + i * BLOCK_INTERVAL)
+            blocks.append(b)
+            parent = b.GetHash()
+        return blocks
+
+    def GenerateBlock(self, parent, timestamp):
+        minerIdx = self.rng.randrange(self.numMiners)
+        miner = self.keys.GetAddr(minerIdx)
+
+        rewardTx = self._MakeTx(minerIdx, minerIdx, self.reward)
+        transactions = [rewardTx]
+        self.balances[minerIdx] = self.balances.get(minerIdx, 0) + self.reward
+
+        # Each address appears at most once per block, so that the chain stays
+        # valid no matter how balances are applied within a block
+        used = set([minerIdx])
+        for tx in self.GenerateTxs(self.txsPerBlock, used):
+            transactions.append(tx)
+
+        b = block.Block(parent, transactions, timestamp, miner)
+        self._MineBlock(b)
+        b.Sign(self.keys.GetPrivateKey(minerIdx), deterministic=True)
+        return b
+
+    def GenerateTxs(self, numTxs, used=None):
+        if used is None:
+            used = set()
+
+        txs = []
+        attempts = 0
+        numAddrs = len(self.keys)
+        while len(txs) < numTxs and attempts < numTxs * 10:
+            attempts += 1
+            fromIdx, toIdx = self.rng.choices(range(numAddrs), self.weights, k=2)
+            if fromIdx == toIdx or fromIdx in used or toIdx in used:
+                continue
+
+            fromBal = self.balances.get(fromIdx, 0)
+            amount = self.rng.randint(0, fromBal) if fromBal else 0
+
+            txs.append(self._MakeTx(fromIdx, toIdx, amount))
+            self.balances[fromIdx] = fromBal - amount
+            self.balances[toIdx] = self.balances.get(toIdx, 0) + amount
+            used.add(fromIdx)
+            used.add(toIdx)
+        return txs
+
+    def _MakeTx(self, fromIdx, toIdx, amount):
+        self.nonce += 1
+        tx = transaction.Transaction(self.keys.GetAddr(fromIdx),
+                                     self.keys.GetAddr(toIdx),
+                                     amount,
+                                     self.nonce)
+        tx.Sign(self.keys.GetPrivateKey(fromIdx), deterministic=True)
+        return tx
+
+    def _MineBlock(self, b):
+        while not self.validator._ValidatePow(b):
+            b.nonce += 1
+
+def BuildBlockchain(blocks, difficulty=DEFAULT_DIFFICULTY):
+    bc = blockchain.Blockchain(difficulty)
+    for b in blocks:
+        if not bc.AddBlock(b):
+            raise RuntimeError("Generated block rejected: %s" % b)
+    return bc
+
+def GenerateBlockchain(**kwargs):
+    gen = ChainGenerator(**kwargs)
+    blocks = gen.Generate()
+    return BuildBlockchain(blocks, gen.difficulty), blocks, gen
+
+
+def Usage():
+    print("Usage: chaingen.py HEIGHT [TXS_PER_BLOCK NUM_ADDRS DISTRIBUTION SEED]")
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        Usage()
+        sys.exit(1)
+
+    log.SetLevel(log.WARNING, 'blockchain')
+    height = int(sys.argv[1])
+    txsPerBlock = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_TXS_PER_BLOCK
+    numAddrs = int(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_NUM_ADDRS
+    distribution = sys.argv[4] if len(sys.argv) > 4 else 'uniform'
+    seed = int(sys.argv[5]) if len(sys.argv) > 5 else DEFAULT_SEED
+
+    bc, blocks, gen = GenerateBlockchain(height=height, txsPerBlock=txsPerBlock,
+                                         numAddrs=numAddrs, distribution=distribution,
+                                         seed=seed)
+    print("Generated %d blocks, tip %s" % (bc.GetHeight(), bc.GetHighestBlock()))
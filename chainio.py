@@ -0,0 +1,256 @@
+import admission
+import block
+import blockchain
+import blockstore
+import client
+import compression
+import log
+import params
+import server
+import utils
+
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# Chain files: MAGIC, the chain's difficulty, retarget interval and target
+# block time (0 for none), then each block of the best chain from the genesis
+# up as its length and block.EncodeBlock bytes. Importing reads them in
+# batches, checks the batch's signatures in a process pool while the next
+# batch is read, and adds the blocks with every other check but the signatures.
+
+MAGIC = b'JCHAIN2\n'
+HEADER_LEN = 3 * utils.INT_BYTE_LEN
+IMPORT_BATCH_SIZE = 256  # blocks read and verified together
+VERIFY_CHUNK_SIZE = 512  # signatures per job sent to a worker
+EXPORT_BATCH_SIZE = server.MAX_BLOCKS_PER_MSG # blocks per GetBlocks when exporting from a node
+
+logger = log.GetLogger('chainio')
+
+def WriteChain(path, encodedBlocks, difficulty, retargetInterval=None, targetBlockTime=None):
+    # encodedBlocks: iterable of EncodeBlock bytes, from the genesis up
+    tmpPath = path + '.tmp'
+    numBlocks = 0
+    with open(tmpPath, 'wb') as f:
+        f.write(MAGIC)
+        f.write(utils.IntToBytes(difficulty))
+        f.write(utils.IntToBytes(retargetInterval or 0))
+        f.write(utils.IntToBytes(targetBlockTime or 0))
+        for blBytes in encodedBlocks:
+            f.write(utils.IntToBytes(len(blBytes)))
+            f.write(blBytes)
+            numBlocks += 1
+    os.replace(tmpPath, path)
+    return numBlocks
+
+def ExportChain(bc, path):
+    snapshot = bc.GetSnapshot()
+    return WriteChain(path, (block.EncodeBlock(bc.GetBlock(h))
+                             for h in snapshot.bestChain[:snapshot.height]),
+                      bc.difficulty, bc.retargetInterval, bc.targetBlockTime)
+
+def _ReadHeader(f, path):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a chain file: %s" % path)
+    header = f.read(HEADER_LEN)
+    if len(header) < HEADER_LEN:
+        raise ValueError("Truncated chain file: %s" % path)
+    return tuple(utils.BytesToInt(header[i:i + utils.INT_BYTE_LEN]) or None
+                 for i in range(0, HEADER_LEN, utils.INT_BYTE_LEN))
+
+def ReadParams(path):
+    # (difficulty, retargetInterval, targetBlockTime) the chain was made with
+    with open(path, 'rb') as f:
+        return _ReadHeader(f, path)
+
+def NewBlockchain(path, addrIndex=False, assumeValid=None, storePath=None,
+                  blockCacheSize=blockstore.DEFAULT_CACHE_SIZE):
+    # An empty chain with the parameters of the chain file, to import it into
+    difficulty, retargetInterval, targetBlockTime = ReadParams(path)
+    return blockchain.Blockchain(difficulty, addrIndex, retargetInterval, targetBlockTime,
+                                 assumeValid, storePath, blockCacheSize)
+
+def ReadChain(path):
+    # Yields the encoded blocks one at a time
+    with open(path, 'rb') as f:
+        _ReadHeader(f, path)
+        while True:
+            sizeBytes = f.read(utils.INT_BYTE_LEN)
+            if not sizeBytes:
+                return
+            size = utils.BytesToInt(sizeBytes)
+            blBytes = f.read(size)
+            if len(sizeBytes) < utils.INT_BYTE_LEN or len(blBytes) < size:
+                raise ValueError("Truncated chain file: %s" % path)
+            yield blBytes
+
+def _ReadBatch(blocks, batchSize, path):
+    # Returns the blocks read and the ValueError that ended the file early, if
+    # any. The blocks before a bad record are still returned.
+    batch = []
+    try:
+        for blBytes in blocks:
+            try:
+                b = block.DecodeBlock(blBytes)
+            except ValueError:
+                b = None
+            if b is None or b.byteSize != len(blBytes):
+                raise ValueError("Corrupt block in chain file: %s" % path)
+            batch.append(b)
+            if len(batch) >= batchSize:
+                break
+    except ValueError as e:
+        return batch, e
+    return batch, None
+
+def _GetSignatureItems(batch):
+    # One (hash, signature, key) for each miner and tx signature
+    items = []
+    for b in batch:
+        items.append((b.GetHash(), b.signature, b.miner))
+        for tx in b.transactions:
+            items.append((tx.GetHash(), tx.signature, tx.fromAddr))
+    return items
+
+def _Submit(executor, items):
+    if executor is None:
+        return items
+    return [executor.submit(admission.VerifySignatures, items[i:i + VERIFY_CHUNK_SIZE])
+            for i in range(0, len(items), VERIFY_CHUNK_SIZE)]
+
+def _Results(executor, jobs):
+    if executor is None:
+        return admission.VerifySignatures(jobs)
+    results = []
+    for f in jobs:
+        results.extend(f.result())
+    return results
+
+def ImportChain(bc, path, numWorkers=admission.DEFAULT_NUM_WORKERS, batchSize=IMPORT_BATCH_SIZE):
+    # Adds the chain in path to bc. Returns the number of blocks added; stops
+    # at the first record that is corrupt, or block that is invalid or doesn't
+    # fit on the chain.
+    executor = None
+    if numWorkers:
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('forkserver')
+        else:
+            context = None
+        executor = ProcessPoolExecutor(numWorkers, mp_context=context)
+
+    startTime = time.perf_counter()
+    numAdded = 0
+    numTxs = 0
+    try:
+        blocks = ReadChain(path)
+        batch, error = _ReadBatch(blocks, batchSize, path)
+        jobs = _Submit(executor, _GetSignatureItems(batch))
+        while batch:
+            # Read and start verifying the next batch before applying this one.
+            # A bad record ends the reading, not this batch.
+            nextBatch, nextError = [], error
+            if error is None:
+                nextBatch, nextError = _ReadBatch(blocks, batchSize, path)
+            nextJobs = _Submit(executor, _GetSignatureItems(nextBatch))
+
+            valid = iter(_Results(executor, jobs))
+            for b in batch:
+                blockValid = next(valid)
+                for _ in b.transactions:
+                    blockValid = next(valid) and blockValid
+                if not blockValid:
+                    logger.Warning("Invalid signature in %s, stopping the import", b)
+                    return numAdded
+                if not bc.HasBlock(b.GetHash()):
+                    blockTxs = len(b.transactions)
+                    if not bc.AddBlock(b, skipSigs=True):
+                        logger.Warning("Could not add %s, stopping the import", b)
+                        return numAdded
+                    numAdded += 1
+                    numTxs += blockTxs
+
+            batch, jobs, error = nextBatch, nextJobs, nextError
+            logger.Info("Imported %d blocks", numAdded)
+
+        if error is not None:
+            logger.Warning("%s, stopping the import", error)
+    finally:
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+        elapsed = time.perf_counter() - startTime
+        logger.Info("Imported %d blocks, %d txs in %.2f s", numAdded, numTxs, elapsed)
+
+    return numAdded
+
+
+class ChainExporter:
+    # Downloads a node's best chain over the peer protocol
+    def __init__(self, hostname, port, bindAddr=None):
+        self.hostname = hostname
+        self.port     = port
+
+        # Used by client.Client
+        self.bindAddr = bindAddr
+        self.codecs   = compression.SUPPORTED_CODECS
+        self.server   = None
+
+    def GetVersion(self):
+        return params.VERSION
+
+    def _GetEncodedBlocks(self, peer, blockHashes):
+        for i in range(0, len(blockHashes), EXPORT_BATCH_SIZE):
+            blocks = peer.GetBlocks(blockHashes[i:i + EXPORT_BATCH_SIZE])
+            if not blocks:
+                raise ConnectionError("Could not get blocks from %s:%d" % (self.hostname, self.port))
+            for b in blocks:
+                yield block.EncodeBlock(b)
+
+    def Export(self, path):
+        peer = client.Client(self.hostname, self.port, self)
+        if not peer.Connect() or peer.Version() != self.GetVersion():
+            raise ConnectionError("Could not connect to %s:%d" % (self.hostname, self.port))
+        try:
+            _, blockHashes = peer.SyncBlocks(0)
+            # Chain parameters aren't on the wire: nodes run with params'
+            return WriteChain(path, self._GetEncodedBlocks(peer, blockHashes or []),
+                              params.DIFFICULTY, params.RETARGET_INTERVAL, params.TARGET_BLOCK_TIME)
+        finally:
+            peer.Close()
+
+
+def Usage():
+    print("USAGE: chainio.py export HOSTNAME PORT FILE")
+    print("     | chainio.py import FILE")
+    print("     | chainio.py generate FILE HEIGHT [TXS_PER_BLOCK]")
+
+if __name__ == '__main__':
+    numArgs = len(sys.argv)
+    if numArgs < 3:
+        Usage()
+        sys.exit(1)
+
+    command = sys.argv[1]
+    if command == 'export' and numArgs > 4:
+        numBlocks = ChainExporter(sys.argv[2], int(sys.argv[3])).Export(sys.argv[4])
+        print("Exported %d blocks to %s" % (numBlocks, sys.argv[4]))
+
+    elif command == 'import':
+        # Checks a chain file; controller.py import starts a node from one
+        bc = NewBlockchain(sys.argv[2])
+        ImportChain(bc, sys.argv[2])
+        print("Height: %d, tip: %s" % (bc.GetHeight(), bc.GetHighestBlock()))
+
+    elif command == 'generate' and numArgs > 3:
+        import chaingen
+        log.SetLevel(log.WARNING, 'blockchain')
+        txsPerBlock = int(sys.argv[4]) if numArgs > 4 else chaingen.DEFAULT_TXS_PER_BLOCK
+        gen = chaingen.ChainGenerator(height=int(sys.argv[3]), txsPerBlock=txsPerBlock)
+        numBlocks = WriteChain(sys.argv[2], (block.EncodeBlock(b) for b in gen.Generate()),
+                               gen.difficulty)
+        print("Generated %d blocks at difficulty %d in %s" % (numBlocks, gen.difficulty, sys.argv[2]))
+
+    else:
+        Usage()
+        sys.exit(1)
@@ -3,32 +3,152 @@ import transaction
 
 import utils
 import network
+import compression
+import merkle
+
+import threading
+import time
+
+# Peer scoring
+STATS_ALPHA = 0.2                  # weight of the newest sample in the moving averages
+MIN_THROUGHPUT_BYTES = 16 * 1024   # smaller responses only measure latency
+REFERENCE_TRANSFER_BYTES = 1024 * 1024
+MIN_SAMPLES_TO_EVICT = 10
+MAX_RTT = 2.0
+MAX_ERROR_RATE = 0.5
+
+# Busy replies from a throttled peer
+BUSY_RETRIES = 3
+BUSY_BACKOFF = 0.5 # seconds, doubled on every retry
+
+class PeerStats:
+    def __init__(self):
+        self.rtt         = None # seconds
+        self.throughput  = None # bytes/sec
+        self.errorRate   = 0.0
+        self.numRequests = 0
+        self.height      = 0    # last height advertised by the peer
+        self.lock        = threading.Lock()
+
+    def __repr__(self):
+        return 'PeerStats{rtt:%s, bps:%s, err:%.2f, n:%d, h:%d}' % (
+            '%.3f' % self.rtt if self.rtt is not None else '-',
+            '%d' % self.throughput if self.throughput is not None else '-',
+            self.errorRate,
+            self.numRequests,
+            self.height)
+
+    def AddRequest(self, seconds, numBytes, success):
+        with self.lock:
+            self.numRequests += 1
+            self.errorRate = _Ewma(self.errorRate, 0.0 if success else 1.0)
+            if not success:
+                return
+
+            self.rtt = _Ewma(self.rtt, seconds)
+            if numBytes >= MIN_THROUGHPUT_BYTES and seconds > 0:
+                self.throughput = _Ewma(self.throughput, numBytes / seconds)
+
+    def AddError(self):
+        with self.lock:
+            self.numRequests += 1
+            self.errorRate = _Ewma(self.errorRate, 1.0)
+
+    def SetHeight(self, height):
+        self.height = height
+
+    def IsMeasured(self):
+        return self.numRequests > 0
+
+    def GetScore(self):
+        # Expected cost of a typical request, penalised by how often it fails
+        rtt = self.rtt if self.rtt is not None else MAX_RTT
+        cost = rtt
+        if self.throughput:
+            cost += REFERENCE_TRANSFER_BYTES / self.throughput
+        return (1.0 - self.errorRate) ** 2 / max(cost, 0.001)
+
+    def IsChronicallySlow(self):
+        if self.numRequests < MIN_SAMPLES_TO_EVICT:
+            return False
+        return (self.errorRate > MAX_ERROR_RATE or
+                (self.rtt is not None and self.rtt > MAX_RTT))
+
+def _Ewma(average, sample):
+    if average is None:
+        return sample
+    return average + STATS_ALPHA * (sample - average)
+
 
 class Client(network.Client):
     def __init__(self, hostname, port, controller):
-        super().__init__(hostname, port)
+        super().__init__(hostname, port, controller.bindAddr)
         self.failedAttempts = 0
         self.controller = controller
+        self.stats = PeerStats()
+
+        # Keeps request/response pairs from different threads apart
+        self.requestLock = threading.Lock()
 
     def Connect(self):
+        # Reset by the caller once the handshake succeeds, not here: a peer
+        # that accepts connections but fails Version is still failing
         success = super().Connect()
         if not success:
             self.failedAttempts += 1
-        else:
-            self.failedAttempts = 0
         return success
 
+    def _Request(self, msgType, payload=b'', compress=False):
+        # A Busy peer is throttling us, not failing: back off and retry, and
+        # leave it out of the peer's stats
+        backoff = BUSY_BACKOFF
+        for retry in range(BUSY_RETRIES + 1):
+            if retry:
+                time.sleep(backoff)
+                backoff *= 2
+
+            with self.requestLock:
+                startTime = time.monotonic()
+                if not self.Send(msgType, payload, compress):
+                    self.stats.AddError()
+                    return None, None
+
+                respType, resp = self.Receive()
+                elapsed = time.monotonic() - startTime
+
+            if respType != 'Busy':
+                numBytes = len(resp) if resp else 0
+                self.stats.AddRequest(elapsed, numBytes, respType is not None)
+                return respType, resp
+
+        return None, None
+
     ### Message Methods ###
 
     def Version(self):
         version = self.controller.GetVersion()
-        if not self.Send('Version', utils.IntToBytes(version)):
-            return None
-        msgType, msg = self.Receive()
-        if  msgType == 'VersionOK':
-            return utils.BytesToInt(msg)
+        outMsg = utils.IntToBytes(version)
+        msgType, msg = self._Request('Version', outMsg)
+        if  msgType == 'VersionOK' and msg:
+            peerVersion = utils.BytesToInt(msg)
+            if peerVersion >= compression.CODECS_VERSION and self.controller.codecs:
+                self.Codecs()
+            return peerVersion
         return None
 
+    def Codecs(self):
+        # Offers our codecs; the peer answers with the one it picked
+        outMsg = utils.IntToBytes(compression.GetCodecMask(self.controller.codecs),
+                                  network.CODEC_BYTE_LEN)
+        msgType, msg = self._Request('Codecs', outMsg)
+        if msgType == 'CodecsOK' and len(msg) == network.CODEC_BYTE_LEN:
+            codec = msg[0]
+            sock = self.sock
+            if sock is not None and codec in self.controller.codecs:
+                sock.codec = codec
+                return codec
+        return compression.CODEC_NONE
+
     def GetAddrs(self):
         addrs = []
 
@@ -37,10 +157,7 @@ class Client(network.Client):
         else:
             outMsg = b''
 
-        if not self.Send('GetAddrs', outMsg):
-            return addrs
-        
-        msgType, msg = self.Receive()
+        msgType, msg = self._Request('GetAddrs', outMsg)
         if msgType == 'Addrs' and msg:
             addrsStr = msg.decode().split(';')
             for addrStr in addrsStr:
@@ -53,10 +170,7 @@ class Client(network.Client):
     def GetMempool(self):
         mempool = []
         
-        if not self.Send('GetMempool'):
-            return []
-
-        msgType, msg = self.Receive()
+        msgType, msg = self._Request('GetMempool')
         if msgType == 'Mempool' and msg and len(msg) >= utils.INT_BYTE_LEN:
             start = 0
             end = utils.INT_BYTE_LEN
@@ -78,18 +192,20 @@ class Client(network.Client):
         if not blBytes:
             return False
 
-        if not self.Send('AddBlock', blBytes):
+        if not self.Send('AddBlock', blBytes, compress=True):
             return False
 
         return True
 
-    def SyncBlocks(self, height):
-        # Send msg
-        if not self.Send('SyncBlocks', utils.IntToBytes(height)):
-            return 0, None
+    def QueueAddBlock(self, blBytes):
+        # Encoded once by the caller and shared by all peers
+        return self.Queue('AddBlock', blBytes,
+                          priority=network.PRIORITY_BLOCK,
+                          compress=True)
 
-        # Receive response
-        msgType, msg = self.Receive()
+    def SyncBlocks(self, height):
+        # Send msg and receive response
+        msgType, msg = self._Request('SyncBlocks', utils.IntToBytes(height))
         if msg:
             msgLen = len(msg)
         else:
@@ -103,6 +219,7 @@ class Client(network.Client):
         if msgLen < end:
             return 0, None
         peerHeight = utils.BytesToInt(msg[start:end])
+        self.stats.SetHeight(peerHeight)
         if peerHeight <= height:
             return 0, None
 
@@ -131,13 +248,9 @@ class Client(network.Client):
         for blockHash in blockHashes:
             outMsg += blockHash
         
-        if not self.Send('GetBlocks', outMsg):
-            return None
-
         # Receive response
-        msgType, msg = self.Receive()
-        msgLen = len(msg)
-        if msgType == "Blocks" and msg and msgLen < utils.INT_BYTE_LEN:
+        msgType, msg = self._Request('GetBlocks', outMsg)
+        if msgType != "Blocks" or not msg or len(msg) < utils.INT_BYTE_LEN:
             return None
 
         numBlocks = utils.BytesToInt(msg[:utils.INT_BYTE_LEN])
@@ -156,6 +269,53 @@ class Client(network.Client):
         
         return blocks
 
+    def GetHeaders(self, height):
+        # Returns (peer height, [block.Header]) for the headers after height
+        msgType, msg = self._Request('GetHeaders', utils.IntToBytes(height))
+        if msgType != 'Headers' or not msg or len(msg) < 2 * utils.INT_BYTE_LEN:
+            return 0, None
+
+        peerHeight = utils.BytesToInt(msg[:utils.INT_BYTE_LEN])
+        self.stats.SetHeight(peerHeight)
+        numHeaders = utils.BytesToInt(msg[utils.INT_BYTE_LEN:2 * utils.INT_BYTE_LEN])
+
+        start = 2 * utils.INT_BYTE_LEN
+        if len(msg) != start + numHeaders * block.HEADER_LEN:
+            return 0, None
+
+        headers = []
+        for i in range(start, len(msg), block.HEADER_LEN):
+            headers.append(block.DecodeHeader(msg[i:i + block.HEADER_LEN]))
+        return peerHeight, headers
+
+    def GetAddrProof(self, addr, start=0, limit=100, maxHeight=0):
+        # Returns [(height, txPos, tx, proof)], newest first, or None. With
+        # a maxHeight, only blocks up to it count, start included.
+        outMsg = addr + utils.IntToBytes(start) + utils.IntToBytes(limit) + utils.IntToBytes(maxHeight)
+        msgType, msg = self._Request('GetAddrProof', outMsg)
+        if msgType != 'AddrProof' or not msg or len(msg) < utils.INT_BYTE_LEN:
+            return None
+
+        entries = []
+        numEntries = utils.BytesToInt(msg[:utils.INT_BYTE_LEN])
+        pos = utils.INT_BYTE_LEN
+        try:
+            for _ in range(numEntries):
+                height = utils.BytesToInt(msg[pos:pos + utils.INT_BYTE_LEN])
+                pos += utils.INT_BYTE_LEN
+                txPos = utils.BytesToInt(msg[pos:pos + utils.INT_BYTE_LEN])
+                pos += utils.INT_BYTE_LEN
+                tx = transaction.DecodeTx(msg[pos:pos + transaction.MSG_LEN])
+                pos += transaction.MSG_LEN
+                proof, used = merkle.DecodeProof(msg[pos:])
+                if proof is None:
+                    return None
+                pos += used
+                entries.append((height, txPos, tx, proof))
+        except ValueError:
+            return None
+        return entries
+
     def Close(self):
         if self.controller.server:
             msg = utils.IntToBytes(self.controller.server.port)
@@ -0,0 +1,106 @@
+import threading
+import metrics
+import zlib
+import lzma
+
+# Codec ids, also used as bits in the codec mask exchanged by Codecs, which
+# is only sent to peers at CODECS_VERSION or later: older ones read the whole
+# Version payload as the version and don't know the message
+CODECS_VERSION = 2
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+
+CODEC_NAMES = {
+    CODEC_NONE: 'none',
+    CODEC_ZLIB: 'zlib',
+    CODEC_LZMA: 'lzma',
+}
+
+# Preferred codecs first
+CODEC_PREFERENCE = [CODEC_ZLIB, CODEC_LZMA]
+SUPPORTED_CODECS = [CODEC_ZLIB, CODEC_LZMA]
+
+# Payloads smaller than this are sent raw
+COMPRESSION_THRESHOLD = 1024
+ZLIB_LEVEL = 6
+LZMA_PRESET = 1
+
+def GetCodecMask(codecs=SUPPORTED_CODECS):
+    mask = 0
+    for codec in codecs:
+        mask |= 1 << codec
+    return mask
+
+def GetCodecsFromMask(mask):
+    return [c for c in SUPPORTED_CODECS if mask & (1 << c)]
+
+def Negotiate(peerMask, codecs=CODEC_PREFERENCE):
+    peerCodecs = GetCodecsFromMask(peerMask)
+    for codec in codecs:
+        if codec in peerCodecs:
+            return codec
+    return CODEC_NONE
+
+def Compress(codec, data):
+    if codec == CODEC_ZLIB:
+        return zlib.compress(data, ZLIB_LEVEL)
+    elif codec == CODEC_LZMA:
+        return lzma.compress(data, preset=LZMA_PRESET)
+    raise ValueError("Unknown codec: %d" % codec)
+
+def Decompress(codec, data, maxSize):
+    # Bounded so a small frame can't expand into an unbounded payload
+    if codec == CODEC_ZLIB:
+        d = zlib.decompressobj()
+    elif codec == CODEC_LZMA:
+        d = lzma.LZMADecompressor()
+    else:
+        raise ValueError("Unknown codec: %d" % codec)
+
+    try:
+        out = d.decompress(data, maxSize + 1)
+    except (zlib.error, lzma.LZMAError) as e:
+        raise ValueError(str(e))
+    if len(out) > maxSize:
+        raise ValueError("Decompressed payload > %d bytes" % maxSize)
+    return out
+
+
+class CompressionStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {} # codec -> [messages, rawBytes, compressedBytes]
+
+    def Add(self, codec, rawLen, compressedLen):
+        with self.lock:
+            s = self.stats.setdefault(codec, [0, 0, 0])
+            s[0] += 1
+            s[1] += rawLen
+            s[2] += compressedLen
+
+    def GetRatio(self, codec=None):
+        with self.lock:
+            if codec is None:
+                values = self.stats.values()
+            else:
+                values = [self.stats.get(codec, [0, 0, 0])]
+            rawLen = sum(s[1] for s in values)
+            compressedLen = sum(s[2] for s in values)
+
+        if compressedLen == 0:
+            return None
+        return rawLen / compressedLen
+
+    def GetStats(self):
+        with self.lock:
+            return {CODEC_NAMES[c]: tuple(s) for c, s in self.stats.items()}
+
+sentStats = CompressionStats()
+receivedStats = CompressionStats()
+
+metrics.registry.Gauge('compression_sent_ratio', 'Raw/compressed bytes of sent payloads',
+                       func=sentStats.GetRatio)
+metrics.registry.Gauge('compression_received_ratio', 'Raw/compressed bytes of received payloads',
+                       func=receivedStats.GetRatio)
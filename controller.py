@@ -1,314 +1,495 @@
 import utils
 import network
+import admission
 import blockchain
+import block
+import blockstore
 import server
 import client
 import rpc
+import peermanager
+import scheduler
+import metrics
+import profiling
+import compression
+import log
+import mempooljournal
+import params
 
 import hashlib
+import os
 import threading
 import time
 import random
 
 # TODO: add a config
-VERSION = 1
+VERSION = params.VERSION
 #INITIAL_ADDRS = [("PORTO", 5001)]
 INITIAL_ADDRS = [("PORTO", 5001), ("18.217.77.113", 5001)]
 DEFAULT_SERVER_PORT = 5001
 DEFAULT_RPC_PORT = 4001
-MAIN_LOOP_TIME = 0.1
+STOP_POLL_TIME = 1.0
 UPDATE_PEERS_TIME = 5
 UPDATE_MEMPOOL_TIME = 1
 CLEAN_MEMPOOL_TIME = 60
 CLEAN_MEMPOOL_MINUTES_AGO = 60 * 60
 SYNC_BLOCKCHAIN_TIME = 10.0
-NUM_PEERS = 5 # TODO: find a way of not limiting the size of the network!!!
-DIFFICULTY = 5
-
-doLog = True
-def Log(msg):
-    if doLog:
-        print(msg)
+MINE_RETRY_TIME = 5.0 # retries mining that gave up, between tx and tip triggers
+SYNC_BATCH_SIZE = server.MAX_BLOCKS_PER_MSG # blocks per GetBlocks
+TARGET_OUTBOUND_PEERS = peermanager.DEFAULT_TARGET_OUTBOUND
+MAX_INBOUND_PEERS = peermanager.DEFAULT_MAX_INBOUND
+DATA_DIR = 'data' # each node started from the command line keeps its files in DATA_DIR/PORT
+ADDR_BOOK_PATH = 'addrbook.json' # relative paths are under the node's dataDir
+MEMPOOL_JOURNAL_PATH = 'mempool.journal'
+BLOCK_STORE_PATH = 'blocks.dat'
+BLOCK_CACHE_SIZE = blockstore.DEFAULT_CACHE_SIZE # decoded block bodies kept in memory
+FLUSH_JOURNAL_TIME = 1
+COMPACT_JOURNAL_TIME = 60
+DIFFICULTY = params.DIFFICULTY
+TARGET_BLOCK_TIME = params.TARGET_BLOCK_TIME
+RETARGET_INTERVAL = params.RETARGET_INTERVAL
+ASSUME_VALID = None # hash of a block whose ancestors sync without signature checks
+
+syncHistogram         = metrics.registry.Histogram('sync_seconds', 'Duration of a block sync round')
+syncBlocksCounter     = metrics.registry.Counter('sync_blocks_total', 'Blocks fetched from peers by sync')
+gossipHistogram       = metrics.registry.Histogram('mempool_gossip_seconds', 'Duration of a mempool gossip round')
+gossipTxsCounter      = metrics.registry.Counter('mempool_gossip_txs_total', 'Transactions received by mempool gossip')
+broadcastCounter      = metrics.registry.Counter('blocks_broadcast_total', 'Mined blocks queued to peers')
+
+# Read from each running node, labelled with its server port: the simulator
+# runs several in one process
+heightGauge           = metrics.registry.Gauge('chain_height', 'Height of the best chain')
+mempoolGauge          = metrics.registry.Gauge('mempool_size', 'Transactions in the mempool')
+peersGauge            = metrics.registry.Gauge('peers', 'Connected outbound peers')
+difficultyGauge       = metrics.registry.Gauge('chain_difficulty', 'Difficulty of the next block, in hex digits')
+
+TASK_UPDATE_PEERS   = 'updatePeers'
+TASK_UPDATE_MEMPOOL = 'updateMempool'
+TASK_CLEAN_MEMPOOL  = 'cleanMempool'
+TASK_SYNC_BLOCKS    = 'syncBlocks'
+TASK_MINE           = 'mine'
+TASK_FLUSH_JOURNAL  = 'flushJournal'
+TASK_COMPACT_JOURNAL = 'compactJournal'
+
+logger = log.GetLogger('controller')
 
 class Controller:
-    def __init__(self, minerAddr=None, privateKey=None):
+    def __init__(self, minerAddr=None, privateKey=None,
+                 initialAddrs=INITIAL_ADDRS, dataDir=None, addrBookPath=ADDR_BOOK_PATH,
+                 targetOutbound=TARGET_OUTBOUND_PEERS, maxInbound=MAX_INBOUND_PEERS,
+                 difficulty=DIFFICULTY, bindAddr=None, addrIndex=False,
+                 admissionWorkers=admission.DEFAULT_NUM_WORKERS,
+                 retargetInterval=RETARGET_INTERVAL, targetBlockTime=TARGET_BLOCK_TIME,
+                 assumeValid=ASSUME_VALID, journalPath=MEMPOOL_JOURNAL_PATH,
+                 storePath=BLOCK_STORE_PATH, blockCacheSize=BLOCK_CACHE_SIZE, bc=None):
         self.isRunning    = False
-        self.blockchain   = blockchain.Blockchain(DIFFICULTY)
-        self.peers        = []
+
+        # Without a dataDir nothing is kept on disk
+        self.dataDir      = dataDir
+        if dataDir:
+            os.makedirs(dataDir, exist_ok=True)
+
+        # A ready chain, like one from chainio.ImportChain, replaces the chain
+        # parameters above
+        if bc is None:
+            bc = blockchain.Blockchain(difficulty, addrIndex,
+                                       retargetInterval, targetBlockTime,
+                                       assumeValid, self.GetDataPath(storePath), blockCacheSize)
+        self.blockchain   = bc
+        self.bindAddr     = bindAddr # local address for the server and outbound peers
         self.server       = None
         self.serverThread = None
         self.rpc          = None
         self.rpcThread    = None
+        self.metricsServer = None
+        self.metricsLabels = None
+        self.profiler     = profiling.ProfilerFromEnv()
+        self.admission    = admission.AdmissionPipeline(self.blockchain, admissionWorkers)
+        journalPath       = self.GetDataPath(journalPath)
+        self.journal      = mempooljournal.MempoolJournal(journalPath) if journalPath else None
         
         self.minerAddr    = minerAddr
         self.privateKey   = privateKey # TODO: use a callback that safely decrypts and returns the private key
         
-        self.minedBlock   = None
-        self.minerThread  = None
+        self.mining       = False
+
+        self.scheduler    = scheduler.Scheduler()
+        self.stopEvent    = threading.Event()
         
-        self.peerLock     = threading.Lock()
+        self.peerManager  = peermanager.PeerManager(self, self.GetDataPath(addrBookPath),
+                                                    initialAddrs,
+                                                    targetOutbound, maxInbound)
+
+        # Wire compression codecs offered to peers, preferred first
+        self.codecs       = list(compression.CODEC_PREFERENCE)
 
         if minerAddr and not privateKey:
             raise ValueError("Miner Address set but private key not specified!")
 
+        self._AddTasks()
+
     def GetVersion(self):
         return VERSION
 
+    def GetDataPath(self, path):
+        if not path or not self.dataDir:
+            return None
+        return os.path.join(self.dataDir, path)
+
     def IsMiner(self):
         return self.minerAddr is not None
 
     def IsMining(self):
-        return self.minerThread is not None
+        return self.mining
 
     def Start(self, startServer=True, serverPort=DEFAULT_SERVER_PORT,
-              startRPC=False, rpcPort=DEFAULT_RPC_PORT):
+              startRPC=False, rpcPort=DEFAULT_RPC_PORT, metricsPort=None):
         if self.isRunning:
             return
 
         if self.minerAddr:
-            Log("Miner Address: %s" % utils.Shorten(self.minerAddr))
+            logger.Info("Miner Address: %s", utils.Shorten(self.minerAddr))
         
-        self.isRunning      = True
-        timerMainLoop       = utils.Timer(MAIN_LOOP_TIME)
-        timerUpdatePeers    = utils.Timer(UPDATE_PEERS_TIME, startDone=True)
-        timerUpdateMempool  = utils.Timer(UPDATE_MEMPOOL_TIME)
-        timerCleanMempool   = utils.Timer(CLEAN_MEMPOOL_TIME)
-        timerSyncBlocks     = utils.Timer(SYNC_BLOCKCHAIN_TIME, startDone=True)
+        self.isRunning = True
+        self.stopEvent.clear()
+        self.metricsLabels = {'port': serverPort}
+        self._SetGauges(self.metricsLabels)
+        self.admission.Start()
+        self._LoadMempool()
 
         if startServer:
-            Log("Starting server")
-            self.server = server.Server(serverPort, self)
+            logger.Info("Starting server")
+            self.server = server.Server(serverPort, self, self.peerManager.maxInbound,
+                                        self.bindAddr)
+            self.server.profiler = self.profiler
             self.serverThread = threading.Thread(name='Server', target=self.server.Start)
             self.serverThread.start()
 
         if startRPC:
-            Log("Starting RPC server")
+            logger.Info("Starting RPC server")
             self.rpc = rpc.RPCServer(rpcPort, self)
+            self.rpc.profiler = self.profiler
             self.rpcThread = threading.Thread(name='RPCServer', target=self.rpc.Start)
             self.rpcThread.start()
 
+        if metricsPort:
+            logger.Info("Starting metrics endpoint on port %d", metricsPort)
+            self.metricsServer = metrics.StartHttpServer(metricsPort)
+
         try:
-            # Main Loop
-            while True:
-                # Update Peers
-                if timerUpdatePeers.IsDone():
-                    self._UpdatePeers()
-                    timerUpdatePeers.Reset()
-                    #Log("My Peers: " + str(self.GetPeerAddrs()))
-
-                # Update mempool
-                if timerUpdateMempool.IsDone():
-                    self._UpdateMempool()
-                    timerUpdateMempool.Reset()
-                    Log("My Mempool: " + str(len(self.blockchain.mempool)))
-
-                # Cleanup the mempool
-                if timerCleanMempool.IsDone():
-                    self._CleanMempool()
-                    timerCleanMempool.Reset()
-
-                # Sync Blockchain with peers
-                if timerSyncBlocks.IsDone():
-                    self._SyncBlocks()
-                    timerSyncBlocks.Reset()
-                    Log("My Blocks: " + str(self.blockchain.GetHeight()))
-
-                # Mine in a separate thread
-                if self.IsMiner():
-                    if not self.IsMining() and self.blockchain.HasMemPool():
-                        self.minerThread = threading.Thread(name='Miner',
-                                                            target=self._Mine)
-                        self.minerThread.start()
-                    elif self.minerThread and not self.minerThread.is_alive():
-                        # Add block and broadcast it
-                        if self.minedBlock and self.blockchain.AddBlock(self.minedBlock):
-                            self._BroadcastBlock(self.minedBlock)
-                        self.minerThread.join()
-                        self.minerThread = None
-                        self.minedBlock = None
-                
-                # Sleep until main loop time has passed
-                timerMainLoop.SleepUntilDone()
-                timerMainLoop.Reset()
-        except:
-            if self.serverThread and self.serverThread.is_alive():
-                self.server.Stop()
-
-            if self.rpcThread and self.rpcThread.is_alive():
-                self.rpc.Stop()
-
-            if self.minerThread and self.minerThread.is_alive():
-                self.blockchain.StopMining()
-
-            raise
+            # Reconnect to the best known addresses right away
+            self.peerManager.Start()
+
+            self.scheduler.Start()
+
+            # Everything runs in the scheduler's workers: just wait to be stopped
+            while self.isRunning:
+                self.stopEvent.wait(STOP_POLL_TIME)
+        finally:
+            self._Shutdown()
+
+    def Stop(self):
+        self.isRunning = False
+        self.stopEvent.set()
+
+    def _Shutdown(self):
+        self.isRunning = False
+
+        if self.IsMining():
+            self.blockchain.StopMining()
+
+        self.scheduler.Stop(STOP_POLL_TIME)
+        self.peerManager.Stop()
+
+        if self.serverThread and self.serverThread.is_alive():
+            self.server.Stop()
+
+        if self.rpcThread and self.rpcThread.is_alive():
+            self.rpc.Stop()
+
+        if self.metricsServer:
+            self.metricsServer.shutdown()
+            self.metricsServer = None
+        self._SetGauges(self.metricsLabels, False)
+
+        self.admission.Stop()
+
+        if self.journal:
+            self.journal.Close()
+
+        # The servers' handlers may still be reading block bodies
+        for thread in (self.serverThread, self.rpcThread):
+            if thread:
+                thread.join(STOP_POLL_TIME)
+        self.blockchain.Close()
+
+    def _SetGauges(self, labels, running=True):
+        bc = self.blockchain
+        gauges = {
+            heightGauge: bc.GetHeight,
+            mempoolGauge: lambda: len(bc.mempool),
+            peersGauge: self.peerManager.GetNumPeers,
+            difficultyGauge: lambda: blockchain.TargetToDifficulty(bc.GetNextTarget()),
+        }
+        for gauge, func in gauges.items():
+            gauge.SetFunc(func if running else None, labels)
+
+    def _LoadMempool(self):
+        # Warm restart: re-admit the journalled txs against the current chain,
+        # then start a fresh journal with the ones that made it back in
+        if not self.journal:
+            return
+
+        txs = self.journal.Load()
+        if txs:
+            statuses = self.admission.Admit(txs)
+            logger.Info("Reloaded %d of %d journalled txs", statuses.count(blockchain.TX_OK), len(txs))
+
+        with self.blockchain.mempoolLock:
+            mempool = list(self.blockchain.mempool.values())
+        self.journal.Open(mempool)
+
+    def _AddTasks(self):
+        self.scheduler.AddTask(TASK_UPDATE_PEERS, self._UpdatePeers, UPDATE_PEERS_TIME)
+        self.scheduler.AddTask(TASK_UPDATE_MEMPOOL, self._UpdateMempool, UPDATE_MEMPOOL_TIME)
+        self.scheduler.AddTask(TASK_CLEAN_MEMPOOL, self._CleanMempool, CLEAN_MEMPOOL_TIME)
+        self.scheduler.AddTask(TASK_SYNC_BLOCKS, self._SyncBlocks, SYNC_BLOCKCHAIN_TIME,
+                               runAtStart=True)
+        if self.IsMiner():
+            self.scheduler.AddTask(TASK_MINE, self._Mine, MINE_RETRY_TIME, runAtStart=True)
+        if self.journal:
+            self.scheduler.AddTask(TASK_FLUSH_JOURNAL, self.journal.Flush, FLUSH_JOURNAL_TIME)
+            self.scheduler.AddTask(TASK_COMPACT_JOURNAL, self._CompactJournal, COMPACT_JOURNAL_TIME)
+
+            self.blockchain.AddListener(blockchain.EVENT_NEW_TX, self.journal.Add)
+            self.blockchain.AddListener(blockchain.EVENT_BLOCK_ADDED, self._OnBlockAddedJournal)
+            self.blockchain.AddListener(blockchain.EVENT_TX_EVICTED, self._OnTxsEvicted)
+
+        # Wake the miner as soon as there's something new to mine on
+        self.blockchain.AddListener(blockchain.EVENT_NEW_TX, self._OnNewTx)
+        self.blockchain.AddListener(blockchain.EVENT_NEW_TIP, self._OnNewTip)
+
+    def _OnNewTx(self, tx):
+        if self.IsMiner():
+            self.scheduler.Trigger(TASK_MINE)
+
+    def _OnNewTip(self, bl):
+        if self.IsMiner():
+            self.scheduler.Trigger(TASK_MINE)
+
+    def _OnBlockAddedJournal(self, bl):
+        # Txs mined in any branch leave the mempool; keep those still in it
+        mempool = self.blockchain.mempool
+        self.journal.Evict([tx.GetHash() for tx in bl.transactions
+                            if tx.GetHash() not in mempool])
+
+    def _OnTxsEvicted(self, txs):
+        self.journal.Evict([tx.GetHash() for tx in txs])
+
+    def _CompactJournal(self):
+        if self.journal.NeedsCompaction():
+            self.journal.Compact()
 
     def ValidateVersion(self, version):
         return version == VERSION
 
     def GetPeerAddrs(self):
-        with self.peerLock:
-            return self._GetPeerAddrs()
+        return self.peerManager.GetPeerAddrs()
+
+    def GetPeers(self):
+        return self.peerManager.GetPeers()
 
     def AddPeer(self, hostname, port):
-        # TODO: Check if hostname is my ip!! maybe use a hash per client?
-        with self.peerLock:
-            if not self._HasPeer(hostname, port) and not self._IsMe(hostname, port):
-                peer = client.Client(hostname, port, self)
-                if peer.Connect():
-                    # Validate version
-                    peerVersion = peer.Version()
-                    if peerVersion and self.ValidateVersion(peerVersion):
-                        self.peers.append(peer)
-                        Log("My Peers: %s"  % self._GetPeerAddrs())
-                        return True
-                    else:
-                        peer.Close()
-                        Log("Invalid peer version:%d" % peerVersion)
-        return False
+        return self.peerManager.AddPeer(hostname, port)
+
+    def AddPeerAsync(self, hostname, port):
+        self.peerManager.AddPeerAsync(hostname, port)
 
     def RemovePeer(self, hostname, port):
-        with self.peerLock:
-            Log("Removing peer: %s:%d" % (hostname, port))
-            self.peers = [c for c in self.peers if not (c.hostname == hostname and c.port == port)]
+        self.peerManager.RemovePeer(hostname, port)
 
-    def _GetRandomPeer(self):
-        if not self.peers:
-            return None
-        
-        i = random.randrange(len(self.peers))
-        return self.peers[i]
-
-    def _HasPeer(self, hostname, port):
-        for peer in self.peers:
-            if peer.hostname == hostname and peer.port == port:
-                return True
-        return False
-
-    def _GetPeerAddrs(self):
-        addrs = []
-        for peer in self.peers:
-            if peer:
-                addrs.append((peer.hostname, peer.port))
-        return addrs
+    def _GetBestPeer(self, minHeight=0):
+        return self.peerManager.GetBestPeer(minHeight)
 
     def _IsMe(self, hostname, port):
         return (self.server and
-                    hostname in (network.GetHostname(), 'localhost', '127.0.0.1') and
+                    hostname in (network.GetHostname(), 'localhost', '127.0.0.1', self.bindAddr) and
                     port == self.server.port)
 
-    def _AddInitialPeers(self):
-        for addr in INITIAL_ADDRS:
-            hostname, port = addr
-            self.AddPeer(hostname, port)
-
-    def _SanitizePeers(self):
-        newPeers = []
-        
-        for peer in self.peers:
-            if not peer.IsConnected():
-                if not peer.Connect() and peer.failedAttempts > 3:
-                    Log("Dropping peer: %s" % peer)
-                    continue
-            newPeers.append(peer)
-
-        self.peers = newPeers
-
     def _UpdatePeers(self):
-        self._SanitizePeers()
-        
-        if not self.peers:
-            #Log("No peers: adding initial peers.")
-            self._AddInitialPeers()
-
-        if len(self.peers) >= NUM_PEERS:
-            return
-
-        for peer in self.peers:
-            addrs = peer.GetAddrs()
-            for addr in addrs:
-                hostname, port = addr
-                self.AddPeer(hostname, port)
-                if len(self.peers) >= NUM_PEERS:
-                    return
+        self.peerManager.Update()
 
     def _UpdateMempool(self):
-        peer = self._GetRandomPeer()
+        peer = self._GetBestPeer()
         if not peer or not peer.IsConnected():
             return
 
-        mempool = peer.GetMempool()
-        for tx in mempool:
-            self.blockchain.AddTransaction(tx)
+        with gossipHistogram.Time():
+            mempool = peer.GetMempool()
+            if mempool:
+                self.admission.Admit(list(mempool))
+        gossipTxsCounter.Inc(len(mempool))
+
+        logger.Debug("My Mempool: %d", len(self.blockchain.mempool))
 
     def _CleanMempool(self):
         timestamp = int(utils.GetCurrentTime() - 60 * CLEAN_MEMPOOL_MINUTES_AGO)
         self.blockchain.CleanMempool(timestamp)
 
     def _Mine(self):
-        if self.minedBlock is not None:
-            return
+        # Keeps mining while there are transactions; a new tip aborts the
+        # current block and the trigger restarts it on top of the new tip
+        while self.isRunning and self.blockchain.HasMemPool():
+            self.mining = True
+            try:
+                minedBlock = self.blockchain.Mine(self.minerAddr,
+                                                  self.privateKey)
+            finally:
+                self.mining = False
+
+            if not minedBlock:
+                return
+
+            logger.Info("Mined Block %s", utils.Shorten(minedBlock.GetHash()))
 
-        self.minedBlock = self.blockchain.Mine(self.minerAddr,
-                                               self.privateKey)
-        if self.minedBlock:
-            Log("Mined Block %s" % utils.Shorten(self.minedBlock.GetHash()))
+            # Add block and broadcast it
+            if self.blockchain.AddBlock(minedBlock):
+                self._BroadcastBlock(minedBlock)
 
     def _BroadcastBlock(self, bl):
-        for peer in self.peers:
-            peer.AddBlock(bl)
+        blBytes = block.EncodeBlock(bl)
+        if not blBytes:
+            return
+
+        peers = self.GetPeers()
+
+        # Each peer's writer thread sends it in parallel
+        for peer in peers:
+            peer.QueueAddBlock(blBytes)
+        broadcastCounter.Inc(len(peers))
 
     def _SyncBlocks(self):
-        # TODO: look for a higher peer?
-        peer = self._GetRandomPeer()
-        if not peer:
-            return
+        with syncHistogram.Time():
+            numBlocks = self._SyncBlocksFromPeer()
+        syncBlocksCounter.Inc(numBlocks)
+
+        logger.Info("My Blocks: %d", self.blockchain.GetHeight())
 
+    def _SyncBlocksFromPeer(self):
         height = self.blockchain.GetHeight()
+        peer = self._GetBestPeer(height)
+        if not peer:
+            return 0
+
         peerHeight, blockHashes = peer.SyncBlocks(height)
 
         # Compare heights
         if peerHeight <= height:
-            return
-
-        if height == 0:
-            newBlockHashes = blockHashes
-        else :
-            newBlockHashes = []
-            # todo: optimize
-            for i in reversed(range(len(blockHashes))):
-                blockHash = blockHashes[i]
-                if self.blockchain.HasBlock(blockHash):
-                    newBlockHashes = blockHashes[i + 1:]
-                    break
+            return 0
+
+        # From the last block we have; all of them if the peer's chain shares
+        # none with ours, as when it grew from another genesis
+        newBlockHashes = blockHashes
+        # todo: optimize
+        for i in reversed(range(len(blockHashes))):
+            if self.blockchain.HasBlock(blockHashes[i]):
+                newBlockHashes = blockHashes[i + 1:]
+                break
+
+        # Blocks up to an assumed-valid one are added together, so that
+        # AddBlocks sees the whole run; the rest batch by batch, so that only
+        # one batch is held in memory
+        numToBuffer = 0
+        assumeValid = self.blockchain.assumeValid
+        if assumeValid in newBlockHashes and not self.blockchain.HasBlock(assumeValid):
+            numToBuffer = newBlockHashes.index(assumeValid) + 1
 
         #TODO: ask new blocks to several peers, rather than just this
-        if newBlockHashes:
-            newBlocks = peer.GetBlocks(newBlockHashes)
-            if newBlocks:
+        # In batches, so that each reply fits in a frame
+        numAdded = 0
+        newBlocks = []
+        for i in range(0, len(newBlockHashes), SYNC_BATCH_SIZE):
+            blocks = peer.GetBlocks(newBlockHashes[i:i + SYNC_BATCH_SIZE])
+            if not blocks:
+                break
+            newBlocks.extend(blocks)
+            if numAdded + len(newBlocks) >= numToBuffer:
                 self.blockchain.AddBlocks(newBlocks)
+                numAdded += len(newBlocks)
+                newBlocks = []
+
+        if newBlocks:
+            self.blockchain.AddBlocks(newBlocks)
+            numAdded += len(newBlocks)
+        return numAdded
 
 def Usage():
     print("USAGE: controller.py [PORT]")
     print("     | controller.py rpc [PORT RPC_PORT]")
     print("     | controller.py miner [PRIV_KEY PUB_KEY] [PORT]")
+    print("     | controller.py import FILE [PORT RPC_PORT]")
     print("     | controller.py genkeys")
     print("     | controller.py help")
 
 if __name__ == '__main__':
     import sys
+    import signal
 
     numArgs = len(sys.argv)
 
+    # Prometheus endpoint, off unless METRICS_PORT is set
+    metricsPort = int(os.environ.get('METRICS_PORT', 0)) or None
+
+    # Address history for the GetAddrHist RPC, off unless ADDR_INDEX=1
+    addrIndex = os.environ.get('ADDR_INDEX', '') not in ('', '0')
+
+    # ASSUME_VALID=<block hash hex> skips signature checks below it when syncing
+    assumeValid = os.environ.get('ASSUME_VALID', None)
+    assumeValid = bytes.fromhex(assumeValid) if assumeValid else ASSUME_VALID
+
+    # kill -USR1 writes the last log records to stderr
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: log.Dump())
+
+    # Node files go in DATA_DIR/PORT, so nodes started from one checkout don't
+    # share them
+    dataRoot = os.environ.get('DATA_DIR', DATA_DIR)
+
+    # Block bodies decoded in memory at once; the rest are read from the
+    # node's blocks.dat
+    blockCacheSize = int(os.environ.get('BLOCK_CACHE_SIZE', BLOCK_CACHE_SIZE))
+
     if numArgs == 1:
         port = int(sys.argv[2]) if numArgs > 2 else 5003
         
-        c = Controller()
-        c.Start(True, port)
+        c = Controller(dataDir=os.path.join(dataRoot, str(port)),
+                       assumeValid=assumeValid, blockCacheSize=blockCacheSize)
+        c.Start(True, port, metricsPort=metricsPort)
 
     elif sys.argv[1] == "help":
         Usage()
         sys.exit(1)
 
+    elif sys.argv[1] == "import" and numArgs > 2:
+        # Seeds the node with a chain file from chainio.py, then syncs the
+        # rest from peers
+        import chainio
+        port = int(sys.argv[3]) if numArgs > 3 else 5001
+        rpcPort = int(sys.argv[4]) if numArgs > 4 else None
+
+        # The node runs with the chain parameters in the file
+        dataDir = os.path.join(dataRoot, str(port))
+        os.makedirs(dataDir, exist_ok=True)
+        try:
+            bc = chainio.NewBlockchain(sys.argv[2], addrIndex, assumeValid,
+                                       os.path.join(dataDir, BLOCK_STORE_PATH), blockCacheSize)
+        except (OSError, ValueError) as e:
+            print(e)
+            sys.exit(1)
+        chainio.ImportChain(bc, sys.argv[2])
+        c = Controller(dataDir=dataDir, bc=bc)
+        c.Start(True, port, rpcPort is not None, rpcPort, metricsPort)
+
     elif sys.argv[1] == "genkeys":
         privateKey, publicKey = utils.GenerateKeys()
         print("Private Key: %s" % utils.BytesToPrivKeyStr(privateKey))
@@ -318,8 +499,9 @@ if __name__ == '__main__':
         port = int(sys.argv[2]) if numArgs > 2 else 5001
         rpcPort = int(sys.argv[3]) if numArgs > 3 else 4001
         
-        c = Controller()
-        c.Start(True, port, True, rpcPort)
+        c = Controller(dataDir=os.path.join(dataRoot, str(port)), addrIndex=addrIndex,
+                       assumeValid=assumeValid, blockCacheSize=blockCacheSize)
+        c.Start(True, port, True, rpcPort, metricsPort)
     
     elif sys.argv[1] == "miner":
         port = int(sys.argv[2]) if numArgs > 2 else 5001
@@ -331,5 +513,7 @@ if __name__ == '__main__':
         else:
             privateKey, minerAddr = utils.GenerateKeys()
       
-        c = Controller(minerAddr=minerAddr, privateKey=privateKey)
-        c.Start(True, port, rpcPort is not None, rpcPort)
+        c = Controller(minerAddr=minerAddr, privateKey=privateKey,
+                       dataDir=os.path.join(dataRoot, str(port)), addrIndex=addrIndex,
+                       assumeValid=assumeValid, blockCacheSize=blockCacheSize)
+        c.Start(True, port, rpcPort is not None, rpcPort, metricsPort)
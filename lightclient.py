@@ -0,0 +1,370 @@
+import blockchain
+import client
+import compression
+import log
+import merkle
+import network
+import params
+import scheduler
+import utils
+
+import sys
+import threading
+
+# Headers-only node. It keeps the best chain's headers, checks their linkage
+# and proof of work, and works out balances from transactions that full peers
+# prove to be in those headers' Merkle roots. Headers don't commit to the
+# balances, so a peer can't forge a transaction but could leave some out.
+
+HEADER_SYNC_TIME = 5.0
+REORG_DEPTH = 20        # headers re-requested below the tip to notice forks
+PROOF_PAGE_SIZE = 1000
+STOP_POLL_TIME = 1.0
+
+TASK_SYNC_HEADERS = 'syncHeaders'
+
+logger = log.GetLogger('lightclient')
+
+
+class HeaderChain:
+    # Parallel lists by height - 1, much smaller than Header objects
+    def __init__(self, difficulty, retargetInterval=None, targetBlockTime=None):
+        self.baseTarget       = blockchain.DifficultyToTarget(difficulty)
+        self.retargetInterval = retargetInterval
+        self.targetBlockTime  = targetBlockTime
+
+        self.hashes      = []
+        self.merkleRoots = []
+        self.numTxs      = []
+        self.timestamps  = []
+        self.targets     = []
+        self.works       = [] # chain work up to each header
+        self.lock        = threading.Lock()
+
+    def GetHeight(self):
+        return len(self.hashes)
+
+    def GetHash(self, height):
+        if 0 < height <= len(self.hashes):
+            return self.hashes[height - 1]
+        return None
+
+    def GetTipHash(self):
+        return self.hashes[-1] if self.hashes else None
+
+    def VerifyTx(self, height, txPos, tx, proof):
+        if not 0 < height <= len(self.hashes) or txPos >= self.numTxs[height - 1]:
+            return False
+        return merkle.VerifyProof(tx.GetHash(), txPos, proof, self.merkleRoots[height - 1])
+
+    def GetWork(self):
+        return self.works[-1] if self.works else 0
+
+    def AddHeaders(self, startHeight, headers):
+        # headers follow the block at startHeight. Replaces our chain above
+        # startHeight if theirs has more work. Returns False if invalid.
+        if not headers:
+            return True
+
+        with self.lock:
+            if startHeight > len(self.hashes):
+                return False
+
+            # Skip the headers we already have
+            skip = 0
+            while (skip < len(headers) and
+                   startHeight + skip < len(self.hashes) and
+                   headers[skip].GetHash() == self.hashes[startHeight + skip]):
+                skip += 1
+            headers = headers[skip:]
+            startHeight += skip
+            if not headers:
+                return True
+
+            hashes      = self.hashes[:startHeight]
+            merkleRoots = self.merkleRoots[:startHeight]
+            numTxs      = self.numTxs[:startHeight]
+            timestamps  = self.timestamps[:startHeight]
+            targets     = self.targets[:startHeight]
+            works       = self.works[:startHeight]
+            now         = utils.GetCurrentTime()
+
+            for h in headers:
+                parent = hashes[-1] if hashes else None
+                if h.parent != parent:
+                    return False
+
+                if not blockchain.ValidateTimestamp(h.timestamp, blockchain.GetMedianTime(timestamps), now):
+                    return False
+
+                target = self._GetTarget(timestamps, targets)
+                hash = h.GetHash()
+                if blockchain.HashToInt(hash) > target:
+                    return False
+
+                hashes.append(hash)
+                merkleRoots.append(h.merkleRoot)
+                numTxs.append(h.numTx)
+                timestamps.append(h.timestamp)
+                targets.append(target)
+                works.append((works[-1] if works else 0) + blockchain.GetWork(target))
+
+            if works[-1] <= self.GetWork():
+                # No more work than what we have
+                return True
+
+            self.hashes      = hashes
+            self.merkleRoots = merkleRoots
+            self.numTxs      = numTxs
+            self.timestamps  = timestamps
+            self.targets     = targets
+            self.works       = works
+            return True
+
+    def _GetTarget(self, timestamps, targets):
+        # Same rule as Blockchain._GetTarget, for a child of the last header
+        parentHeight = len(targets)
+        if not self.retargetInterval or parentHeight == 0:
+            return self.baseTarget
+        if parentHeight % self.retargetInterval != 0 or parentHeight < self.retargetInterval:
+            return targets[-1]
+
+        first = parentHeight - self.retargetInterval
+        return blockchain.Retarget(targets[-1], timestamps[-1] - timestamps[first],
+                                   self.retargetInterval, self.targetBlockTime)
+
+
+class LightClient:
+    def __init__(self, peerAddrs, difficulty=params.DIFFICULTY,
+                 retargetInterval=params.RETARGET_INTERVAL,
+                 targetBlockTime=params.TARGET_BLOCK_TIME, bindAddr=None):
+        self.headers   = HeaderChain(difficulty, retargetInterval, targetBlockTime)
+        self.peerAddrs = list(peerAddrs)
+        self.peer      = None
+        self.peerLock  = threading.Lock()
+        self.balances  = {} # addr -> (tip hash, balance)
+
+        # Used by client.Client
+        self.bindAddr  = bindAddr
+        self.codecs    = compression.SUPPORTED_CODECS
+        self.server    = None
+
+        self.rpc       = None
+        self.rpcThread = None
+        self.scheduler = scheduler.Scheduler()
+        self.stopEvent = threading.Event()
+        self.scheduler.AddTask(TASK_SYNC_HEADERS, self.SyncHeaders, HEADER_SYNC_TIME,
+                               runAtStart=True)
+
+    def GetVersion(self):
+        return params.VERSION
+
+    def GetHeight(self):
+        return self.headers.GetHeight()
+
+    def Start(self, rpcPort=None):
+        self.stopEvent.clear()
+        if rpcPort is not None:
+            self.rpc = LightRPCServer(rpcPort, self)
+            self.rpcThread = threading.Thread(name='LightRPCServer', target=self.rpc.Start)
+            self.rpcThread.start()
+
+        self.scheduler.Start()
+        try:
+            while not self.stopEvent.wait(STOP_POLL_TIME):
+                pass
+        finally:
+            self.scheduler.Stop(STOP_POLL_TIME)
+            if self.rpcThread and self.rpcThread.is_alive():
+                self.rpc.Stop()
+            with self.peerLock:
+                if self.peer:
+                    self.peer.Close()
+                    self.peer = None
+
+    def Stop(self):
+        self.stopEvent.set()
+
+    def _GetPeer(self):
+        # Keeps one connection, moving to the next address when it drops
+        with self.peerLock:
+            if self.peer and self.peer.IsConnected():
+                return self.peer
+
+            for _ in range(len(self.peerAddrs)):
+                hostname, port = self.peerAddrs[0]
+                self.peerAddrs.append(self.peerAddrs.pop(0))
+
+                peer = client.Client(hostname, port, self)
+                if peer.Connect() and peer.Version() == self.GetVersion():
+                    self.peer = peer
+                    return peer
+                peer.Close()
+
+            self.peer = None
+            return None
+
+    def SyncHeaders(self):
+        # Returns the number of new headers
+        startHeight = self.headers.GetHeight()
+        while True:
+            peer = self._GetPeer()
+            if not peer:
+                return 0
+
+            height = self.headers.GetHeight()
+            tip = self.headers.GetTipHash()
+            fromHeight = max(0, height - REORG_DEPTH)
+            peerHeight, headers = peer.GetHeaders(fromHeight)
+            if headers is None:
+                peer.Disconnect()
+                return 0
+
+            if not self.headers.AddHeaders(fromHeight, headers):
+                logger.Warning("Invalid headers from %s:%d", peer.hostname, peer.port)
+                peer.Disconnect()
+                return 0
+
+            if not headers or fromHeight + len(headers) >= peerHeight:
+                break
+
+            # A longer branch with less work than ours leaves the tip where it
+            # was, and asking again would get the same headers
+            if self.headers.GetTipHash() == tip:
+                logger.Warning("No progress on headers from %s:%d", peer.hostname, peer.port)
+                peer.Disconnect()
+                break
+
+        added = self.headers.GetHeight() - startHeight
+        if added:
+            logger.Info("Headers height: %d", self.headers.GetHeight())
+        return added
+
+    def GetProvenHistory(self, addr):
+        # All of addr's txs as [(height, txPos, tx)], oldest first, each
+        # checked against our headers. None if a peer sent a bad proof.
+        return self._GetProvenHistory(addr)[1]
+
+    def _GetProvenHistory(self, addr):
+        # Returns (hash of the last block covered, history)
+        # Pages only cover blocks up to our headers' height, so that blocks
+        # the peer adds meanwhile don't shift the entries between pages
+        self.SyncHeaders()
+        maxHeight = self.headers.GetHeight()
+        tip = self.headers.GetHash(maxHeight)
+
+        peer = self._GetPeer()
+        if not peer:
+            return tip, None
+
+        entries = []
+        start = 0
+        while True:
+            page = peer.GetAddrProof(addr, start, PROOF_PAGE_SIZE, maxHeight)
+            if page is None:
+                return tip, None
+            entries.extend(page)
+            if len(page) < PROOF_PAGE_SIZE:
+                break
+            start += len(page)
+
+        # A reorg between pages can still repeat entries
+        history = []
+        seen = set()
+        for height, txPos, tx, proof in entries:
+            if (height, txPos) in seen:
+                continue
+            seen.add((height, txPos))
+            if addr not in (tx.fromAddr, tx.toAddr) or not self.headers.VerifyTx(height, txPos, tx, proof):
+                logger.Warning("Bad proof for %s at height %d", utils.Shorten(addr), height)
+                peer.Disconnect()
+                return tip, None
+            history.append((height, txPos, tx))
+
+        history.sort(key=lambda e: (e[0], e[1]))
+        return tip, history
+
+    def GetBalance(self, addr):
+        tip = self.headers.GetTipHash()
+        cached = self.balances.get(addr, None)
+        if cached and cached[0] == tip:
+            return cached[1]
+
+        tip, history = self._GetProvenHistory(addr)
+        if history is None:
+            return None
+
+        balance = 0
+        i = 0
+        while i < len(history):
+            height = history[i][0]
+            blockTxs = []
+            while i < len(history) and history[i][0] == height:
+                blockTxs.append(history[i][2])
+                i += 1
+            balance = ApplyBlockTxs(balance, addr, blockTxs)
+
+        self.balances[addr] = (tip, balance)
+        return balance
+
+    def IsTxIncluded(self, addr, txHash):
+        history = self.GetProvenHistory(addr)
+        if history is None:
+            return None
+        return any(tx.GetHash() == txHash for _, _, tx in history)
+
+
+def ApplyBlockTxs(balance, addr, txs):
+    # addr's balance after a block, given its txs in the block, following
+    # Blockchain._CalculateBalances: the receiving side starts from the
+    # balance before the block, and a tx to oneself (like the reward) adds
+    # its amount
+    blockBalance = None
+    for tx in txs:
+        if tx.fromAddr == tx.toAddr:
+            blockBalance = balance + tx.amount
+        elif tx.fromAddr == addr:
+            fromBalance = blockBalance if blockBalance is not None else balance
+            blockBalance = fromBalance - tx.amount
+        else:
+            blockBalance = balance + tx.amount
+    return blockBalance if blockBalance is not None else balance
+
+
+class LightRPCServer(network.Server):
+    # The subset of rpc.RPCServer a light client can answer
+    def __init__(self, port, lightClient):
+        super().__init__(port)
+        self.lightClient = lightClient
+
+    def _Version(self, clientSock, clientAddress, msgType, msg):
+        clientSock.Send('Version', utils.IntToBytes(self.lightClient.GetVersion()))
+
+    def _GetBalance(self, clientSock, clientAddress, msgType, msg):
+        addr = msg[:utils.ADDR_BYTE_LEN]
+        balance = self.lightClient.GetBalance(addr)
+        if balance is not None:
+            clientSock.Send('Balance', utils.IntToBytes(balance))
+        else:
+            clientSock.Send('NoBalance')
+
+
+def Usage():
+    print("USAGE: lightclient.py HOSTNAME:PORT[,HOSTNAME:PORT...] [RPC_PORT]")
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        Usage()
+        sys.exit(1)
+
+    peerAddrs = []
+    for addrStr in sys.argv[1].split(','):
+        hostname, port = addrStr.split(':')
+        peerAddrs.append((hostname, int(port)))
+    rpcPort = int(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    lc = LightClient(peerAddrs)
+    try:
+        lc.Start(rpcPort)
+    except KeyboardInterrupt:
+        lc.Stop()
@@ -0,0 +1,249 @@
+import blockchain
+import metrics
+import rpc
+import transaction
+import utils
+
+import argparse
+import json
+import queue
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# Transaction load generator for a node's RPC port. Keys are generated once,
+# transactions are signed ahead of time in a process pool and several RPC
+# connections send them at a target rate.
+
+DEFAULT_KEYS = 100
+DEFAULT_CONNECTIONS = 4
+DEFAULT_RATE = 100.0
+DEFAULT_DURATION = 30.0
+SIGN_BATCH_SIZE = 200
+MAX_SIGNED_BATCHES = 32 # signed batches kept ready ahead of the senders
+KEY_SECRET_BASE = 7000000
+
+SINGLE_TX_STATUS = {'TxOK': blockchain.TX_OK, 'TxBUSY': blockchain.TX_BUSY}
+
+def SignBatch(batch):
+    # Runs in a worker process: [(privateKey, fromAddr, toAddr, amount, nonce)] -> [txBytes]
+    out = []
+    for privateKey, fromAddr, toAddr, amount, nonce in batch:
+        tx = transaction.Transaction(fromAddr, toAddr, amount, nonce)
+        tx.Sign(privateKey)
+        out.append(transaction.EncodeTx(tx))
+    return out
+
+
+class KeyPool:
+    def __init__(self, numKeys, seed):
+        self.keys   = [utils.GenerateKeysFromSecret(KEY_SECRET_BASE + seed * 100003 + i)
+                       for i in range(numKeys)]
+        self.nonces = [random.Random(seed + i).randrange(1 << 24) for i in range(numKeys)]
+        self.rng    = random.Random(seed)
+
+    def NextTxArgs(self, amount=0):
+        # Sequential nonces per sender keep every tx distinct
+        i = self.rng.randrange(len(self.keys))
+        j = self.rng.randrange(len(self.keys))
+        self.nonces[i] += 1
+        privateKey, fromAddr = self.keys[i]
+        return (privateKey, fromAddr, self.keys[j][1], amount, self.nonces[i] % (1 << 32))
+
+    def Fund(self, client, funderKey, funderAddr, amount, nonce):
+        # Optional: give each key a balance from a funded address
+        accepted = 0
+        for _, addr in self.keys:
+            nonce += 1
+            tx = transaction.Transaction(funderAddr, addr, amount, nonce)
+            tx.Sign(funderKey)
+            if client.AddTx(tx):
+                accepted += 1
+        return accepted
+
+
+class LoadGenerator:
+    def __init__(self, hostname, port, rate=DEFAULT_RATE, duration=DEFAULT_DURATION,
+                 numConnections=DEFAULT_CONNECTIONS, numKeys=DEFAULT_KEYS,
+                 numProcesses=None, seed=1, batchSize=1):
+        self.hostname       = hostname
+        self.port           = port
+        self.rate           = rate
+        self.duration       = duration
+        self.numConnections = numConnections
+        self.numProcesses   = numProcesses
+        self.batchSize      = batchSize
+        self.keys           = KeyPool(numKeys, seed)
+
+        self.signed   = queue.Queue(MAX_SIGNED_BATCHES)
+        self.latency  = metrics.Histogram('loadgen_latency_seconds')
+        self.lock     = threading.Lock()
+        self.sent     = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.busy     = 0
+        self.errors   = 0
+        self.active   = False
+
+    def _Sign(self):
+        # Keeps the senders supplied with signed txs until the run ends
+        with ProcessPoolExecutor(self.numProcesses) as pool:
+            pending = []
+            while self.active:
+                while len(pending) < (self.numProcesses or 4) * 2:
+                    batch = [self.keys.NextTxArgs() for _ in range(SIGN_BATCH_SIZE)]
+                    pending.append(pool.submit(SignBatch, batch))
+
+                txs = pending.pop(0).result()
+                while self.active:
+                    try:
+                        self.signed.put(txs, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+
+            for f in pending:
+                f.cancel()
+
+    def _Send(self, index, startTime):
+        client = rpc.RPCClient(self.hostname, self.port)
+        if not client.Connect():
+            with self.lock:
+                self.errors += 1
+            return
+
+        # Each connection sends its share of the rate on a fixed schedule,
+        # one tx or one AddTxs batch per slot
+        interval = self.numConnections * self.batchSize / self.rate
+        nextTime = startTime + index * interval / self.numConnections
+        endTime = startTime + self.duration
+        txs = []
+
+        while self.active and time.monotonic() < endTime:
+            if len(txs) < self.batchSize:
+                try:
+                    txs.extend(self.signed.get(timeout=0.1))
+                except queue.Empty:
+                    continue
+
+            delay = nextTime - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            nextTime += interval
+
+            if self.batchSize > 1:
+                batch, txs = txs[:self.batchSize], txs[self.batchSize:]
+                sendTime = time.perf_counter()
+                statuses = client.AddEncodedTxs(batch)
+            else:
+                sendTime = time.perf_counter()
+                client.Send('AddTx', txs.pop())
+                msgType, _msg = client.Receive()
+                statuses = None if msgType is None else [SINGLE_TX_STATUS.get(msgType, None)]
+            self.latency.Observe(time.perf_counter() - sendTime)
+
+            with self.lock:
+                if statuses is None:
+                    self.errors += 1
+                    break
+                self.sent += len(statuses)
+                for status in statuses:
+                    if status == blockchain.TX_OK:
+                        self.accepted += 1
+                    elif status == blockchain.TX_BUSY:
+                        self.busy += 1
+                    else:
+                        self.rejected += 1
+
+        client.Close()
+
+    def Run(self):
+        self.active = True
+        signer = threading.Thread(name='Signer', target=self._Sign, daemon=True)
+        signer.start()
+
+        # Wait for the first signed batch so that the ramp up doesn't count
+        while self.signed.empty():
+            if not signer.is_alive():
+                raise RuntimeError("Signer stopped before producing any transactions")
+            time.sleep(0.01)
+
+        startTime = time.monotonic()
+        senders = [threading.Thread(name='Sender_%d' % i, target=self._Send,
+                                    args=(i, startTime), daemon=True)
+                   for i in range(self.numConnections)]
+        for t in senders:
+            t.start()
+        for t in senders:
+            t.join()
+        elapsed = time.monotonic() - startTime
+
+        self.active = False
+        signer.join()
+        return self.Report(elapsed)
+
+    def Report(self, elapsed):
+        snapshot = self.latency.Snapshot().get((), None)
+        buckets = {}
+        mean = None
+        if snapshot:
+            bucketCounts, count, total = snapshot
+            for bound, n in zip(self.latency.buckets + (float('inf'),), bucketCounts):
+                buckets['le_%s' % bound] = n
+            mean = total / count if count else None
+
+        return {
+            'targetRate': self.rate,
+            'achievedRate': self.sent / elapsed if elapsed else 0,
+            'acceptedRate': self.accepted / elapsed if elapsed else 0,
+            'elapsed': elapsed,
+            'sent': self.sent,
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'busy': self.busy,
+            'errors': self.errors,
+            'acceptance': self.accepted / self.sent if self.sent else None,
+            'latency': {
+                'mean': mean,
+                'p50': self.latency.GetPercentile(0.5),
+                'p90': self.latency.GetPercentile(0.9),
+                'p99': self.latency.GetPercentile(0.99),
+                'histogram': buckets,
+            },
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='JoaoChain transaction load generator')
+    parser.add_argument('hostname')
+    parser.add_argument('port', type=int)
+    parser.add_argument('--rate', type=float, default=DEFAULT_RATE, help='transactions per second')
+    parser.add_argument('--duration', type=float, default=DEFAULT_DURATION)
+    parser.add_argument('--connections', type=int, default=DEFAULT_CONNECTIONS)
+    parser.add_argument('--keys', type=int, default=DEFAULT_KEYS)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--batch', type=int, default=1, help='transactions per AddTxs request')
+    parser.add_argument('--fund', nargs=3, metavar=('PRIV_KEY', 'ADDR', 'AMOUNT'),
+                        help='fund every key from this address first')
+    args = parser.parse_args()
+
+    gen = LoadGenerator(args.hostname, args.port, args.rate, args.duration,
+                        args.connections, args.keys, args.processes, args.seed,
+                        args.batch)
+
+    if args.fund:
+        client = rpc.RPCClient(args.hostname, args.port)
+        if not client.Connect():
+            sys.exit(1)
+        funded = gen.keys.Fund(client,
+                               utils.PrivKeyStrToBytes(args.fund[0]),
+                               utils.AddrStrToBytes(args.fund[1]),
+                               int(args.fund[2]),
+                               random.randrange(1 << 24))
+        client.Close()
+        print("Funded %d keys" % funded, file=sys.stderr)
+
+    print(json.dumps(gen.Run(), indent=2))
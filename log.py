@@ -0,0 +1,214 @@
+import atexit
+import collections
+import os
+import sys
+import threading
+import time
+
+# Leveled logging for the node. A record is stored unformatted, as (time,
+# level, module, fmt, args). The last RING_SIZE records at or above the ring
+# level, DEBUG unless set, go in a ring buffer for post-mortem dumps, whatever
+# the module and output levels. The ones at or above both of those are also
+# queued to a background thread that formats and writes them. A call below
+# all the levels returns after one comparison.
+#
+# LOG_LEVEL=info,blockchain=debug sets the default and per-module levels.
+
+DEBUG   = 10
+INFO    = 20
+WARNING = 30
+ERROR   = 40
+OFF     = 100
+
+LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR', OFF: 'OFF'}
+
+DEFAULT_LEVEL = INFO
+DEFAULT_RING_LEVEL = DEBUG
+RING_SIZE = 4096
+MAX_QUEUED = 10000 # records waiting to be written; more are dropped
+
+def ParseLevel(name):
+    for level, levelName in LEVEL_NAMES.items():
+        if levelName.lower() == name.strip().lower():
+            return level
+    return int(name)
+
+
+class Logger:
+    def __init__(self, name, level):
+        self.name  = name
+        self.SetLevel(level)
+
+    def SetLevel(self, level):
+        self.level    = level # written at or above this
+        self.minLevel = min(level, ringLevel) # kept at or above this
+
+    def IsEnabled(self, level):
+        return level >= self.minLevel
+
+    def Log(self, level, fmt, *args):
+        if level >= self.minLevel:
+            _Emit(level, self, fmt, args)
+
+    def Debug(self, fmt, *args):
+        if DEBUG >= self.minLevel:
+            _Emit(DEBUG, self, fmt, args)
+
+    def Info(self, fmt, *args):
+        if INFO >= self.minLevel:
+            _Emit(INFO, self, fmt, args)
+
+    def Warning(self, fmt, *args):
+        if WARNING >= self.minLevel:
+            _Emit(WARNING, self, fmt, args)
+
+    def Error(self, fmt, *args):
+        if ERROR >= self.minLevel:
+            _Emit(ERROR, self, fmt, args)
+
+
+class QueueHandler:
+    # Formats and writes records from a daemon thread, so the caller only
+    # pays for an append
+    def __init__(self, stream=None, maxQueued=MAX_QUEUED):
+        self.stream    = stream
+        self.maxQueued = maxQueued
+        self.records   = collections.deque()
+        self.pending   = 0 # queued or being written
+        self.dropped   = 0
+        self.cond      = threading.Condition()
+        self.thread    = None
+
+    def Put(self, record):
+        with self.cond:
+            if len(self.records) >= self.maxQueued:
+                self.dropped += 1
+                return
+            self.records.append(record)
+            self.pending += 1
+            if self.thread is None:
+                self.thread = threading.Thread(name='Log', target=self._Run, daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def Flush(self):
+        # Waits until the queued records are written
+        with self.cond:
+            while self.pending and self.thread and self.thread.is_alive():
+                self.cond.wait(0.1)
+
+    def _Run(self):
+        while True:
+            with self.cond:
+                while not self.records:
+                    self.cond.wait()
+                records = list(self.records)
+                self.records.clear()
+                dropped, self.dropped = self.dropped, 0
+
+            stream = self.stream or sys.stdout
+            lines = [FormatLine(r) for r in records]
+            if dropped:
+                lines.append('Log queue full, dropped %d records' % dropped)
+            try:
+                stream.write('\n'.join(lines) + '\n')
+                stream.flush()
+            except (OSError, ValueError):
+                pass
+
+            with self.cond:
+                self.pending -= len(records)
+                self.cond.notify_all()
+
+
+def Format(record):
+    t, level, name, fmt, args = record
+    try:
+        return fmt % args if args else fmt
+    except (TypeError, ValueError) as e:
+        return '%s %r (bad format: %s)' % (fmt, args, e)
+
+def FormatLine(record):
+    # As written out: plain for info and below, like the old prints
+    level = record[1]
+    if level >= WARNING:
+        return '%s: %s' % (LEVEL_NAMES.get(level, level), Format(record))
+    return Format(record)
+
+
+defaultLevel = DEFAULT_LEVEL
+ringLevel    = DEFAULT_RING_LEVEL
+outputLevel  = DEBUG # records at or above this and their module's level are written
+moduleLevels = {} # module -> level
+loggers      = {} # module -> Logger
+ring         = collections.deque(maxlen=RING_SIZE)
+handler      = QueueHandler()
+lock         = threading.Lock()
+
+def _Emit(level, logger, fmt, args):
+    record = (time.time(), level, logger.name, fmt, args)
+    if level >= ringLevel:
+        ring.append(record)
+    if level >= logger.level and level >= outputLevel:
+        handler.Put(record)
+
+def GetLogger(name):
+    with lock:
+        logger = loggers.get(name, None)
+        if logger is None:
+            logger = loggers[name] = Logger(name, moduleLevels.get(name, defaultLevel))
+        return logger
+
+def SetLevel(level, module=None):
+    # The default level, or one module's
+    global defaultLevel
+    with lock:
+        if module is None:
+            defaultLevel = level
+            for name, logger in loggers.items():
+                logger.SetLevel(moduleLevels.get(name, level))
+        else:
+            moduleLevels[module] = level
+            if module in loggers:
+                loggers[module].SetLevel(level)
+
+def SetOutputLevel(level):
+    # Records below it go only to the ring buffer
+    global outputLevel
+    outputLevel = level
+
+def SetRingLevel(level):
+    # Records below it aren't kept for dumps; OFF keeps only what's written
+    global ringLevel
+    with lock:
+        ringLevel = level
+        for logger in loggers.values():
+            logger.SetLevel(logger.level)
+
+def Configure(spec):
+    # 'info,blockchain=debug,network=warning'
+    for part in spec.split(','):
+        if not part.strip():
+            continue
+        if '=' in part:
+            module, level = part.split('=', 1)
+            SetLevel(ParseLevel(level), module.strip())
+        else:
+            SetLevel(ParseLevel(part))
+
+def Flush():
+    handler.Flush()
+
+def Dump(stream=None):
+    # Writes the ring buffer, oldest first, with times and modules
+    stream = stream or sys.stderr
+    for record in list(ring):
+        t, level, name = record[:3]
+        stream.write('%s.%03d %-7s %-12s %s\n' % (
+            time.strftime('%H:%M:%S', time.localtime(t)), int(t * 1000) % 1000,
+            LEVEL_NAMES.get(level, level), name, Format(record)))
+    stream.flush()
+
+
+Configure(os.environ.get('LOG_LEVEL', ''))
+atexit.register(Flush)
@@ -0,0 +1,224 @@
+import transaction
+import utils
+import metrics
+import log
+
+import os
+import threading
+from collections import OrderedDict
+
+# Append-only log of mempool changes, so that a restarted node gets its
+# mempool back without waiting for gossip. Each record is one type byte and
+# its payload:
+#   RECORD_ADD:   encoded tx | timeAdded
+#   RECORD_EVICT: tx hash
+# Replaying the records gives the txs that were still in the mempool. The
+# file is rewritten with just those once it holds mostly dead records.
+
+RECORD_ADD   = b'A'
+RECORD_EVICT = b'E'
+TIME_BYTE_LEN = 8
+ADD_RECORD_LEN = 1 + transaction.MSG_LEN + TIME_BYTE_LEN
+EVICT_RECORD_LEN = 1 + utils.HASH_BYTE_LEN
+
+COMPACT_MIN_RECORDS = 1000
+COMPACT_RATIO = 4 # compact once there are this many records per live tx
+
+journalRecordsCounter = metrics.registry.Counter('mempool_journal_records_total', 'Records appended to the mempool journal')
+journalCompactCounter = metrics.registry.Counter('mempool_journal_compactions_total', 'Mempool journal rewrites')
+
+logger = log.GetLogger('mempooljournal')
+
+
+class MempoolJournal:
+    def __init__(self, path):
+        self.path       = path
+        self.file       = None
+        self.live       = OrderedDict() # tx hash -> add record, for txs not evicted
+        self.loaded     = OrderedDict() # the live records found by Load
+        self.loadedLen  = None # bytes of the file that Load could read
+        self.numRecords = 0
+        self.compacting = None # records written while compacting, to copy over
+        self.lock       = threading.Lock()
+        self.compactLock = threading.Lock()
+
+    def Load(self):
+        # Returns the live txs in the order they were added
+        if not self.path or not os.path.exists(self.path):
+            return []
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except OSError as e:
+            logger.Warning("Could not load mempool journal %s: %s", self.path, e)
+            return []
+
+        txs = {}
+        records = {}
+        numRecords = 0
+        pos = 0
+        while pos < len(data):
+            recordType = data[pos:pos + 1]
+            if recordType == RECORD_ADD and pos + ADD_RECORD_LEN <= len(data):
+                start = pos + 1
+                try:
+                    tx = transaction.DecodeTx(data[start:start + transaction.MSG_LEN])
+                except ValueError:
+                    logger.Warning("Bad tx in mempool journal %s at byte %d", self.path, pos)
+                    break
+                start += transaction.MSG_LEN
+                tx.timeAdded = utils.BytesToInt(data[start:start + TIME_BYTE_LEN])
+                txs[tx.GetHash()] = tx
+                records[tx.GetHash()] = data[pos:pos + ADD_RECORD_LEN]
+                pos += ADD_RECORD_LEN
+            elif recordType == RECORD_EVICT and pos + EVICT_RECORD_LEN <= len(data):
+                txHash = data[pos + 1:pos + EVICT_RECORD_LEN]
+                txs.pop(txHash, None)
+                records.pop(txHash, None)
+                pos += EVICT_RECORD_LEN
+            else:
+                # A torn last write, or garbage: keep what came before
+                logger.Warning("Mempool journal %s truncated at byte %d", self.path, pos)
+                break
+            numRecords += 1
+
+        with self.lock:
+            self.loaded     = OrderedDict(records)
+            self.loadedLen  = pos
+            self.numRecords = numRecords
+        return list(txs.values())
+
+    def Open(self, txs=()):
+        # Journals from here on with txs as the live ones. The loaded journal
+        # is kept and appended the difference, unless that leaves it due for
+        # compaction; then, or without one, a fresh journal is written.
+        if not self.path:
+            return False
+
+        live = OrderedDict()
+        for tx in txs:
+            record = EncodeAddRecord(tx)
+            if record:
+                live[tx.GetHash()] = record
+
+        with self.lock:
+            loaded, self.loaded = self.loaded, OrderedDict()
+            loadedLen, self.loadedLen = self.loadedLen, None
+            self.live = live
+
+        if loadedLen is None:
+            return self.Compact()
+
+        records = [RECORD_EVICT + txHash for txHash in loaded if txHash not in live]
+        records += [record for txHash, record in live.items() if loaded.get(txHash) != record]
+        self.numRecords += len(records)
+        if self.NeedsCompaction():
+            return self.Compact()
+
+        try:
+            # Drop a torn tail, so that the new records can be read back
+            f = open(self.path, 'r+b')
+            f.truncate(loadedLen)
+            f.seek(loadedLen)
+            f.write(b''.join(records))
+        except OSError as e:
+            logger.Warning("Could not open mempool journal %s: %s", self.path, e)
+            return self.Compact()
+        with self.lock:
+            self.file = f
+        journalRecordsCounter.Inc(len(records))
+        return True
+
+    def IsOpen(self):
+        return self.file is not None
+
+    def Close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+    def Flush(self):
+        with self.lock:
+            if self.file:
+                self.file.flush()
+
+    def Add(self, tx):
+        record = EncodeAddRecord(tx)
+        if not record:
+            return
+        with self.lock:
+            if self.file is None:
+                return
+            self.live[tx.GetHash()] = record
+            self._Write(record)
+
+    def Evict(self, txHashes):
+        with self.lock:
+            if self.file is None:
+                return
+            for txHash in txHashes:
+                if self.live.pop(txHash, None) is not None:
+                    self._Write(RECORD_EVICT + txHash)
+
+    def NeedsCompaction(self):
+        return (self.numRecords > COMPACT_MIN_RECORDS and
+                self.numRecords > COMPACT_RATIO * len(self.live))
+
+    def Compact(self):
+        # Rewrite with only the live adds, and rename so that a crash leaves
+        # either the old journal or the new one. The live adds are written
+        # outside the lock; records journalled meanwhile still go to the old
+        # file, and are copied over before the new one takes its place.
+        tmpPath = self.path + '.tmp'
+        with self.compactLock:
+            with self.lock:
+                records = list(self.live.values())
+                self.compacting = []
+
+            f = None
+            try:
+                f = open(tmpPath, 'wb')
+                f.write(b''.join(records))
+                with self.lock:
+                    f.write(b''.join(self.compacting))
+                    self.numRecords = len(records) + len(self.compacting)
+                    self.compacting = None
+                    oldFile, self.file = self.file, f
+            except OSError as e:
+                with self.lock:
+                    self.compacting = None
+                if f:
+                    f.close()
+                logger.Warning("Could not write mempool journal %s: %s", self.path, e)
+                return False
+
+            # Appends now go to the new file, which the rename moves into place
+            if oldFile:
+                oldFile.close()
+            try:
+                os.replace(tmpPath, self.path)
+            except OSError as e:
+                logger.Warning("Could not replace mempool journal %s: %s", self.path, e)
+                return False
+        journalCompactCounter.Inc()
+        return True
+
+    def _Write(self, record):
+        try:
+            self.file.write(record)
+        except OSError as e:
+            logger.Warning("Could not write mempool journal %s: %s", self.path, e)
+            return
+        if self.compacting is not None:
+            self.compacting.append(record)
+        self.numRecords += 1
+        journalRecordsCounter.Inc()
+
+
+def EncodeAddRecord(tx):
+    txBytes = transaction.EncodeTx(tx)
+    if not txBytes:
+        return None
+    timeAdded = tx.timeAdded if tx.timeAdded is not None else utils.GetCurrentTime()
+    return RECORD_ADD + txBytes + utils.IntToBytes(timeAdded, TIME_BYTE_LEN)
@@ -0,0 +1,60 @@
+import hashlib
+
+import utils
+
+# Binary Merkle tree over transaction hashes. A level with an odd number of
+# nodes pairs its last node with itself. Proofs are the sibling hashes from
+# the leaf up; the leaf index tells on which side each sibling goes.
+
+def HashPair(left, right):
+    return hashlib.sha256(left + right).digest()
+
+def GetLevels(leaves):
+    # [leaves, ..., [root]]
+    if not leaves:
+        return [[utils.ZeroHash()]]
+
+    levels = [list(leaves)]
+    level = levels[0]
+    while len(level) > 1:
+        if len(level) % 2:
+            level = level + [level[-1]]
+        level = [HashPair(level[i], level[i + 1]) for i in range(0, len(level), 2)]
+        levels.append(level)
+    return levels
+
+def GetRoot(leaves):
+    return GetLevels(leaves)[-1][0]
+
+def GetProof(levels, index):
+    proof = []
+    for level in levels[:-1]:
+        sibling = index ^ 1
+        proof.append(level[sibling] if sibling < len(level) else level[index])
+        index //= 2
+    return proof
+
+def VerifyProof(leaf, index, proof, root):
+    h = leaf
+    for sibling in proof:
+        if index % 2:
+            h = HashPair(sibling, h)
+        else:
+            h = HashPair(h, sibling)
+        index //= 2
+    return index == 0 and h == root
+
+def EncodeProof(proof):
+    return utils.IntToBytes(len(proof)) + b''.join(proof)
+
+def DecodeProof(proofBytes):
+    # Returns (proof, bytes used), or (None, 0) if truncated
+    if len(proofBytes) < utils.INT_BYTE_LEN:
+        return None, 0
+    n = utils.BytesToInt(proofBytes[:utils.INT_BYTE_LEN])
+    end = utils.INT_BYTE_LEN + n * utils.HASH_BYTE_LEN
+    if len(proofBytes) < end:
+        return None, 0
+    proof = [proofBytes[i:i + utils.HASH_BYTE_LEN]
+             for i in range(utils.INT_BYTE_LEN, end, utils.HASH_BYTE_LEN)]
+    return proof, end
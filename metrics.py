@@ -0,0 +1,238 @@
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+DEFAULT_HTTP_HOST = '127.0.0.1'
+
+def _LabelsKey(labels):
+    if not labels:
+        return ()
+    return tuple(sorted(labels.items()))
+
+def _EscapeLabel(value):
+    # As the Prometheus text format wants label values
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _LabelsStr(key, extra=()):
+    items = list(key) + list(extra)
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _EscapeLabel(v)) for k, v in items)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, doc=''):
+        self.name   = name
+        self.doc    = doc
+        self.values = {}
+        self.lock   = threading.Lock()
+
+    def Inc(self, amount=1, labels=None):
+        key = _LabelsKey(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def Get(self, labels=None):
+        with self.lock:
+            return self.values.get(_LabelsKey(labels), 0)
+
+    def Snapshot(self):
+        with self.lock:
+            return dict(self.values)
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def __init__(self, name, doc='', func=None):
+        super().__init__(name, doc)
+        self.funcs = {} # labels key -> func, read on demand instead of being set
+        if func is not None:
+            self.funcs[()] = func
+
+    def Set(self, value, labels=None):
+        with self.lock:
+            self.values[_LabelsKey(labels)] = value
+
+    def SetFunc(self, func, labels=None):
+        # The latest owner of these labels wins; None removes them
+        key = _LabelsKey(labels)
+        with self.lock:
+            self.values.pop(key, None)
+            if func is None:
+                self.funcs.pop(key, None)
+            else:
+                self.funcs[key] = func
+
+    def Snapshot(self):
+        with self.lock:
+            values = dict(self.values)
+            funcs = list(self.funcs.items())
+        for key, func in funcs:
+            value = func()
+            if value is not None:
+                values[key] = value
+        return values
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, doc='', buckets=LATENCY_BUCKETS):
+        self.name    = name
+        self.doc     = doc
+        self.buckets = tuple(buckets)
+        self.values  = {} # labels -> [bucketCounts, count, sum]
+        self.lock    = threading.Lock()
+
+    def Observe(self, value, labels=None):
+        key = _LabelsKey(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            v = self.values.get(key, None)
+            if v is None:
+                v = self.values[key] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            v[0][i] += 1
+            v[1] += 1
+            v[2] += value
+
+    def Time(self, labels=None):
+        return _Timer(self, labels)
+
+    def GetPercentile(self, p, labels=None):
+        # Upper bound of the bucket the percentile falls into
+        with self.lock:
+            v = self.values.get(_LabelsKey(labels), None)
+            if not v or not v[1]:
+                return None
+            target = p * v[1]
+            total = 0
+            for i, n in enumerate(v[0]):
+                total += n
+                if total >= target:
+                    return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return None
+
+    def Snapshot(self):
+        with self.lock:
+            return {k: (list(v[0]), v[1], v[2]) for k, v in self.values.items()}
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.Observe(time.perf_counter() - self.start, self.labels)
+        return False
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock    = threading.Lock()
+
+    def _Get(self, cls, name, *args, **kwargs):
+        with self.lock:
+            m = self.metrics.get(name, None)
+            if m is None:
+                m = self.metrics[name] = cls(name, *args, **kwargs)
+            elif type(m) is not cls:
+                raise ValueError("Metric %s already registered as %s" % (name, m.kind))
+            return m
+
+    def Counter(self, name, doc=''):
+        return self._Get(Counter, name, doc)
+
+    def Gauge(self, name, doc='', func=None):
+        m = self._Get(Gauge, name, doc)
+        if func is not None:
+            m.SetFunc(func)
+        return m
+
+    def Histogram(self, name, doc='', buckets=LATENCY_BUCKETS):
+        return self._Get(Histogram, name, doc, buckets)
+
+    def GetMetrics(self):
+        with self.lock:
+            return sorted(self.metrics.values(), key=lambda m: m.name)
+
+    def ToDict(self):
+        out = {}
+        for m in self.GetMetrics():
+            values = {}
+            for key, v in m.Snapshot().items():
+                labels = _LabelsStr(key)
+                if m.kind == 'histogram':
+                    bucketCounts, count, total = v
+                    values[labels] = {
+                        'count': count,
+                        'sum': total,
+                        'p50': m.GetPercentile(0.5, dict(key)),
+                        'p99': m.GetPercentile(0.99, dict(key)),
+                    }
+                else:
+                    values[labels] = v
+            out[m.name] = values
+        return out
+
+    def ToPrometheus(self):
+        lines = []
+        for m in self.GetMetrics():
+            if m.doc:
+                lines.append('# HELP %s %s' % (m.name, m.doc))
+            lines.append('# TYPE %s %s' % (m.name, m.kind))
+
+            for key, v in sorted(m.Snapshot().items()):
+                if m.kind != 'histogram':
+                    lines.append('%s%s %s' % (m.name, _LabelsStr(key), v))
+                    continue
+
+                bucketCounts, count, total = v
+                cumulative = 0
+                for bound, n in zip(m.buckets + (float('inf'),), bucketCounts):
+                    cumulative += n
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('%s_bucket%s %d' % (m.name, _LabelsStr(key, [('le', le)]), cumulative))
+                lines.append('%s_sum%s %s' % (m.name, _LabelsStr(key), total))
+                lines.append('%s_count%s %d' % (m.name, _LabelsStr(key), count))
+
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+
+### Prometheus endpoint ###
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = registry.ToPrometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def StartHttpServer(port, host=DEFAULT_HTTP_HOST):
+    httpServer = ThreadingHTTPServer((host, port), _Handler)
+    t = threading.Thread(name='Metrics', target=httpServer.serve_forever, daemon=True)
+    t.start()
+    return httpServer
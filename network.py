@@ -1,10 +1,45 @@
 import socket
 import time
 import threading
+import heapq
 import utils
+import compression
+import metrics
+import log
 
 LISTEN_SLEEP_TIME = 0.1
 CONNECTION_TIMEOUT = 0.5
+LISTEN_BACKLOG = 128 # connects queued between accepts; beyond it SYNs are dropped
+HEADER_LEN = utils.MSGTYPE_BYTE_LEN + utils.INT_BYTE_LEN # type|size
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+RECV_BUFFER_SIZE = 64 * 1024
+MAX_IDLE_RECV_BUFFER_SIZE = 16 * 1024 * 1024
+
+bytesSentCounter        = metrics.registry.Counter('net_sent_bytes_total', 'Bytes written to sockets')
+bytesReceivedCounter    = metrics.registry.Counter('net_received_bytes_total', 'Bytes read from sockets')
+messagesSentCounter     = metrics.registry.Counter('net_sent_messages_total', 'Messages sent by type')
+messagesReceivedCounter = metrics.registry.Counter('net_received_messages_total', 'Requests received by servers, by type')
+sendQueueDropsCounter   = metrics.registry.Counter('net_send_queue_drops_total', 'Queued messages dropped for slow peers')
+
+logger = log.GetLogger('network')
+
+# Optional hook called as linkShaper(sock, numBytes) before every send, used
+# by the simulator to inject latency and loss
+linkShaper = None
+
+# Outbound queues
+PRIORITY_BLOCK = 0
+PRIORITY_TX = 1
+PRIORITY_BULK = 2
+MAX_SEND_QUEUE = 64
+MAX_SEND_DELAY = 10.0 # seconds the oldest queued message may wait
+
+# Top bit of the size field flags a compressed payload: codec(1)|data
+COMPRESSED_FLAG = 1 << (utils.INT_BYTE_LEN * 8 - 1)
+CODEC_BYTE_LEN = 1
+
+# Metrics label for received messages no handler knows
+OTHER_MSG_TYPE = 'other'
 
 def GetHostname():
     return socket.gethostname()
@@ -15,8 +50,16 @@ class Message:
         self.payload = payload
 
 class Socket():
-    def __init__(self, sock=None, blocking=True):
+    def __init__(self, sock=None, blocking=True, maxFrameSize=MAX_FRAME_SIZE):
         self.sock = None
+        self.maxFrameSize = maxFrameSize
+
+        # Codec negotiated on Version; only payloads sent with compress=True use it
+        self.codec = compression.CODEC_NONE
+        self.bytesSent = 0
+
+        # Receive buffer, reused across messages and grown on demand
+        self._recvBuf = bytearray(RECV_BUFFER_SIZE)
         
         if sock:
             self.sock = sock
@@ -26,11 +69,20 @@ class Socket():
 
         self.sock.setblocking(blocking)
 
-    def Connect(self, hostname, port):
+    def _SetNoDelay(self):
+        try:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            pass
+
+    def Connect(self, hostname, port, bindAddr=None):
+        if bindAddr:
+            self.sock.bind((bindAddr, 0))
         t = self.sock.gettimeout()
         self.sock.settimeout(CONNECTION_TIMEOUT)
         self.sock.connect((hostname, port))
         self.sock.settimeout(t)
+        self._SetNoDelay()
 
     def Bind(self, hostname, port):
         self.sock.bind((hostname, port))
@@ -40,61 +92,235 @@ class Socket():
 
     def Accept(self):
         (clientSock, clientAddress) = self.sock.accept()
-        return Socket(sock=clientSock), clientAddress
+        s = Socket(sock=clientSock, maxFrameSize=self.maxFrameSize)
+        s._SetNoDelay()
+        return s, clientAddress
 
     def Close(self):
         self.sock.close()
         self.sock = None
 
+    def Shutdown(self):
+        # Unblocks other threads stuck sending or receiving on this socket
+        sock = self.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
     def IsConnected(self):
         return self.sock != None
 
-    def Send(self, msgType, payload=b''):
+    def Send(self, msgType, payload=b'', compress=False):
         if len(msgType) > utils.MSGTYPE_BYTE_LEN:
             raise ConnectionError("MsgType > %d letters: %s" % (utils.MSGTYPE_BYTE_LEN, msgType))
 
-        totalSent = 0
         payloadLen = len(payload)
-        msgLen = utils.MSGTYPE_BYTE_LEN + utils.INT_BYTE_LEN + payloadLen # type|size|payload
+        if payloadLen > self.maxFrameSize:
+            raise ConnectionError("Frame too large: %d > %d" % (payloadLen, self.maxFrameSize))
+
+        if linkShaper is not None:
+            linkShaper(self, payloadLen)
+
+        sizeField = payloadLen
+        codecByte = None
+        if (compress and self.codec != compression.CODEC_NONE and
+                payloadLen >= compression.COMPRESSION_THRESHOLD):
+            compressed = compression.Compress(self.codec, payload)
+            if len(compressed) + CODEC_BYTE_LEN < payloadLen:
+                compression.sentStats.Add(self.codec, payloadLen, len(compressed))
+                payload = compressed
+                codecByte = utils.IntToBytes(self.codec, CODEC_BYTE_LEN)
+                sizeField = (len(payload) + CODEC_BYTE_LEN) | COMPRESSED_FLAG
+
+        # type|size, sent together with the payload without joining them
+        header = msgType.ljust(utils.MSGTYPE_BYTE_LEN).encode()
+        header += utils.IntToBytes(sizeField)
+
+        if payloadLen == 0:
+            self._SendAll([header])
+        elif codecByte:
+            self._SendAll([header, codecByte, payload])
+        else:
+            self._SendAll([header, payload])
 
-        b = msgType.ljust(utils.MSGTYPE_BYTE_LEN).encode()
-        b += utils.IntToBytes(payloadLen)
-        b += payload
-        
-        while totalSent < msgLen:
-            sent = self.sock.send(b[totalSent:])
+        frameLen = HEADER_LEN + (sizeField & ~COMPRESSED_FLAG)
+        self.bytesSent += frameLen
+        bytesSentCounter.Inc(frameLen)
+        messagesSentCounter.Inc(labels={'type': msgType})
+
+    def _SendAll(self, buffers):
+        sock = self.sock
+        if sock is None:
+            raise ConnectionError("socket closed")
+
+        buffers = [memoryview(b).cast('B') for b in buffers]
+
+        if not hasattr(sock, 'sendmsg'):
+            for b in buffers:
+                sock.sendall(b)
+            return
+
+        while buffers:
+            sent = sock.sendmsg(buffers)
             if sent == 0:
                 raise ConnectionError("socket connection broken")
-            totalSent += sent
 
-    def Receive(self):
-        # Type and Size 
-        chunk = self.sock.recv(utils.MSGTYPE_BYTE_LEN + utils.INT_BYTE_LEN)
-        if chunk == b'':
-            raise ConnectionError("socket connection broken")
-        msgType = chunk[:utils.MSGTYPE_BYTE_LEN].decode().rstrip()
-        start = utils.MSGTYPE_BYTE_LEN
-        end = start + utils.INT_BYTE_LEN
-        payloadLen = utils.BytesToInt(chunk[start:end])
-
-        chunks = []
+            # Drop the fully sent buffers and trim the partially sent one
+            while buffers and sent >= len(buffers[0]):
+                sent -= len(buffers[0])
+                buffers.pop(0)
+            if buffers and sent:
+                buffers[0] = buffers[0][sent:]
+
+    def _ReceiveInto(self, size):
+        sock = self.sock
+        if sock is None:
+            raise ConnectionError("socket closed")
+
+        if len(self._recvBuf) < size:
+            self._recvBuf = bytearray(max(size, 2 * len(self._recvBuf)))
+
+        view = memoryview(self._recvBuf)
         bytesReceived = 0
-        while bytesReceived < payloadLen:
-            chunk = self.sock.recv(min(payloadLen - bytesReceived, 2048))
-            if chunk == b'':
+        while bytesReceived < size:
+            n = sock.recv_into(view[bytesReceived:size])
+            if n == 0:
                 raise ConnectionError("socket connection broken")
-            chunks.append(chunk)
-            bytesReceived = bytesReceived + len(chunk)
-        
-        payload = b''.join(chunks)
+            bytesReceived += n
+        return view[:size]
+
+    def Receive(self):
+        # Type and Size
+        header = self._ReceiveInto(HEADER_LEN)
+        msgType = bytes(header[:utils.MSGTYPE_BYTE_LEN]).decode().rstrip()
+        payloadLen = utils.BytesToInt(header[utils.MSGTYPE_BYTE_LEN:HEADER_LEN])
+        isCompressed = payloadLen & COMPRESSED_FLAG
+        payloadLen &= ~COMPRESSED_FLAG
+
+        if payloadLen > self.maxFrameSize:
+            raise ConnectionError("Frame too large: %d > %d" % (payloadLen, self.maxFrameSize))
+
+        bytesReceivedCounter.Inc(HEADER_LEN + payloadLen)
+
+        if payloadLen == 0:
+            return msgType, b''
+
+        if isCompressed:
+            data = self._ReceiveInto(payloadLen)
+            codec = data[0]
+            try:
+                payload = compression.Decompress(codec, data[CODEC_BYTE_LEN:], self.maxFrameSize)
+            except ValueError as e:
+                raise ConnectionError("Invalid compressed payload: %s" % e)
+            compression.receivedStats.Add(codec, len(payload), payloadLen - CODEC_BYTE_LEN)
+        else:
+            payload = bytes(self._ReceiveInto(payloadLen))
+
+        # Don't keep a huge buffer around after a one-off large message
+        if len(self._recvBuf) > MAX_IDLE_RECV_BUFFER_SIZE:
+            self._recvBuf = bytearray(RECV_BUFFER_SIZE)
+
         return msgType, payload
 
 
+class SendQueue:
+    def __init__(self, client, maxSize=MAX_SEND_QUEUE, maxDelay=MAX_SEND_DELAY):
+        self.client   = client
+        self.maxSize  = maxSize
+        self.maxDelay = maxDelay
+        self.items    = [] # heap of (priority, seq, timeQueued, msgType, payload, compress)
+        self.seq      = 0
+        self.cond     = threading.Condition()
+        self.thread   = None
+        self.active   = False
+        self.gen      = 0 # bumped on Stop so a stale writer exits
+        self.dropped  = 0
+
+    def __len__(self):
+        with self.cond:
+            return len(self.items)
+
+    def Put(self, msgType, payload=b'', priority=PRIORITY_BULK, compress=False):
+        stalled = False
+
+        with self.cond:
+            now = time.monotonic()
+
+            # The peer isn't draining its queue: drop it
+            if self.items and now - min(i[2] for i in self.items) > self.maxDelay:
+                stalled = True
+
+            elif len(self.items) >= self.maxSize:
+                # Make room by dropping the least important queued message
+                worst = max(self.items)
+                if worst[0] <= priority:
+                    self.dropped += 1
+                    sendQueueDropsCounter.Inc()
+                    if priority == PRIORITY_BLOCK:
+                        stalled = True
+                    else:
+                        return False
+                else:
+                    self.items.remove(worst)
+                    heapq.heapify(self.items)
+                    self.dropped += 1
+                    sendQueueDropsCounter.Inc()
+
+            if not stalled:
+                self.seq += 1
+                heapq.heappush(self.items, (priority, self.seq, now, msgType, payload, compress))
+                self._StartWriter()
+                self.cond.notify()
+                return True
+
+        logger.Warning("Send queue stalled, disconnecting: %s", self.client)
+        self.client.Disconnect()
+        return False
+
+    def Stop(self, gen=None):
+        with self.cond:
+            if gen is not None and gen != self.gen:
+                return
+            self.active = False
+            self.gen += 1
+            self.items = []
+            self.cond.notify_all()
+
+    def _StartWriter(self):
+        if self.active:
+            return
+        self.active = True
+        self.thread = threading.Thread(name='Sender_%s:%d' % (self.client.hostname, self.client.port),
+                                       target=self._Run,
+                                       args=(self.gen,),
+                                       daemon=True)
+        self.thread.start()
+
+    def _Run(self, gen):
+        while True:
+            with self.cond:
+                while self.gen == gen and not self.items:
+                    self.cond.wait()
+                if self.gen != gen:
+                    return
+                (_p, _s, _t, msgType, payload, compress) = heapq.heappop(self.items)
+
+            if not self.client.Send(msgType, payload, compress):
+                # Connection is gone, nothing else queued can be delivered
+                self.Stop(gen)
+                return
+
+
 class Client:
-    def __init__(self, hostname, port):
+    def __init__(self, hostname, port, bindAddr=None):
         self.hostname = hostname
         self.port = port
+        self.bindAddr = bindAddr # local address to connect from
         self.sock = None
+        self.sendLock = threading.Lock()
+        self.sendQueue = SendQueue(self)
 
     def __repr__(self):
         return 'Client(%s:%d)' % (self.hostname, self.port)
@@ -112,49 +338,72 @@ class Client:
 
         try:
             self.sock = Socket()
-            self.sock.Connect(self.hostname, self.port)
-            print ("Connected to %s:%d" % (self.hostname, self.port))
+            self.sock.Connect(self.hostname, self.port, self.bindAddr)
+            logger.Info("Connected to %s:%d", self.hostname, self.port)
             return True
         except (ConnectionRefusedError,
                 TimeoutError,
                 socket.timeout,
                 socket.gaierror):
             self.sock = None
-            print ("Connection refused: %s:%d" % (self.hostname, self.port))
+            logger.Info("Connection refused: %s:%d", self.hostname, self.port)
             return False
 
-    def Send(self, msgType, payload=b''):
-        if not self.IsConnected():
+    def Send(self, msgType, payload=b'', compress=False):
+        sock = self.sock
+        if sock is None:
             return False
         try:
             #print ("Sending", msgType)
-            self.sock.Send(msgType, payload)
+            with self.sendLock:
+                sock.Send(msgType, payload, compress)
             return True
         except (ConnectionError, OSError):
             self.sock = None
             return False
 
-    def Receive(self):
+    def Queue(self, msgType, payload=b'', priority=PRIORITY_BULK, compress=False):
+        # Sends asynchronously from the peer's writer thread
         if not self.IsConnected():
+            return False
+        return self.sendQueue.Put(msgType, payload, priority, compress)
+
+    def Receive(self):
+        sock = self.sock
+        if sock is None:
             return None, None
 
         try:
-            return self.sock.Receive()
+            return sock.Receive()
         except ConnectionError:
             self.sock = None
             return None, None
 
+    def Disconnect(self):
+        # Drop the connection without a goodbye, unblocking any pending send
+        sock = self.sock
+        self.sock = None
+        self.sendQueue.Stop()
+        if sock is not None and sock.sock is not None:
+            sock.Shutdown()
+            sock.Close()
+
     def Close(self):
+        self.sendQueue.Stop()
         if self.IsConnected():
             self.sock.Close()
             self.sock = None
 
 
 class Server:
-    def __init__(self, port):
+    def __init__(self, port, maxConnections=None, hostname=None):
         self.sock = None
         self.port = port
+        self.hostname = hostname # defaults to this machine's hostname
         self.active = False
+        self.maxConnections = maxConnections
+        self.profiler = None # profiling.HandlerProfiler
+        self.rateLimits = None # ratelimit.Policy
 
     def __repr__(self):
         return 'Server(%d)' % (self.port)
@@ -176,9 +425,9 @@ class Server:
     def Start(self):
         # Create, bind and listen server socket
         self.sock = Socket(blocking=False)
-        self.sock.Bind(socket.gethostname(), self.port)
-        self.sock.Listen(5)
-        print ("Listening to port", self.port)
+        self.sock.Bind(self.hostname or socket.gethostname(), self.port)
+        self.sock.Listen(LISTEN_BACKLOG)
+        logger.Info("Listening to port %d", self.port)
 
         threads = []
         self.active = True
@@ -186,6 +435,14 @@ class Server:
         while self.active:
             try:
                 (clientSock, clientAddress) = self.sock.Accept()
+
+                # Cleanup dead threads
+                threads = [t for t in threads if t.is_alive()]
+                if self.maxConnections is not None and len(threads) >= self.maxConnections:
+                    logger.Warning("Too many connections, refusing: %s", clientAddress)
+                    clientSock.Close()
+                    continue
+
                 t = self.ClientListenerThread(clientSock, clientAddress,
                                               target=self._HandleClient,
                                               args=(clientSock, clientAddress))
@@ -202,7 +459,7 @@ class Server:
         for t in threads:
             if t.is_alive():
                 if t.clientSock.IsConnected():
-                    t.clientSock.Close()
+                    t.clientSock.Shutdown()
                 t.join()
 
         # Close the listening socket
@@ -217,19 +474,48 @@ class Server:
             self.sock = None
 
     def _HandleClient(self, clientSock, clientAddress):
-        print("Accepted connection:", clientAddress)
+        logger.Info("Accepted connection: %s", clientAddress)
+        policy = self.rateLimits
+        limiter = policy.NewPeer() if policy else None
 
         while clientSock.IsConnected():
             try:
                 msgType, msg = clientSock.Receive()
 
                 # Call the methor with the name of the message type prefixed with _.
+                # Only types with a handler get their own label: the peer picks msgType
                 methodName = '_%s' % msgType
                 if msgType and hasattr(self, methodName):
-                    method = getattr(self, methodName)
-                    method(clientSock, clientAddress, msgType, msg)
+                    messagesReceivedCounter.Inc(labels={'type': msgType})
+                    if limiter and not limiter.Allow(msgType, msg):
+                        if limiter.IsAbusive():
+                            logger.Warning("Over its quotas, disconnecting: %s", clientAddress)
+                            clientSock.Shutdown()
+                            clientSock.Close()
+                            return
+                        self.SendBusy(clientSock, msgType)
+                        continue
+
+                    if policy and not policy.AcquireExpensive(msgType):
+                        self.SendBusy(clientSock, msgType)
+                        continue
+                    try:
+                        method = getattr(self, methodName)
+                        if self.profiler:
+                            self.profiler.Call(method, clientSock, clientAddress, msgType, msg)
+                        else:
+                            method(clientSock, clientAddress, msgType, msg)
+                    finally:
+                        if policy:
+                            policy.ReleaseExpensive(msgType)
                 else:
+                    messagesReceivedCounter.Inc(labels={'type': OTHER_MSG_TYPE})
                     raise RuntimeError("Server method for message type not found: %s" % msgType)
             except ConnectionError:
-                print("Disconnected", clientAddress)
+                logger.Info("Disconnected %s", clientAddress)
                 return
+
+    def SendBusy(self, clientSock, msgType):
+        # Refused request: answer so that the sender isn't left waiting
+        if self.rateLimits.GetLimit(msgType).reply:
+            clientSock.Send('Busy')
@@ -0,0 +1,7 @@
+# Network parameters shared by full nodes, light clients and tools, kept
+# apart from controller so that using them doesn't load the whole node
+
+VERSION = 2 # 2: block hashes commit to a Merkle root of the txs
+DIFFICULTY = 5 # starting difficulty, retargeted from there
+TARGET_BLOCK_TIME = 10 # seconds
+RETARGET_INTERVAL = 20 # blocks
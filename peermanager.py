@@ -0,0 +1,375 @@
+import client
+import utils
+import profiling
+import log
+
+import json
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_TARGET_OUTBOUND = 8
+DEFAULT_MAX_INBOUND = 32
+MAX_PARALLEL_DIALS = 16
+MAX_ADDRS = 1000
+RETRY_BACKOFF_TIME = 5        # doubled for each consecutive failure
+MAX_RETRY_BACKOFF_TIME = 60 * 60
+EVICTED_PEER_TIME = 10 * 60
+PEER_EXPLORATION = 0.1        # chance of picking a random peer to keep scores fresh
+
+logger = log.GetLogger('peermanager')
+
+
+class AddrEntry:
+    def __init__(self, hostname, port):
+        self.hostname    = hostname
+        self.port        = port
+        self.successes   = 0
+        self.failures    = 0 # consecutive
+        self.lastSeen    = 0
+        self.lastSuccess = 0
+        self.lastAttempt = 0
+        self.bannedUntil = 0
+
+    def __repr__(self):
+        return 'Addr{%s:%d, s:%d, f:%d}' % (self.hostname, self.port, self.successes, self.failures)
+
+    def GetScore(self, now):
+        score = min(self.successes, 10) - 2 * self.failures
+        # Recently working addresses first
+        if self.lastSuccess:
+            score += max(0, 5 - (now - self.lastSuccess) / (60 * 60))
+        return score
+
+    def CanDial(self, now):
+        if now < self.bannedUntil:
+            return False
+        backoff = min(RETRY_BACKOFF_TIME * 2 ** self.failures, MAX_RETRY_BACKOFF_TIME)
+        return self.failures == 0 or now - self.lastAttempt >= backoff
+
+    def ToDict(self):
+        return dict(self.__dict__)
+
+    @staticmethod
+    def FromDict(d):
+        e = AddrEntry(d['hostname'], int(d['port']))
+        for k, v in d.items():
+            if hasattr(e, k):
+                setattr(e, k, v)
+        return e
+
+
+class AddrBook:
+    def __init__(self, path=None):
+        self.path    = path
+        self.entries = {} # (hostname, port) -> AddrEntry
+        self.lock    = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def Load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.Warning("Could not load address book %s: %s", self.path, e)
+            return
+
+        with self.lock:
+            for d in data:
+                e = AddrEntry.FromDict(d)
+                self.entries[(e.hostname, e.port)] = e
+
+    def Save(self):
+        if not self.path:
+            return
+        with self.lock:
+            data = [e.ToDict() for e in self.entries.values()]
+
+        # Write and rename so a crash never leaves a truncated book
+        tmpPath = self.path + '.tmp'
+        try:
+            with open(tmpPath, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmpPath, self.path)
+        except OSError as e:
+            logger.Warning("Could not save address book %s: %s", self.path, e)
+
+    def Add(self, hostname, port):
+        now = utils.GetCurrentTime()
+        with self.lock:
+            e = self.entries.get((hostname, port), None)
+            if e is None:
+                e = AddrEntry(hostname, port)
+                self.entries[(hostname, port)] = e
+                self._Trim(now)
+            e.lastSeen = now
+
+    def MarkAttempt(self, hostname, port, success):
+        now = utils.GetCurrentTime()
+        with self.lock:
+            e = self.entries.get((hostname, port), None)
+            if e is None:
+                e = AddrEntry(hostname, port)
+                self.entries[(hostname, port)] = e
+            e.lastAttempt = now
+            if success:
+                e.successes += 1
+                e.failures = 0
+                e.lastSuccess = now
+            else:
+                e.failures += 1
+
+    def Ban(self, hostname, port, seconds=EVICTED_PEER_TIME):
+        with self.lock:
+            e = self.entries.get((hostname, port), None)
+            if e:
+                e.bannedUntil = utils.GetCurrentTime() + seconds
+
+    def IsBanned(self, hostname, port):
+        with self.lock:
+            e = self.entries.get((hostname, port), None)
+            return e is not None and utils.GetCurrentTime() < e.bannedUntil
+
+    def GetCandidates(self, n, exclude=()):
+        now = utils.GetCurrentTime()
+        with self.lock:
+            entries = [e for a, e in self.entries.items()
+                         if a not in exclude and e.CanDial(now)]
+        entries.sort(key=lambda e: e.GetScore(now), reverse=True)
+        return [(e.hostname, e.port) for e in entries[:n]]
+
+    def _Trim(self, now):
+        if len(self.entries) <= MAX_ADDRS:
+            return
+        worst = min(self.entries.values(), key=lambda e: e.GetScore(now))
+        del self.entries[(worst.hostname, worst.port)]
+
+
+class PeerManager:
+    def __init__(self, controller, addrBookPath=None, initialAddrs=(),
+                 targetOutbound=DEFAULT_TARGET_OUTBOUND,
+                 maxInbound=DEFAULT_MAX_INBOUND):
+        self.controller     = controller
+        self.addrBook       = AddrBook(addrBookPath)
+        self.initialAddrs   = list(initialAddrs)
+        self.targetOutbound = targetOutbound
+        self.maxInbound     = maxInbound
+        self.peers          = []
+        self.peerLock       = profiling.TimedLock()
+        self.dialing        = set() # (hostname, port) being dialed
+        self.executor       = ThreadPoolExecutor(max_workers=MAX_PARALLEL_DIALS,
+                                                 thread_name_prefix='Dial')
+        self.active         = True
+
+    def Start(self):
+        self.addrBook.Load()
+        for hostname, port in self.initialAddrs:
+            self.addrBook.Add(hostname, port)
+        self.Update()
+
+    def Stop(self):
+        self.active = False
+        self.addrBook.Save()
+        self.executor.shutdown(wait=False)
+
+        with self.peerLock:
+            peers = self.peers
+            self.peers = []
+        for peer in peers:
+            peer.Close()
+
+    def GetPeers(self):
+        with self.peerLock:
+            return list(self.peers)
+
+    def GetPeerAddrs(self):
+        with self.peerLock:
+            return [(p.hostname, p.port) for p in self.peers]
+
+    def GetNumPeers(self):
+        with self.peerLock:
+            return len(self.peers)
+
+    def HasPeer(self, hostname, port):
+        with self.peerLock:
+            return self._HasPeer(hostname, port)
+
+    def AddPeer(self, hostname, port):
+        # Connects without holding peerLock so other peer users never wait on a dial
+        if self.controller._IsMe(hostname, port) or self.addrBook.IsBanned(hostname, port):
+            return False
+
+        with self.peerLock:
+            if self._HasPeer(hostname, port) or (hostname, port) in self.dialing:
+                return False
+            self.dialing.add((hostname, port))
+
+        try:
+            peer = self._Dial(hostname, port)
+            if peer is None:
+                return False
+
+            with self.peerLock:
+                if self._HasPeer(hostname, port):
+                    added = False
+                else:
+                    self.peers.append(peer)
+                    added = True
+                    logger.Info("My Peers: %s", [(p.hostname, p.port) for p in self.peers])
+
+            if not added:
+                peer.Close()
+            return added
+        finally:
+            with self.peerLock:
+                self.dialing.discard((hostname, port))
+
+    def AddPeerAsync(self, hostname, port):
+        self.addrBook.Add(hostname, port)
+        if self.GetNumPeers() < self.targetOutbound:
+            try:
+                self.executor.submit(self.AddPeer, hostname, port)
+            except RuntimeError:
+                pass # shutting down
+
+    def RemovePeer(self, hostname, port):
+        with self.peerLock:
+            logger.Info("Removing peer: %s:%d", hostname, port)
+            self.peers = [c for c in self.peers if not (c.hostname == hostname and c.port == port)]
+
+    def GetBestPeer(self, minHeight=0):
+        with self.peerLock:
+            peers = [p for p in self.peers if p.IsConnected()]
+        if not peers:
+            return None
+
+        # Unmeasured peers go first so that every peer gets a score
+        unmeasured = [p for p in peers if not p.stats.IsMeasured()]
+        if unmeasured:
+            return random.choice(unmeasured)
+
+        if random.random() < PEER_EXPLORATION:
+            return random.choice(peers)
+
+        # Prefer peers that advertised a higher chain than minHeight
+        ahead = [p for p in peers if p.stats.height > minHeight]
+        return max(ahead or peers, key=lambda p: p.stats.GetScore())
+
+    def Update(self):
+        if not self.active:
+            return
+
+        self._SanitizePeers()
+
+        # Learn new addresses from all peers at once
+        peers = self.GetPeers()
+        if peers and self.GetNumPeers() < self.targetOutbound:
+            try:
+                results = list(self.executor.map(lambda p: p.GetAddrs(), peers))
+            except RuntimeError:
+                return # shutting down
+            for addrs in results:
+                for hostname, port in addrs:
+                    self.addrBook.Add(hostname, port)
+
+        self._DialCandidates()
+        self.addrBook.Save()
+
+    def _DialCandidates(self):
+        missing = self.targetOutbound - self.GetNumPeers()
+        if missing <= 0:
+            return
+
+        with self.peerLock:
+            exclude = set((p.hostname, p.port) for p in self.peers) | self.dialing
+
+        # Over-dial a little: some candidates will be gone
+        candidates = self.addrBook.GetCandidates(missing * 2, exclude)
+        if not candidates and not self.peers:
+            candidates = [a for a in self.initialAddrs if a not in exclude]
+
+        try:
+            futures = [self.executor.submit(self.AddPeer, hostname, port)
+                       for hostname, port in candidates]
+        except RuntimeError:
+            return # shutting down
+        for f in futures:
+            f.result()
+
+        # Trim any extra connections made by over-dialing
+        with self.peerLock:
+            extra = self.peers[self.targetOutbound:]
+            self.peers = self.peers[:self.targetOutbound]
+        for peer in extra:
+            peer.Close()
+
+    def _Dial(self, hostname, port):
+        peer = client.Client(hostname, port, self.controller)
+        if not peer.Connect():
+            self.addrBook.MarkAttempt(hostname, port, False)
+            return None
+
+        # Validate version
+        peerVersion = peer.Version()
+        if peerVersion and self.controller.ValidateVersion(peerVersion):
+            self.addrBook.MarkAttempt(hostname, port, True)
+            return peer
+
+        peer.Close()
+        self.addrBook.MarkAttempt(hostname, port, False)
+        logger.Warning("Invalid peer version: %s", peerVersion)
+        return None
+
+    def _SanitizePeers(self):
+        peers = self.GetPeers()
+        dropped = []
+
+        # Reconnect all at once, like dials, so a slow peer doesn't hold up the rest
+        disconnected = [p for p in peers if not p.IsConnected()]
+        try:
+            futures = [self.executor.submit(self._Reconnect, peer) for peer in disconnected]
+        except RuntimeError:
+            return # shutting down
+        for peer, f in zip(disconnected, futures):
+            if not f.result() and peer.failedAttempts > 3:
+                logger.Info("Dropping peer: %s", peer)
+                dropped.append(peer)
+
+        # Evict slow peers so they get replaced by better candidates
+        for peer in peers:
+            if peer in dropped:
+                continue
+            if peer.stats.IsChronicallySlow() and len(peers) - len(dropped) > 1:
+                logger.Info("Evicting slow peer: %s %s", peer, peer.stats)
+                self.addrBook.Ban(peer.hostname, peer.port)
+                peer.Close()
+                dropped.append(peer)
+
+        if dropped:
+            with self.peerLock:
+                self.peers = [p for p in self.peers if p not in dropped]
+
+    def _Reconnect(self, peer):
+        # A new connection starts without a codec: redo the handshake. Only a
+        # completed one clears the peer's failed attempts.
+        success = peer.Connect()
+        if success and not self.controller.ValidateVersion(peer.Version()):
+            peer.Disconnect()
+            peer.failedAttempts += 1
+            success = False
+        if success:
+            peer.failedAttempts = 0
+        self.addrBook.MarkAttempt(peer.hostname, peer.port, success)
+        return success
+
+    def _HasPeer(self, hostname, port):
+        for peer in self.peers:
+            if peer.hostname == hostname and peer.port == port:
+                return True
+        return False
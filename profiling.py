@@ -0,0 +1,210 @@
+import cProfile
+import collections
+import io
+import os
+import pstats
+import random
+import threading
+import time
+
+DEFAULT_SAMPLE_RATE = 0.01    # fraction of handler calls run under cProfile
+DEFAULT_SLOW_THRESHOLD = 0.25 # seconds
+SLOW_LOG_SIZE = 50
+PROFILE_NUM_LINES = 25
+
+# Set PROFILE_HANDLERS=<sample rate> to enable at startup
+ENV_VAR = 'PROFILE_HANDLERS'
+
+### Lock wait accounting ###
+
+_local = threading.local()
+_lockTiming = False # only pay for timing while a profiler is enabled
+_numEnabled = 0     # enabled profilers
+_enabledLock = threading.Lock()
+_profileLock = threading.Lock()
+
+def _SetEnabled(enabled):
+    # Counts profilers in and out, so one being disabled leaves lock timing
+    # on for the others
+    global _lockTiming, _numEnabled
+    with _enabledLock:
+        _numEnabled += 1 if enabled else -1
+        _lockTiming = _numEnabled > 0
+
+def GetLockWait():
+    return getattr(_local, 'lockWait', 0.0)
+
+class TimedLock:
+    # Drop-in for threading.Lock that adds time spent waiting to the calling thread
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def acquire(self, blocking=True, timeout=-1):
+        if not _lockTiming:
+            return self.lock.acquire(blocking, timeout)
+
+        start = time.perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        _local.lockWait = GetLockWait() + time.perf_counter() - start
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+
+### Handler profiling ###
+
+class HandlerStats:
+    def __init__(self):
+        self.count    = 0
+        self.wall     = 0.0
+        self.maxWall  = 0.0
+        self.cpu      = 0.0
+        self.lockWait = 0.0
+        self.bytesIn  = 0
+        self.bytesOut = 0
+
+    def ToDict(self):
+        n = max(self.count, 1)
+        return {
+            'count': self.count,
+            'wallTotal': self.wall,
+            'wallAvg': self.wall / n,
+            'wallMax': self.maxWall,
+            'cpuTotal': self.cpu,
+            'cpuAvg': self.cpu / n,
+            'lockWaitTotal': self.lockWait,
+            'bytesIn': self.bytesIn,
+            'bytesOut': self.bytesOut,
+        }
+
+
+class HandlerProfiler:
+    def __init__(self, sampleRate=DEFAULT_SAMPLE_RATE, slowThreshold=DEFAULT_SLOW_THRESHOLD):
+        self.enabled       = False
+        self.sampleRate    = sampleRate
+        self.slowThreshold = slowThreshold
+        self.stats         = {} # msgType -> HandlerStats
+        self.slow          = collections.deque(maxlen=SLOW_LOG_SIZE)
+        self.lock          = threading.Lock()
+
+    def Enable(self, sampleRate=None, slowThreshold=None):
+        if sampleRate is not None:
+            self.sampleRate = sampleRate
+        if slowThreshold is not None:
+            self.slowThreshold = slowThreshold
+        with self.lock:
+            if self.enabled:
+                return
+            self.enabled = True
+        _SetEnabled(True)
+
+    def Disable(self):
+        with self.lock:
+            if not self.enabled:
+                return
+            self.enabled = False
+        _SetEnabled(False)
+
+    def Reset(self):
+        with self.lock:
+            self.stats = {}
+            self.slow.clear()
+
+    def Call(self, method, clientSock, clientAddress, msgType, msg):
+        if not self.enabled:
+            return method(clientSock, clientAddress, msgType, msg)
+
+        # One capture at a time: cProfile can't always run in two threads at once
+        profile = None
+        if random.random() < self.sampleRate and _profileLock.acquire(blocking=False):
+            profile = cProfile.Profile()
+
+        lockWait = GetLockWait()
+        bytesOut = clientSock.bytesSent
+        cpu = time.thread_time()
+        wall = time.perf_counter()
+        try:
+            if profile:
+                return profile.runcall(method, clientSock, clientAddress, msgType, msg)
+            return method(clientSock, clientAddress, msgType, msg)
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.thread_time() - cpu
+            lockWait = GetLockWait() - lockWait
+            bytesIn = len(msg) if msg else 0
+            bytesOut = clientSock.bytesSent - bytesOut
+            if profile:
+                _profileLock.release()
+            self._Record(msgType, clientAddress, wall, cpu, lockWait, bytesIn, bytesOut, profile)
+
+    def _Record(self, msgType, clientAddress, wall, cpu, lockWait, bytesIn, bytesOut, profile):
+        with self.lock:
+            s = self.stats.get(msgType, None)
+            if s is None:
+                s = self.stats[msgType] = HandlerStats()
+            s.count += 1
+            s.wall += wall
+            s.maxWall = max(s.maxWall, wall)
+            s.cpu += cpu
+            s.lockWait += lockWait
+            s.bytesIn += bytesIn
+            s.bytesOut += bytesOut
+
+        if wall < self.slowThreshold:
+            return
+
+        record = {
+            'msgType': msgType,
+            'peer': '%s:%d' % clientAddress[:2],
+            'time': time.time(),
+            'wall': wall,
+            'cpu': cpu,
+            'lockWait': lockWait,
+            'bytesIn': bytesIn,
+            'bytesOut': bytesOut,
+        }
+        if profile:
+            out = io.StringIO()
+            pstats.Stats(profile, stream=out).sort_stats('cumulative').print_stats(PROFILE_NUM_LINES)
+            record['profile'] = out.getvalue()
+
+        with self.lock:
+            self.slow.append(record)
+
+    def GetStats(self):
+        with self.lock:
+            return {t: s.ToDict() for t, s in self.stats.items()}
+
+    def GetSlowest(self, n=SLOW_LOG_SIZE):
+        with self.lock:
+            slow = list(self.slow)
+        slow.sort(key=lambda r: r['wall'], reverse=True)
+        return slow[:n]
+
+    def Dump(self):
+        return {
+            'enabled': self.enabled,
+            'sampleRate': self.sampleRate,
+            'slowThreshold': self.slowThreshold,
+            'handlers': self.GetStats(),
+            'slowest': self.GetSlowest(),
+        }
+
+def ProfilerFromEnv():
+    profiler = HandlerProfiler()
+    sampleRate = os.environ.get(ENV_VAR, None)
+    if sampleRate:
+        profiler.Enable(float(sampleRate))
+    return profiler
@@ -0,0 +1,118 @@
+import metrics
+
+import threading
+import time
+
+# Per-connection quotas for the messages a server handles. Each connection
+# gets a token bucket per message type, refilled at the type's rate and
+# charged its cost. Expensive handlers also share a global concurrency cap.
+# A connection that keeps going over its quotas is disconnected.
+
+DEFAULT_RATE = 50.0  # cost units per second, for types without a Limit
+DEFAULT_BURST = 200.0
+MAX_EXPENSIVE = 4    # expensive handlers running at once, across connections
+EXPENSIVE_WAIT_TIME = 2.0
+MAX_VIOLATIONS = 20  # refused messages a connection may burst...
+VIOLATION_RATE = 0.2 # ...and how fast they're forgiven, per second
+
+throttledCounter   = metrics.registry.Counter('ratelimit_throttled_total', 'Messages refused by type')
+disconnectsCounter = metrics.registry.Counter('ratelimit_disconnects_total', 'Connections dropped for going over their quotas')
+expensiveGauge     = metrics.registry.Gauge('ratelimit_expensive_running', 'Expensive handlers running')
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate   = rate
+        self.burst  = burst
+        self.tokens = burst
+        self.last   = time.monotonic()
+
+    def Take(self, cost=1):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+        # A request bigger than the burst goes through on a full bucket and
+        # leaves it in debt, so it's still served, just not often
+        if self.tokens < min(cost, self.burst):
+            return False
+        self.tokens -= cost
+        return True
+
+
+class Limit:
+    def __init__(self, rate, burst, cost=None, expensive=False, reply=True):
+        self.rate      = rate
+        self.burst     = burst
+        self.cost      = cost      # msg -> cost units, 1 if None
+        self.expensive = expensive # takes one of the policy's expensive slots
+        self.reply     = reply     # the sender waits for an answer
+
+
+class Policy:
+    # Shared by all the connections of a server
+    def __init__(self, limits, maxExpensive=MAX_EXPENSIVE,
+                 maxViolations=MAX_VIOLATIONS, violationRate=VIOLATION_RATE):
+        self.limits        = limits # msgType -> Limit
+        self.defaultLimit  = Limit(DEFAULT_RATE, DEFAULT_BURST)
+        self.maxViolations = maxViolations
+        self.violationRate = violationRate
+        self.expensive     = threading.BoundedSemaphore(maxExpensive)
+        self.numExpensive  = 0
+        self.lock          = threading.Lock()
+
+    def GetLimit(self, msgType):
+        return self.limits.get(msgType, self.defaultLimit)
+
+    def NewPeer(self):
+        return PeerLimiter(self)
+
+    def AcquireExpensive(self, msgType):
+        if not self.GetLimit(msgType).expensive:
+            return True
+        if not self.expensive.acquire(timeout=EXPENSIVE_WAIT_TIME):
+            return False
+        with self.lock:
+            self.numExpensive += 1
+            expensiveGauge.Set(self.numExpensive)
+        return True
+
+    def ReleaseExpensive(self, msgType):
+        if not self.GetLimit(msgType).expensive:
+            return
+        with self.lock:
+            self.numExpensive -= 1
+            expensiveGauge.Set(self.numExpensive)
+        self.expensive.release()
+
+
+class PeerLimiter:
+    # One per connection, used only by its handler thread
+    def __init__(self, policy):
+        self.policy     = policy
+        self.buckets    = {} # msgType -> TokenBucket
+        self.violations = TokenBucket(policy.violationRate, policy.maxViolations)
+        self.abusive    = False
+
+    def Allow(self, msgType, msg):
+        limit = self.policy.GetLimit(msgType)
+        bucket = self.buckets.get(msgType, None)
+        if bucket is None:
+            bucket = self.buckets[msgType] = TokenBucket(limit.rate, limit.burst)
+
+        cost = limit.cost(msg) if limit.cost else 1
+        if bucket.Take(cost):
+            return True
+
+        throttledCounter.Inc(labels={'type': msgType})
+        self.Violation()
+        return False
+
+    def Violation(self):
+        if not self.violations.Take():
+            if not self.abusive:
+                disconnectsCounter.Inc()
+            self.abusive = True
+
+    def IsAbusive(self):
+        return self.abusive
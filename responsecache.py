@@ -0,0 +1,116 @@
+import block
+import transaction
+import utils
+import metrics
+
+import threading
+from collections import OrderedDict
+
+# Encoded replies for the peer queries that get asked over and over. Blocks
+# never change once added, so their encoding is kept by hash. The hash list
+# of the best chain is kept for the current tip and the mempool message for
+# the current mempool generation; both are rebuilt from the previous one.
+
+MAX_ENCODED_BLOCK_BYTES = 32 * 1024 * 1024
+
+cacheHitsCounter   = metrics.registry.Counter('response_cache_hits_total', 'Peer replies served from a cache')
+cacheMissesCounter = metrics.registry.Counter('response_cache_misses_total', 'Peer replies that had to be encoded')
+
+
+class EncodedBlockCache:
+    # LRU of EncodeBlock output, bounded in bytes
+    def __init__(self, maxBytes=MAX_ENCODED_BLOCK_BYTES):
+        self.maxBytes = maxBytes
+        self.size     = 0
+        self.blocks   = OrderedDict() # hash -> encoded block, oldest first
+        self.lock     = threading.Lock()
+
+    def Get(self, b):
+        hash = b.GetHash()
+        with self.lock:
+            blBytes = self.blocks.get(hash, None)
+            if blBytes is not None:
+                self.blocks.move_to_end(hash)
+                cacheHitsCounter.Inc(labels={'cache': 'block'})
+                return blBytes
+
+        blBytes = block.EncodeBlock(b)
+        cacheMissesCounter.Inc(labels={'cache': 'block'})
+        if blBytes is None or len(blBytes) > self.maxBytes:
+            return blBytes
+
+        with self.lock:
+            if hash not in self.blocks:
+                self.blocks[hash] = blBytes
+                self.size += len(blBytes)
+                while self.size > self.maxBytes:
+                    _, old = self.blocks.popitem(last=False)
+                    self.size -= len(old)
+        return blBytes
+
+
+class ChainHashesCache:
+    # The best chain's hashes, oldest first, for the tip they were built at
+    def __init__(self):
+        self.tipHash = None
+        self.height  = 0
+        self.hashes  = b''
+        self.lock    = threading.Lock()
+
+    def Get(self, snapshot):
+        # Returns (height, hashes)
+        with self.lock:
+            tipHash = snapshot.GetTipHash()
+            if tipHash == self.tipHash:
+                cacheHitsCounter.Inc(labels={'cache': 'hashes'})
+                return self.height, self.hashes
+
+            bestChain = snapshot.bestChain
+            height = snapshot.height
+            if (self.tipHash is not None and self.height <= height and
+                    bestChain[self.height - 1] == self.tipHash):
+                # Same chain, longer: only the new hashes are added
+                hashes = self.hashes + b''.join(bestChain[self.height:height])
+            else:
+                hashes = b''.join(bestChain[:height])
+            cacheMissesCounter.Inc(labels={'cache': 'hashes'})
+
+            self.tipHash = tipHash
+            self.height  = height
+            self.hashes  = hashes
+            return height, hashes
+
+
+class MempoolCache:
+    # The Mempool message for a mempool generation. Txs keep their encoding
+    # between generations, so only the new ones get encoded.
+    def __init__(self):
+        self.generation = None
+        self.msg        = None
+        self.encoded    = {} # tx hash -> encoded tx
+        self.lock       = threading.Lock()
+
+    def Get(self, bc):
+        with self.lock:
+            if self.generation == bc.mempoolGeneration:
+                cacheHitsCounter.Inc(labels={'cache': 'mempool'})
+                return self.msg
+
+            with bc.mempoolLock:
+                generation = bc.mempoolGeneration
+                txs = list(bc.mempool.items())
+
+            encoded = {}
+            for txHash, tx in txs:
+                txBytes = self.encoded.get(txHash, None)
+                if txBytes is None:
+                    txBytes = transaction.EncodeTx(tx)
+                    if not txBytes:
+                        continue
+                encoded[txHash] = txBytes
+            cacheMissesCounter.Inc(labels={'cache': 'mempool'})
+
+            self.generation = generation
+            self.encoded    = encoded
+            self.msg        = utils.IntToBytes(len(encoded)) + b''.join(encoded.values())
+            return self.msg
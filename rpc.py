@@ -3,6 +3,13 @@ import utils
 import network
 import transaction
 import random
+import json
+import math
+import metrics
+import blockchain
+
+MAX_BATCH_TXS = 10000
+MAX_HISTORY_PAGE = 1000
 
 class RPCServer(network.Server):
     def __init__(self, port, controller):
@@ -16,11 +23,38 @@ class RPCServer(network.Server):
     def _AddTx(self, clientSock, clientAddress, msgType, msg):
         tx = transaction.DecodeTx(msg)
 
-        if self.controller.blockchain.AddTransaction(tx):
+        status = self.controller.admission.AdmitOne(tx)
+        if status in (blockchain.TX_OK, blockchain.TX_DUPLICATE):
             clientSock.Send('TxOK')
+        elif status == blockchain.TX_BUSY:
+            clientSock.Send('TxBUSY')
         else:
             clientSock.Send('TxNO')
 
+    def _AddTxs(self, clientSock, clientAddress, msgType, msg):
+        # Count followed by that many encoded txs; the reply has one TX_* status byte per tx
+        numTxs = utils.BytesToInt(msg[:utils.INT_BYTE_LEN])
+        body = msg[utils.INT_BYTE_LEN:]
+        if numTxs > MAX_BATCH_TXS or len(body) != numTxs * transaction.MSG_LEN:
+            clientSock.Send('TxsNO')
+            return
+
+        statuses = [blockchain.TX_MALFORMED] * numTxs
+        txs = []
+        indices = []
+        for i in range(numTxs):
+            start = i * transaction.MSG_LEN
+            try:
+                txs.append(transaction.DecodeTx(body[start:start + transaction.MSG_LEN]))
+                indices.append(i)
+            except ValueError:
+                pass
+
+        for i, status in zip(indices, self.controller.admission.Admit(txs)):
+            statuses[i] = status
+
+        clientSock.Send('TxsStatus', bytes(statuses))
+
     def _GetBalance(self, clientSock, clientAddress, msgType, msg):
         addr = msg[:256]
         balance = self.controller.blockchain.GetBalance(addr)
@@ -29,6 +63,72 @@ class RPCServer(network.Server):
         else:
             clientSock.Send('NoBalance')
 
+    def _GetAddrHist(self, clientSock, clientAddress, msgType, msg):
+        # addr, start, limit -> count, then (height, blockHash, txPos, tx) per entry
+        addr = msg[:utils.ADDR_BYTE_LEN]
+        pos = utils.ADDR_BYTE_LEN
+        start = utils.BytesToInt(msg[pos:pos + utils.INT_BYTE_LEN])
+        pos += utils.INT_BYTE_LEN
+        limit = min(utils.BytesToInt(msg[pos:pos + utils.INT_BYTE_LEN]), MAX_HISTORY_PAGE)
+
+        history = self.controller.blockchain.GetAddressHistory(addr, start, limit)
+        if history is None:
+            clientSock.Send('NoAddrHist')
+            return
+
+        out = [utils.IntToBytes(len(history))]
+        for height, blockHash, txPos, tx in history:
+            out.append(utils.IntToBytes(height))
+            out.append(blockHash)
+            out.append(utils.IntToBytes(txPos))
+            out.append(transaction.EncodeTx(tx))
+        clientSock.Send('AddrHist', b''.join(out), compress=True)
+
+    def _Profile(self, clientSock, clientAddress, msgType, msg):
+        # {"enable": bool, "sampleRate": float, "slowThreshold": float, "reset": bool}
+        try:
+            options = json.loads(msg) if msg else {}
+        except ValueError:
+            clientSock.Send('ProfileNO')
+            return
+        if not _ValidProfileOptions(options):
+            clientSock.Send('ProfileNO')
+            return
+
+        profiler = self.controller.profiler
+        if options.get('reset', False):
+            profiler.Reset()
+        if 'enable' in options:
+            if options['enable']:
+                profiler.Enable(options.get('sampleRate', None),
+                                options.get('slowThreshold', None))
+            else:
+                profiler.Disable()
+
+        clientSock.Send('Profile', json.dumps(profiler.Dump()).encode(), compress=True)
+
+    def _GetMetrics(self, clientSock, clientAddress, msgType, msg):
+        # JSON by default, Prometheus text if asked for
+        if msg == b'prometheus':
+            out = metrics.registry.ToPrometheus()
+        else:
+            out = json.dumps(metrics.registry.ToDict())
+        clientSock.Send('Metrics', out.encode(), compress=True)
+
+
+def _ValidProfileOptions(options):
+    if not isinstance(options, dict):
+        return False
+    for key in ('sampleRate', 'slowThreshold'):
+        value = options.get(key, None)
+        if value is None:
+            continue
+        # bool is an int, but not a rate
+        if (isinstance(value, bool) or not isinstance(value, (int, float)) or
+                not math.isfinite(value) or value < 0):
+            return False
+    return True
+
 
 class RPCClient(network.Client):
 
@@ -40,10 +140,28 @@ class RPCClient(network.Client):
         return None
 
     def AddTx(self, tx):
-        self.Send('AddTx', transaction.EncodeTx(tx))
+        return self.AddEncodedTx(transaction.EncodeTx(tx))
+
+    def AddEncodedTx(self, txBytes):
+        self.Send('AddTx', txBytes)
         msgType, _msg = self.Receive()
         return msgType == 'TxOK'
 
+    def AddTxs(self, txs):
+        return self.AddEncodedTxs([transaction.EncodeTx(tx) for tx in txs])
+
+    def AddEncodedTxs(self, txsBytes):
+        # Returns a blockchain.TX_* status per tx, or None if the batch was refused
+        statuses = []
+        for start in range(0, len(txsBytes), MAX_BATCH_TXS):
+            batch = txsBytes[start:start + MAX_BATCH_TXS]
+            self.Send('AddTxs', utils.IntToBytes(len(batch)) + b''.join(batch))
+            msgType, msg = self.Receive()
+            if msgType != 'TxsStatus' or len(msg) != len(batch):
+                return None
+            statuses.extend(msg)
+        return statuses
+
     def GetBalance(self, addrStr):
         addr = utils.AddrStrToBytes(addrStr)
         self.Send('GetBalance', addr)
@@ -52,10 +170,51 @@ class RPCClient(network.Client):
             return utils.BytesToInt(msg[0:utils.INT_BYTE_LEN])
         return None
 
+    def GetAddressHistory(self, addrStr, start=0, limit=100):
+        # Newest first: [(height, blockHash, txPos, tx)]
+        addr = utils.AddrStrToBytes(addrStr)
+        self.Send('GetAddrHist', addr + utils.IntToBytes(start) + utils.IntToBytes(limit))
+        msgType, msg = self.Receive()
+        if msgType != 'AddrHist':
+            return None
+
+        history = []
+        numEntries = utils.BytesToInt(msg[:utils.INT_BYTE_LEN])
+        pos = utils.INT_BYTE_LEN
+        for _ in range(numEntries):
+            height = utils.BytesToInt(msg[pos:pos + utils.INT_BYTE_LEN])
+            pos += utils.INT_BYTE_LEN
+            blockHash = msg[pos:pos + utils.HASH_BYTE_LEN]
+            pos += utils.HASH_BYTE_LEN
+            txPos = utils.BytesToInt(msg[pos:pos + utils.INT_BYTE_LEN])
+            pos += utils.INT_BYTE_LEN
+            tx = transaction.DecodeTx(msg[pos:pos + transaction.MSG_LEN])
+            pos += transaction.MSG_LEN
+            history.append((height, blockHash, txPos, tx))
+        return history
+
+    def Profile(self, **options):
+        self.Send('Profile', json.dumps(options).encode())
+        msgType, msg = self.Receive()
+        if msgType != 'Profile':
+            return None
+        return json.loads(msg)
+
+    def GetMetrics(self, prometheus=False):
+        self.Send('GetMetrics', b'prometheus' if prometheus else b'')
+        msgType, msg = self.Receive()
+        if msgType != 'Metrics':
+            return None
+        if prometheus:
+            return msg.decode()
+        return json.loads(msg)
+
 
 
 def Usage(extraCmds = ""):
-    print ("Usage: rpc.py [genkeys] | [version,tx,randomtxs,badtx] HOSTNAME PORT | [balance] HOSTNAME PORT ADDR")
+    print ("Usage: rpc.py [genkeys] | [version,tx,randomtxs,badtx,metrics,prometheus] HOSTNAME PORT | [balance] HOSTNAME PORT ADDR")
+    print ("     | rpc.py history HOSTNAME PORT ADDR [START [LIMIT]]")
+    print ("     | rpc.py profile HOSTNAME PORT [on [SAMPLE_RATE [SLOW_SECONDS]] | off | reset | dump]")
 
 if __name__ == '__main__':
 
@@ -134,6 +293,39 @@ if __name__ == '__main__':
             tx.Sign(privateKey)
             print('Bad TX:', client.AddTx(tx))
 
+        elif msgType == "metrics":
+            print(json.dumps(client.GetMetrics(), indent=2, sort_keys=True))
+
+        elif msgType == "prometheus":
+            print(client.GetMetrics(prometheus=True))
+
+        elif msgType == "profile":
+            action = sys.argv[4] if numArgs > 4 else 'dump'
+            options = {}
+            if action == 'on':
+                options['enable'] = True
+                if numArgs > 5: options['sampleRate'] = float(sys.argv[5])
+                if numArgs > 6: options['slowThreshold'] = float(sys.argv[6])
+            elif action == 'off':
+                options['enable'] = False
+            elif action == 'reset':
+                options['reset'] = True
+            print(json.dumps(client.Profile(**options), indent=2))
+
+        elif msgType == "history":
+            if numArgs < 5:
+                Usage()
+                sys.exit(1)
+
+            start = int(sys.argv[5]) if numArgs > 5 else 0
+            limit = int(sys.argv[6]) if numArgs > 6 else 100
+            history = client.GetAddressHistory(sys.argv[4], start, limit)
+            if history is None:
+                print('No address index on this node')
+            else:
+                for height, blockHash, txPos, tx in history:
+                    print('%6d %s %3d %s' % (height, blockHash.hex(), txPos, tx))
+
         elif msgType == "balance":
             if numArgs < 5:
                 Usage()
@@ -0,0 +1,96 @@
+import threading
+import time
+import traceback
+
+import log
+
+logger = log.GetLogger('scheduler')
+
+
+class Task:
+    def __init__(self, name, target, interval=None, runAtStart=False):
+        self.name     = name
+        self.target   = target
+        self.interval = interval # None: only runs when triggered
+        self.event    = threading.Event()
+        self.thread   = None
+        self.numRuns  = 0
+        self.lastRun  = None
+
+        if runAtStart:
+            self.event.set()
+
+    def __repr__(self):
+        return 'Task(%s)' % self.name
+
+
+class Scheduler:
+    # Runs each task in its own worker so that a slow task never delays the
+    # others. A task runs every interval seconds and as soon as it's triggered;
+    # triggers that arrive while it's running coalesce into one more run.
+    def __init__(self):
+        self.tasks  = {}
+        self.active = False
+        self.lock   = threading.Lock()
+
+    def AddTask(self, name, target, interval=None, runAtStart=False):
+        with self.lock:
+            if name in self.tasks:
+                raise ValueError("Task already added: %s" % name)
+            task = Task(name, target, interval, runAtStart)
+            self.tasks[name] = task
+            if self.active:
+                self._StartTask(task)
+        return task
+
+    def Trigger(self, name):
+        task = self.tasks.get(name, None)
+        if task is None:
+            raise ValueError("Unknown task: %s" % name)
+        task.event.set()
+
+    def Start(self):
+        with self.lock:
+            if self.active:
+                return
+            self.active = True
+            for task in self.tasks.values():
+                self._StartTask(task)
+
+    def Stop(self, timeout=None):
+        with self.lock:
+            self.active = False
+            tasks = list(self.tasks.values())
+
+        # Wake every worker so it sees it has to stop
+        for task in tasks:
+            task.event.set()
+
+        for task in tasks:
+            if task.thread and task.thread is not threading.current_thread():
+                task.thread.join(timeout)
+
+    def IsRunning(self):
+        return self.active
+
+    def _StartTask(self, task):
+        task.thread = threading.Thread(name='Task_%s' % task.name,
+                                       target=self._Run,
+                                       args=(task,),
+                                       daemon=True)
+        task.thread.start()
+
+    def _Run(self, task):
+        while self.active:
+            task.event.wait(task.interval)
+            if not self.active:
+                return
+            task.event.clear()
+
+            try:
+                task.target()
+            except Exception:
+                logger.Error("Task %s failed:\n%s", task.name, traceback.format_exc())
+
+            task.numRuns += 1
+            task.lastRun = time.monotonic()
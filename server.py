@@ -3,11 +3,43 @@ import transaction
 
 import utils
 import network
+import compression
+import merkle
+import responsecache
+import ratelimit
+
+MAX_HEADERS_PER_MSG = 2000
+MAX_BLOCKS_PER_MSG = 500
+MAX_PROOFS_PER_MSG = 1000
+
+def _NumHashesCost(msg):
+    return max(1, utils.BytesToInt(msg[:utils.INT_BYTE_LEN])) if msg else 1
+
+# Quotas per peer connection: rate and burst in cost units
+PEER_LIMITS = {
+    'Version':      ratelimit.Limit(1, 5),
+    'Codecs':       ratelimit.Limit(1, 5),
+    'GetAddrs':     ratelimit.Limit(1, 10),
+    'GetMempool':   ratelimit.Limit(2, 10, expensive=True),
+    'AddBlock':     ratelimit.Limit(20, 200, reply=False),
+    'SyncBlocks':   ratelimit.Limit(1, 10, expensive=True),
+    'GetBlocks':    ratelimit.Limit(500, 5000, cost=_NumHashesCost, expensive=True),
+    'GetHeaders':   ratelimit.Limit(5, 20, expensive=True),
+    'GetAddrProof': ratelimit.Limit(5, 20, expensive=True),
+    'Close':        ratelimit.Limit(1, 5, reply=False),
+    'Stop':         ratelimit.Limit(1, 5),
+}
 
 class Server(network.Server):
-    def __init__(self, port, controller):
-        super().__init__(port)
+    def __init__(self, port, controller, maxConnections=None, hostname=None):
+        super().__init__(port, maxConnections, hostname)
         self.controller = controller
+        self.rateLimits = ratelimit.Policy(PEER_LIMITS)
+
+        # Encoded replies shared by all the connections
+        self.blockCache   = responsecache.EncodedBlockCache()
+        self.hashesCache  = responsecache.ChainHashesCache()
+        self.mempoolCache = responsecache.MempoolCache()
 
     ### Message Methods ###
 
@@ -15,22 +47,34 @@ class Server(network.Server):
         peerVersion = utils.BytesToInt(msg)
         if self.controller.ValidateVersion(peerVersion):
             version = self.controller.GetVersion()
-            clientSock.Send('VersionOK', utils.IntToBytes(version))
+            outMsg = utils.IntToBytes(version)
+            clientSock.Send('VersionOK', outMsg)
         else:
             clientSock.Send('VersionNO')
 
+    def _Codecs(self, clientSock, clientAddress, msgType, msg):
+        if not msg or len(msg) != network.CODEC_BYTE_LEN:
+            clientSock.Send('CodecsNO')
+            return
+
+        codec = compression.Negotiate(msg[0], self.controller.codecs)
+        clientSock.Send('CodecsOK', utils.IntToBytes(codec, network.CODEC_BYTE_LEN))
+
+        # Compress from the next reply on, once the peer knows the codec
+        clientSock.codec = codec
+
     def _GetAddrs(self, clientSock, clientAddress, msgType, msg):
             addrsBytes = self.__GetAddrsMsg()
             clientSock.Send('Addrs', addrsBytes) 
             if msg:
                 port = utils.BytesToInt(msg)
                 clientHost = clientAddress[0]
-                self.controller.AddPeer(clientHost, port)
+                self.controller.AddPeerAsync(clientHost, port)
 
     def _GetMempool(self, clientSock, clientAddress, msgType, msg):
         #TODO: get random sample
-        mempoolBytes = self.__GetMempoolMsg()
-        clientSock.Send('Mempool', mempoolBytes)
+        mempoolBytes = self.mempoolCache.Get(self.controller.blockchain)
+        clientSock.Send('Mempool', mempoolBytes, compress=True)
 
     def _AddBlock(self, clientSock, clientAddress, msgType, msg):
         if not msg:
@@ -45,18 +89,15 @@ class Server(network.Server):
             return
 
         theirHeight = utils.BytesToInt(msg)
-        height = self.controller.blockchain.GetHeight()
+        snapshot = self.controller.blockchain.GetSnapshot()
 
-        if height < theirHeight:
+        if snapshot.height < theirHeight:
             clientSock.Send('HashesNO')
             return
 
-        chain = []
-        for b in self.controller.blockchain.GetHighestChain():
-            chain.append(b.GetHash())
-        
-        msg = self.__GetBlockAddrsMessage(chain)
-        clientSock.Send('Hashes', msg)
+        height, hashes = self.hashesCache.Get(snapshot)
+        msg = self.__GetBlockAddrsMessage(height, hashes)
+        clientSock.Send('Hashes', msg, compress=True)
 
     def _GetBlocks(self, clientSock, clientAddress, msgType, msg):
         msgLen = len(msg)
@@ -70,11 +111,12 @@ class Server(network.Server):
         numHashes = utils.BytesToInt(msg[start:end])
         start = end
         end += numHashes * utils.HASH_BYTE_LEN
-        if numHashes < 1 or msgLen != end:
+        if numHashes < 1 or numHashes > MAX_BLOCKS_PER_MSG or msgLen != end:
             clientSock.Send('BlocksNo')
             return
 
-        blocksMsg = utils.IntToBytes(numHashes)
+        blocksMsg = [utils.IntToBytes(numHashes)]
+        msgSize = utils.INT_BYTE_LEN
         step = utils.HASH_BYTE_LEN
         for i in range(start, end, step):
             blockHash = msg[i:i+step]
@@ -84,9 +126,61 @@ class Server(network.Server):
                 clientSock.Send('BlocksNo')
                 return
 
-            blocksMsg += block.EncodeBlock(b)
+            blBytes = self.blockCache.Get(b)
+            msgSize += len(blBytes)
+            if msgSize > clientSock.maxFrameSize:
+                # Too big for one frame: the peer has to ask for fewer
+                clientSock.Send('BlocksNo')
+                return
+            blocksMsg.append(blBytes)
+
+        clientSock.Send('Blocks', b''.join(blocksMsg), compress=True)
+
+    def _GetHeaders(self, clientSock, clientAddress, msgType, msg):
+        # Best chain headers after the given height, for light clients
+        if not msg or len(msg) != utils.INT_BYTE_LEN:
+            clientSock.Send('HeadersNO')
+            return
+
+        bc = self.controller.blockchain
+        snapshot = bc.GetSnapshot()
+        start = min(utils.BytesToInt(msg), snapshot.height)
+        end = min(snapshot.height, start + MAX_HEADERS_PER_MSG)
+
+        out = [utils.IntToBytes(snapshot.height), utils.IntToBytes(end - start)]
+        for blockHash in snapshot.bestChain[start:end]:
+            out.append(block.EncodeHeader(bc.GetBlock(blockHash).GetHeader()))
+        clientSock.Send('Headers', b''.join(out), compress=True)
+
+    def _GetAddrProof(self, clientSock, clientAddress, msgType, msg):
+        # addr, start, limit[, maxHeight] -> the addr's txs up to maxHeight,
+        # newest first, each with the height and Merkle proof of its block
+        msgLen = utils.ADDR_BYTE_LEN + 2 * utils.INT_BYTE_LEN
+        if not msg or len(msg) not in (msgLen, msgLen + utils.INT_BYTE_LEN):
+            clientSock.Send('AddrProofNO')
+            return
+
+        addr = msg[:utils.ADDR_BYTE_LEN]
+        pos = utils.ADDR_BYTE_LEN
+        start = utils.BytesToInt(msg[pos:pos + utils.INT_BYTE_LEN])
+        pos += utils.INT_BYTE_LEN
+        limit = min(utils.BytesToInt(msg[pos:pos + utils.INT_BYTE_LEN]), MAX_PROOFS_PER_MSG)
+        pos += utils.INT_BYTE_LEN
+        maxHeight = utils.BytesToInt(msg[pos:pos + utils.INT_BYTE_LEN]) or None
+
+        bc = self.controller.blockchain
+        history = bc.GetAddressHistory(addr, start, limit, maxHeight)
+        if history is None:
+            clientSock.Send('AddrProofNO')
+            return
 
-        clientSock.Send('Blocks', blocksMsg)
+        out = [utils.IntToBytes(len(history))]
+        for height, blockHash, txPos, tx in history:
+            out.append(utils.IntToBytes(height))
+            out.append(utils.IntToBytes(txPos))
+            out.append(transaction.EncodeTx(tx))
+            out.append(merkle.EncodeProof(bc.GetBlock(blockHash).GetTxProof(txPos)))
+        clientSock.Send('AddrProof', b''.join(out), compress=True)
 
     def _Close(self, clientSock, clientAddress, msgType, msg):
         if msg:
@@ -110,28 +204,13 @@ class Server(network.Server):
             addrsBytes += ('%s:%d' % addr).encode()
         return addrsBytes
 
-    def __GetMempoolMsg(self):
-        msg = b''
-        numTx = 0
-        for tx in self.controller.blockchain.GetMempoolTransactions():
-            txBytes = transaction.EncodeTx(tx)
-            if txBytes:
-                msg += txBytes
-                numTx += 1        
-
-        return utils.IntToBytes(numTx) + msg
-
     def __GetServerAddrFromMsg(self, msg):
         (hostname, port) = msg.decode()
         return (hostname, int(port))
 
-    def __GetBlockAddrsMessage(self, chain):
-        height = utils.IntToBytes(len(chain))
+    def __GetBlockAddrsMessage(self, height, hashes):
+        # hashes: the chain's hashes, oldest first
+        height = utils.IntToBytes(height)
         numHashes = height #TODO: slice hashes into different messages?
-        msg = height + numHashes
-
-        for hash in reversed(chain):
-            msg += hash
-        
-        return msg
+        return height + numHashes + hashes
 
@@ -0,0 +1,295 @@
+import blockchain
+import controller
+import log
+import network
+import peermanager
+import transaction
+import utils
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import statistics
+import threading
+import time
+
+# Runs N controllers in this process, each bound to its own loopback address
+# (127.0.1.X) so that links can be told apart, with latency and loss injected
+# on every send. Reports block propagation, fork rate, tx inclusion latency
+# and the time a fresh node takes to sync.
+
+BASE_IP = '127.0.1.'
+BASE_PORT = 7100
+TOPOLOGIES = ('full', 'ring', 'line', 'star', 'random')
+RETRANSMIT_DELAY = 0.2 # extra delay of a "lost" frame, as TCP would retransmit it
+STARTUP_TIME = 1.0
+SYNC_TIMEOUT = 60.0
+STOP_TIMEOUT = 5.0
+
+def Percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    i = min(len(values) - 1, max(0, int(round(p * (len(values) - 1)))))
+    return values[i]
+
+def Summary(values):
+    if not values:
+        return None
+    return {
+        'count': len(values),
+        'mean': statistics.mean(values),
+        'p50': Percentile(values, 0.5),
+        'p90': Percentile(values, 0.9),
+        'p99': Percentile(values, 0.99),
+        'max': max(values),
+    }
+
+
+class LinkShaper:
+    # Installed as network.linkShaper: delays every send by the link latency,
+    # plus a retransmit delay for frames that would have been lost
+    def __init__(self, latency, jitter, loss, seed):
+        self.latency = latency
+        self.jitter  = jitter
+        self.loss    = loss
+        self.links   = {} # (srcIp, dstIp) -> latency override
+        self.rng     = random.Random(seed)
+        self.lock    = threading.Lock()
+
+    def SetLink(self, srcIp, dstIp, latency):
+        self.links[(srcIp, dstIp)] = latency
+        self.links[(dstIp, srcIp)] = latency
+
+    def __call__(self, sock, numBytes):
+        try:
+            link = (sock.sock.getsockname()[0], sock.sock.getpeername()[0])
+        except (OSError, AttributeError):
+            return
+
+        delay = self.links.get(link, self.latency)
+        with self.lock:
+            if self.jitter:
+                delay += self.rng.uniform(0, self.jitter)
+            if self.loss and self.rng.random() < self.loss:
+                delay += RETRANSMIT_DELAY
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Node:
+    def __init__(self, index, initialAddrs, isMiner, args):
+        self.index = index
+        self.ip    = BASE_IP + str(index + 1)
+        self.port  = BASE_PORT + index
+        self.addr  = (self.ip, self.port)
+
+        if isMiner:
+            privateKey, minerAddr = utils.GenerateKeys()
+        else:
+            privateKey, minerAddr = None, None
+
+        self.controller = controller.Controller(minerAddr=minerAddr,
+                                                privateKey=privateKey,
+                                                initialAddrs=initialAddrs,
+                                                addrBookPath=None,
+                                                journalPath=None,
+                                                storePath=None,
+                                                targetOutbound=args.peers,
+                                                difficulty=args.difficulty,
+                                                bindAddr=self.ip,
+                                                admissionWorkers=0, # no process pool per node
+                                                retargetInterval=args.retarget or None,
+                                                targetBlockTime=args.block_time)
+        self.thread = None
+
+    def Start(self):
+        self.thread = threading.Thread(name='Node_%d' % self.index,
+                                       target=self.controller.Start,
+                                       args=(True, self.port),
+                                       daemon=True)
+        self.thread.start()
+
+    def Stop(self):
+        self.controller.Stop()
+
+
+class Simulation:
+    def __init__(self, args):
+        self.args   = args
+        self.rng    = random.Random(args.seed)
+        self.nodes  = []
+        self.lock   = threading.Lock()
+
+        self.blockTimes = {}  # block hash -> {node index: time added}
+        self.txTimes    = {}  # tx hash -> time submitted
+        self.txIncluded = {}  # tx hash -> time first seen in a block
+
+    def GetInitialAddrs(self, i, addrs):
+        n = len(addrs)
+        topology = self.args.topology
+        if n == 1:
+            return []
+        if topology == 'full':
+            return [a for j, a in enumerate(addrs) if j != i]
+        if topology == 'ring':
+            return [addrs[(i + 1) % n]]
+        if topology == 'line':
+            return [addrs[i - 1]] if i > 0 else []
+        if topology == 'star':
+            return [addrs[0]] if i > 0 else []
+        # random: each node dials a few random others
+        others = [a for j, a in enumerate(addrs) if j != i]
+        return self.rng.sample(others, min(self.args.degree, len(others)))
+
+    def AddNode(self, initialAddrs, isMiner, track=True):
+        node = Node(len(self.nodes), initialAddrs, isMiner, self.args)
+        if track:
+            bc = node.controller.blockchain
+            bc.AddListener(blockchain.EVENT_BLOCK_ADDED,
+                           lambda b, i=node.index: self._OnBlockAdded(i, b))
+        self.nodes.append(node)
+        return node
+
+    def _OnBlockAdded(self, i, b):
+        now = time.monotonic()
+        with self.lock:
+            self.blockTimes.setdefault(b.GetHash(), {}).setdefault(i, now)
+            for tx in b.transactions:
+                txHash = tx.GetHash()
+                if txHash in self.txTimes and txHash not in self.txIncluded:
+                    self.txIncluded[txHash] = now
+
+    def Run(self):
+        args = self.args
+
+        network.linkShaper = LinkShaper(args.latency, args.jitter, args.loss, args.seed)
+
+        # Sync and gossip faster than a real deployment so that runs are short
+        controller.SYNC_BLOCKCHAIN_TIME = args.sync_interval
+        controller.UPDATE_MEMPOOL_TIME = args.gossip_interval
+        controller.UPDATE_PEERS_TIME = args.peers_interval
+
+        addrs = [(BASE_IP + str(i + 1), BASE_PORT + i) for i in range(args.nodes)]
+        miners = set(self.rng.sample(range(args.nodes), min(args.miners, args.nodes)))
+        for i in range(args.nodes):
+            self.AddNode(self.GetInitialAddrs(i, addrs), i in miners)
+
+        for node in self.nodes:
+            node.Start()
+        time.sleep(STARTUP_TIME)
+
+        # Inject transactions at random nodes at the given rate
+        keys = [utils.GenerateKeys() for _ in range(args.keys)]
+        endTime = time.monotonic() + args.duration
+        nonce = 0
+        while time.monotonic() < endTime:
+            privateKey, addr = self.rng.choice(keys)
+            nonce += 1
+            tx = transaction.Transaction(addr, addr, 0, nonce)
+            tx.Sign(privateKey)
+            with self.lock:
+                self.txTimes[tx.GetHash()] = time.monotonic()
+            self.rng.choice(self.nodes).controller.blockchain.AddTransaction(tx)
+            time.sleep(1.0 / args.tx_rate)
+
+        # Let the last blocks propagate
+        time.sleep(args.settle)
+
+        syncTime = self.MeasureSync(addrs)
+
+        for node in self.nodes:
+            node.Stop()
+        for node in self.nodes:
+            node.thread.join(STOP_TIMEOUT)
+        network.linkShaper = None
+
+        return self.Report(syncTime)
+
+    def MeasureSync(self, addrs):
+        if not self.args.measure_sync:
+            return None
+
+        target = max(n.controller.blockchain.GetHeight() for n in self.nodes)
+        node = self.AddNode([self.rng.choice(addrs)], False, track=False)
+        startTime = time.monotonic()
+        node.Start()
+        while node.controller.blockchain.GetHeight() < target:
+            if time.monotonic() - startTime > SYNC_TIMEOUT:
+                return None
+            time.sleep(0.01)
+        return time.monotonic() - startTime
+
+    def Report(self, syncTime):
+        reference = self.nodes[0].controller.blockchain
+        bestChain = set(b.GetHash() for b in (reference.GetHighestChain() or []))
+
+        delays = []
+        fullyPropagated = 0
+        with self.lock:
+            for blockHash, times in self.blockTimes.items():
+                first = min(times.values())
+                delays.extend(t - first for t in times.values() if t != first)
+                if len(times) >= self.args.nodes:
+                    fullyPropagated += 1
+            numBlocks = len(self.blockTimes)
+            inclusion = [self.txIncluded[h] - t for h, t in self.txTimes.items()
+                           if h in self.txIncluded]
+            numTxs = len(self.txTimes)
+
+        heights = [n.controller.blockchain.GetHeight() for n in self.nodes[:self.args.nodes]]
+        forks = numBlocks - len(bestChain & set(self.blockTimes))
+
+        return {
+            'params': vars(self.args),
+            'blocks': numBlocks,
+            'blocksOnAllNodes': fullyPropagated,
+            'heights': heights,
+            'forkRate': forks / numBlocks if numBlocks else None,
+            'blockPropagation': Summary(delays),
+            'txs': numTxs,
+            'txsIncluded': len(inclusion),
+            'txInclusionLatency': Summary(inclusion),
+            'syncTime': syncTime,
+        }
+
+
+def Quiet():
+    # The nodes log a lot; only the report goes to stdout, the logs stay in
+    # the ring buffer
+    log.SetOutputLevel(log.OFF)
+    stack = contextlib.ExitStack()
+    devnull = stack.enter_context(open(os.devnull, 'w'))
+    stack.enter_context(contextlib.redirect_stdout(devnull))
+    return stack
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local JoaoChain network simulator')
+    parser.add_argument('--nodes', type=int, default=5)
+    parser.add_argument('--miners', type=int, default=2)
+    parser.add_argument('--topology', choices=TOPOLOGIES, default='random')
+    parser.add_argument('--degree', type=int, default=2, help='peers dialed per node in the random topology')
+    parser.add_argument('--peers', type=int, default=peermanager.DEFAULT_TARGET_OUTBOUND,
+                        help='target outbound peers per node')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds per send')
+    parser.add_argument('--jitter', type=float, default=0.005)
+    parser.add_argument('--loss', type=float, default=0.0, help='fraction of frames retransmitted')
+    parser.add_argument('--difficulty', type=int, default=3)
+    parser.add_argument('--retarget', type=int, default=0, help='retarget interval in blocks, 0 for a fixed difficulty')
+    parser.add_argument('--block-time', type=int, default=controller.TARGET_BLOCK_TIME)
+    parser.add_argument('--duration', type=float, default=20.0)
+    parser.add_argument('--tx-rate', type=float, default=5.0, help='transactions per second')
+    parser.add_argument('--keys', type=int, default=20)
+    parser.add_argument('--settle', type=float, default=3.0)
+    parser.add_argument('--sync-interval', type=float, default=2.0)
+    parser.add_argument('--gossip-interval', type=float, default=0.5)
+    parser.add_argument('--peers-interval', type=float, default=2.0)
+    parser.add_argument('--no-sync', dest='measure_sync', action='store_false')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    with Quiet():
+        report = Simulation(args).Run()
+    print(json.dumps(report, indent=2, sort_keys=True))
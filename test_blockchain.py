@@ -0,0 +1,74 @@
+import blockchain
+import block
+import log
+import transaction
+import utils
+
+import unittest
+
+log.SetOutputLevel(log.OFF)
+
+DIFFICULTY = 2
+RETARGET_INTERVAL = 4
+TARGET_BLOCK_TIME = 10
+
+
+class ForgedTimestampsTest(unittest.TestCase):
+    def setUp(self):
+        self.privateKey, self.miner = utils.GenerateKeysFromSecret(1)
+        self.now = utils.GetCurrentTime()
+        self.bc = blockchain.Blockchain(DIFFICULTY, retargetInterval=RETARGET_INTERVAL,
+                                        targetBlockTime=TARGET_BLOCK_TIME)
+
+    def MakeBlock(self, parent, timestamp):
+        # A valid block on parent, mined against the target it will be checked with
+        rewardTx = transaction.Transaction(self.miner, self.miner, self.bc.reward, timestamp)
+        rewardTx.Sign(self.privateKey, deterministic=True)
+        b = block.Block(parent.GetHash() if parent else None, [rewardTx], timestamp, self.miner)
+        target = self.bc._GetTarget(parent)
+        while blockchain.HashToInt(b.GetHash()) > target:
+            b.nonce += 1
+        b.Sign(self.privateKey, deterministic=True)
+        return b
+
+    def AddChain(self, parent, timestamps):
+        blocks = []
+        for timestamp in timestamps:
+            b = self.MakeBlock(parent, timestamp)
+            self.assertTrue(self.bc.AddBlock(b))
+            blocks.append(b)
+            parent = b
+        return blocks
+
+    def testLongerChainWithLessWorkLoses(self):
+        start = self.now - 100000
+        genesis = self.AddChain(None, [start])[0]
+        honest = self.AddChain(genesis, [start + TARGET_BLOCK_TIME * i for i in range(1, 9)])
+
+        # Blocks 1000 s apart: every retarget makes the forged branch 4x easier,
+        # so it gets longer than the honest one with less work
+        forged = self.AddChain(genesis, [start + 1000 * i for i in range(1, 13)])
+
+        self.assertGreater(forged[-1].height, honest[-1].height)
+        self.assertLess(forged[-1].chainWork, honest[-1].chainWork)
+        self.assertEqual(self.bc.GetHighestBlock(), honest[-1])
+
+    def testTimestampAtOrBelowMedianIsRejected(self):
+        start = self.now - 100000
+        chain = self.AddChain(None, [start + TARGET_BLOCK_TIME * i for i in range(11)])
+
+        # Pulling the timestamp back to restart a retarget timespan
+        median = blockchain.GetMedianTime([b.timestamp for b in chain])
+        self.assertFalse(self.bc.AddBlock(self.MakeBlock(chain[-1], median)))
+        self.assertTrue(self.bc.AddBlock(self.MakeBlock(chain[-1], median + 1)))
+
+    def testTimestampTooFarAheadIsRejected(self):
+        genesis = self.AddChain(None, [self.now])[0]
+
+        future = self.now + blockchain.MAX_FUTURE_BLOCK_TIME + 60
+        self.assertFalse(self.bc.AddBlock(self.MakeBlock(genesis, future)))
+        self.assertEqual(self.bc.GetHighestBlock(), genesis)
+
+
+if __name__ == '__main__':
+    unittest.main()
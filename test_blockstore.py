@@ -0,0 +1,83 @@
+import blockstore
+import chaingen
+import block
+import transaction
+import log
+
+import os
+import tempfile
+import unittest
+
+log.SetOutputLevel(log.OFF)
+
+
+class BlockStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'blocks.dat')
+
+        # Fresh copies, so archiving doesn't touch another test's blocks
+        gen = chaingen.ChainGenerator(height=3, txsPerBlock=3)
+        self.blocks = [block.DecodeBlock(block.EncodeBlock(b)) for b in gen.Generate()]
+        self.txs = [[transaction.EncodeTx(tx) for tx in b.transactions] for b in self.blocks]
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def Put(self, store):
+        for b in self.blocks:
+            store.Put(b)
+
+    def AssertBodies(self):
+        for b, txs in zip(self.blocks, self.txs):
+            self.assertEqual([transaction.EncodeTx(tx) for tx in b.transactions], txs)
+
+    def testRoundTripFromTheFile(self):
+        # A one-body cache: every other read goes to the file
+        store = blockstore.BlockStore(self.path, cacheSize=1)
+        self.Put(store)
+        self.AssertBodies()
+        self.AssertBodies()
+        store.Close()
+
+    def testRoundTripInMemory(self):
+        store = blockstore.BlockStore(cacheSize=1)
+        self.Put(store)
+        self.AssertBodies()
+
+    def testCorruptBodyFailsTheRootCheck(self):
+        store = blockstore.BlockStore(self.path, cacheSize=1)
+        self.Put(store)
+
+        # Flip a byte in the first body; the last one is the one cached
+        with open(self.path, 'r+b') as f:
+            data = bytearray(f.read(1))
+            data[0] ^= 0xff
+            f.seek(0)
+            f.write(data)
+
+        with self.assertRaises(ValueError):
+            self.blocks[0].transactions
+        store.Close()
+
+    def testOneNodePerStore(self):
+        store = blockstore.BlockStore(self.path)
+        with self.assertRaises(RuntimeError):
+            blockstore.BlockStore(self.path)
+
+        # Free again once closed, and truncated when reopened
+        store.Close()
+        store = blockstore.BlockStore(self.path)
+        self.assertEqual(os.path.getsize(self.path), 0)
+        store.Close()
+
+    def testClosedStore(self):
+        store = blockstore.BlockStore(self.path, cacheSize=1)
+        self.Put(store)
+        store.Close()
+        with self.assertRaises(ValueError):
+            self.blocks[0].transactions
+
+
+if __name__ == '__main__':
+    unittest.main()
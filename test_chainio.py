@@ -0,0 +1,69 @@
+import chainio
+import chaingen
+import block
+import log
+
+import os
+import tempfile
+import unittest
+
+log.SetOutputLevel(log.OFF)
+
+HEIGHT = 12
+BATCH_SIZE = 4
+
+
+class ImportChainTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        gen = chaingen.ChainGenerator(height=HEIGHT, txsPerBlock=2)
+        cls.difficulty = gen.difficulty
+        cls.encoded = [block.EncodeBlock(b) for b in gen.Generate()]
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'chain.dat')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def Import(self):
+        bc = chainio.NewBlockchain(self.path)
+        return bc, chainio.ImportChain(bc, self.path, numWorkers=0, batchSize=BATCH_SIZE)
+
+    def testGeneratedChainImportsWithItsParams(self):
+        chainio.WriteChain(self.path, self.encoded, self.difficulty)
+        self.assertEqual(chainio.ReadParams(self.path), (self.difficulty, None, None))
+
+        bc, numAdded = self.Import()
+        self.assertEqual(numAdded, HEIGHT)
+        self.assertEqual(bc.GetHeight(), HEIGHT)
+
+    def testCorruptRecordStopsAfterTheBlocksBeforeIt(self):
+        # In the second batch, so it's read while the first is being applied
+        bad = BATCH_SIZE + 2
+        encoded = list(self.encoded)
+        encoded[bad] = encoded[bad][:-10]
+        chainio.WriteChain(self.path, encoded, self.difficulty)
+
+        bc, numAdded = self.Import()
+        self.assertEqual(numAdded, bad)
+        self.assertEqual(bc.GetHeight(), bad)
+
+    def testTruncatedFileStopsAfterTheBlocksBeforeIt(self):
+        chainio.WriteChain(self.path, self.encoded, self.difficulty)
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 10)
+
+        bc, numAdded = self.Import()
+        self.assertEqual(numAdded, HEIGHT - 1)
+
+    def testNotAChainFile(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'not a chain')
+        with self.assertRaises(ValueError):
+            chainio.ReadParams(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import client
+
+import unittest
+from unittest import mock
+
+
+class Controller:
+    bindAddr = None
+
+
+class BusyTest(unittest.TestCase):
+    def setUp(self):
+        self.peer = client.Client('localhost', 0, Controller())
+        self.peer.Send = lambda msgType, payload=b'', compress=False: True
+        self.replies = []
+        self.peer.Receive = lambda: self.replies.pop(0)
+
+    def Request(self):
+        with mock.patch('client.time.sleep') as sleep:
+            reply = self.peer._Request('GetBlocks')
+        return reply, [c.args[0] for c in sleep.call_args_list]
+
+    def testBusyIsRetriedWithBackoff(self):
+        self.replies = [('Busy', b''), ('Busy', b''), ('Blocks', b'blocks')]
+        reply, sleeps = self.Request()
+        self.assertEqual(reply, ('Blocks', b'blocks'))
+        self.assertEqual(sleeps, [client.BUSY_BACKOFF, 2 * client.BUSY_BACKOFF])
+
+        # Only the answered request counts
+        self.assertEqual(self.peer.stats.numRequests, 1)
+        self.assertEqual(self.peer.stats.errorRate, 0.0)
+
+    def testStillBusyIsNoReplyAndNoError(self):
+        self.replies = [('Busy', b'')] * (client.BUSY_RETRIES + 1)
+        reply, sleeps = self.Request()
+        self.assertEqual(reply, (None, None))
+        self.assertEqual(len(sleeps), client.BUSY_RETRIES)
+        self.assertFalse(self.peer.stats.IsMeasured())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import log
+
+import io
+import unittest
+
+
+class RingTest(unittest.TestCase):
+    def setUp(self):
+        self.logger = log.GetLogger('test_log')
+        log.SetLevel(log.WARNING, 'test_log')
+        log.SetOutputLevel(log.OFF)
+        log.ring.clear()
+
+    def tearDown(self):
+        log.SetRingLevel(log.DEFAULT_RING_LEVEL)
+        log.ring.clear()
+
+    def Dumped(self):
+        out = io.StringIO()
+        log.Dump(out)
+        return out.getvalue()
+
+    def testDebugIsKeptBelowTheModuleAndOutputLevels(self):
+        self.logger.Debug("detail %d", 1)
+        self.assertIn("detail 1", self.Dumped())
+        self.assertEqual(log.handler.pending, 0)
+
+    def testRingLevel(self):
+        log.SetRingLevel(log.INFO)
+        self.logger.Debug("detail")
+        self.logger.Info("info")
+        dumped = self.Dumped()
+        self.assertNotIn("detail", dumped)
+        self.assertIn("info", dumped)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import mempooljournal
+import transaction
+import utils
+import log
+
+import os
+import tempfile
+import unittest
+
+log.SetOutputLevel(log.OFF)
+
+
+class MempoolJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'mempool.journal')
+
+        privateKey, addr = utils.GenerateKeysFromSecret(1)
+        self.txs = []
+        for nonce in range(5):
+            tx = transaction.Transaction(addr, addr, 0, nonce)
+            tx.Sign(privateKey, deterministic=True)
+            self.txs.append(tx)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def Hashes(self, txs):
+        return [tx.GetHash() for tx in txs]
+
+    def Reload(self):
+        j = mempooljournal.MempoolJournal(self.path)
+        return j, j.Load()
+
+    def testReplayKeepsTheLiveTxsInOrder(self):
+        j = mempooljournal.MempoolJournal(self.path)
+        self.assertTrue(j.Open())
+        for tx in self.txs:
+            j.Add(tx)
+        j.Evict([self.txs[1].GetHash(), self.txs[3].GetHash()])
+        j.Close()
+
+        _, txs = self.Reload()
+        self.assertEqual(self.Hashes(txs), self.Hashes([self.txs[0], self.txs[2], self.txs[4]]))
+
+    def testTornTailIsDroppedOnOpen(self):
+        j = mempooljournal.MempoolJournal(self.path)
+        j.Open(self.txs[:2])
+        j.Close()
+        with open(self.path, 'ab') as f:
+            f.write(mempooljournal.RECORD_ADD + b'torn')
+
+        j, txs = self.Reload()
+        self.assertEqual(self.Hashes(txs), self.Hashes(self.txs[:2]))
+
+        # Reopened with one tx gone: appended after the good records
+        j.Open(txs[1:])
+        j.Add(self.txs[2])
+        j.Close()
+
+        _, txs = self.Reload()
+        self.assertEqual(self.Hashes(txs), self.Hashes(self.txs[1:3]))
+
+    def testCompactionKeepsTheLiveTxs(self):
+        j = mempooljournal.MempoolJournal(self.path)
+        j.Open(self.txs)
+        for _ in range(3):
+            j.Evict(self.Hashes(self.txs[:3]))
+            for tx in self.txs[:3]:
+                j.Add(tx)
+        j.Evict(self.Hashes(self.txs[:3]))
+        j.Flush()
+        size = os.path.getsize(self.path)
+
+        self.assertTrue(j.Compact())
+        j.Close()
+        self.assertLess(os.path.getsize(self.path), size)
+
+        _, txs = self.Reload()
+        self.assertEqual(self.Hashes(txs), self.Hashes(self.txs[3:]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import merkle
+import utils
+
+import hashlib
+import unittest
+
+
+def Leaves(n):
+    return [hashlib.sha256(bytes([i])).digest() for i in range(n)]
+
+
+class MerkleTest(unittest.TestCase):
+    def testEveryLeafProves(self):
+        # Odd sizes pair a level's last node with itself
+        for n in (1, 2, 3, 5, 8, 13):
+            leaves = Leaves(n)
+            levels = merkle.GetLevels(leaves)
+            root = merkle.GetRoot(leaves)
+            for i, leaf in enumerate(leaves):
+                proof = merkle.GetProof(levels, i)
+                self.assertTrue(merkle.VerifyProof(leaf, i, proof, root), (n, i))
+
+    def testWrongLeafIndexOrRootFails(self):
+        leaves = Leaves(5)
+        levels = merkle.GetLevels(leaves)
+        root = merkle.GetRoot(leaves)
+        proof = merkle.GetProof(levels, 2)
+
+        self.assertFalse(merkle.VerifyProof(leaves[3], 2, proof, root))
+        self.assertFalse(merkle.VerifyProof(leaves[2], 3, proof, root))
+        self.assertFalse(merkle.VerifyProof(leaves[2], 2 + 8, proof, root))
+        self.assertFalse(merkle.VerifyProof(leaves[2], 2, proof, utils.ZeroHash()))
+
+    def testEmptyTreeHasTheZeroRoot(self):
+        self.assertEqual(merkle.GetRoot([]), utils.ZeroHash())
+
+    def testProofEncoding(self):
+        proof = merkle.GetProof(merkle.GetLevels(Leaves(6)), 4)
+        encoded = merkle.EncodeProof(proof)
+        self.assertEqual(merkle.DecodeProof(encoded + b'rest'), (proof, len(encoded)))
+        self.assertEqual(merkle.DecodeProof(encoded[:-1]), (None, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
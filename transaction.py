@@ -13,8 +13,8 @@ class Transaction:
         # Metadata
         self.timeAdded = None
 
-    def Sign(self, privateKey):
-        self.signature = utils.SignData(self.GetHash(), privateKey)
+    def Sign(self, privateKey, deterministic=False):
+        self.signature = utils.SignData(self.GetHash(), privateKey, deterministic)
 
     def ValidateSignature(self):
         return utils.ValidateSignature(self.GetHash(),
@@ -56,8 +56,15 @@ def GenerateKeys():
 
     return privateKey, publicKey
 
-def SignData(data, privateKey):
+def GenerateKeysFromSecret(secret):
+    # Deterministic keys, for tests and benchmarks only
+    sk = ecdsa.SigningKey.from_secret_exponent(secret, curve=ecdsa.SECP256k1)
+    return sk.to_string(), sk.get_verifying_key().to_string()
+
+def SignData(data, privateKey, deterministic=False):
     sk = ecdsa.SigningKey.from_string(privateKey, curve=ecdsa.SECP256k1)
+    if deterministic:
+        return sk.sign_deterministic(data)
     return sk.sign(data)
 
 def ValidateSignature(data, signature, publicKey):